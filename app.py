@@ -8,7 +8,8 @@ from flask_cors import CORS
 from authlib.integrations.flask_client import OAuth
 from config import (
     FLASK_SECRET_KEY, GOOGLE_CLIENT_ID, GOOGLE_CLIENT_SECRET,
-    PREFERRED_URL_SCHEME, ENABLE_OAUTH_LOGIN, ANIME_GENERATOR_PORT, ANIME_GENERATOR_HOST
+    PREFERRED_URL_SCHEME, ENABLE_OAUTH_LOGIN, ANIME_GENERATOR_PORT, ANIME_GENERATOR_HOST,
+    JOB_RESUME_ON_STARTUP
 )
 from auth import login_required, is_authenticated
 from routes.auth import create_auth_blueprint
@@ -16,7 +17,15 @@ from routes.generate import create_generate_blueprint
 from routes.video import create_video_blueprint
 from routes.api import create_api_blueprint
 from utils.db import init_db
-from utils.comfy_config import COMFYUI_URL_GENERATE, COMFYUI_URL_EDIT, COMFYUI_URL_VIDEO
+from utils.comfy_ws import start_ws_listeners
+from utils.comfy_pool import start_backend_poller
+from utils.jobs import init_jobs
+from utils.job_reaper import start_job_reaper
+from utils.cost_model import init_cost_model
+from utils.keep_warm import start_keep_warm, backend_contact_allowed
+from utils.warmup import start_warmup
+from utils.workflow import check_workflows
+from utils.comfy_config import COMFYUI_URLS_GENERATE, COMFYUI_URLS_EDIT, COMFYUI_URLS_VIDEO
 
 app = Flask(__name__)
 CORS(app)
@@ -78,11 +87,27 @@ if __name__ == '__main__':
     # Cargar tags al iniciar la aplicación
     # Inicializar base de datos de tags
     init_db()
+    # Compile the registered workflows to catch node errors at startup
+    check_workflows()
+    # Open one persistent WebSocket per ComfyUI backend (idle serverless ones wait for their first prompt)
+    start_ws_listeners(allowed=backend_contact_allowed)
+    # Track queue depth of every backend when a mode has a pool of them
+    start_backend_poller()
+    # Persist jobs in SQLite and reattach to prompts left running by a previous process
+    init_jobs(resume=JOB_RESUME_ON_STARTUP)
+    # Load measured generation durations (ETAs, adaptive timeouts, SEJF dispatch)
+    init_cost_model()
+    # Keep serverless (Modal) backends warm while traffic is expected
+    start_keep_warm()
+    # Load the models of every workflow on each backend before the first user prompt
+    start_warmup()
+    # Cancel async jobs whose client stopped sending heartbeats
+    start_job_reaper()
     
     print(f"Iniciando Generador de Anime en {ANIME_GENERATOR_HOST}:{ANIME_GENERATOR_PORT}")
     print(f"Conectando a ComfyUI:")
-    print(f"  - Generate: {COMFYUI_URL_GENERATE}")
-    print(f"  - Edit: {COMFYUI_URL_EDIT}")
-    print(f"  - Video: {COMFYUI_URL_VIDEO}")
+    print(f"  - Generate: {', '.join(COMFYUI_URLS_GENERATE)}")
+    print(f"  - Edit: {', '.join(COMFYUI_URLS_EDIT)}")
+    print(f"  - Video: {', '.join(COMFYUI_URLS_VIDEO)}")
     app.run(host=ANIME_GENERATOR_HOST, port=ANIME_GENERATOR_PORT, debug=False)
 
@@ -3,6 +3,7 @@ Configuration and constants for the AI Content Creator application
 """
 import os
 import json
+import uuid
 
 # Load default configuration from defaults.json
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -76,6 +77,131 @@ ANIME_GENERATOR_HOST = os.environ.get('ANIME_GENERATOR_HOST', get_default('flask
 
 # Workflow paths
 WORKFLOW_PATH = os.environ.get('LUMINA_WORKFLOW_PATH', get_default('workflows.generate', 'workflows/text-to-image/text-to-image-lumina.json'))
-VIDEO_WORKFLOW_PATH = os.environ.get('VIDEO_WORKFLOW_PATH', get_default('workflows.video', 'workflows/image-to-video/video_wan2_2_14B_i2v_remix.json'))
+VIDEO_WORKFLOW_PATH = os.environ.get('VIDEO_WORKFLOW_PATH', get_default('workflows.video', 'workflows/image-to-video/video_wan2_2_14B_i2v_remix_sound.json'))
+VIDEO_NO_SOUND_WORKFLOW_PATH = os.environ.get('VIDEO_NO_SOUND_WORKFLOW_PATH', get_default('workflows.video_no_sound', 'workflows/image-to-video/video_wan2_2_14B_i2v_remix.json'))
+VIDEO_NSFW_WORKFLOW_PATH = os.environ.get('VIDEO_NSFW_WORKFLOW_PATH', get_default('workflows.video_nsfw', 'workflows/image-to-video/video_wan2_2_14B_i2v_remix_sound_nsfw.json'))
 EDIT_WORKFLOW_PATH = os.environ.get('EDIT_WORKFLOW_PATH', get_default('workflows.edit', 'workflows/edit-image/edit-image-qwen-2509-aio.json'))
 
+# ComfyUI HTTP connection pooling
+COMFY_HTTP_POOL_SIZE = int(os.environ.get('COMFY_HTTP_POOL_SIZE', get_default('comfyui.http.pool_size', 16)))
+COMFY_HTTP_CONNECT_TIMEOUT = float(os.environ.get('COMFY_HTTP_CONNECT_TIMEOUT', get_default('comfyui.http.connect_timeout', 5)))
+COMFY_HTTP_READ_TIMEOUT = float(os.environ.get('COMFY_HTTP_READ_TIMEOUT', get_default('comfyui.http.read_timeout', 60)))
+COMFY_HTTP_MAX_RETRIES = int(os.environ.get('COMFY_HTTP_MAX_RETRIES', get_default('comfyui.http.max_retries', 3)))
+COMFY_HTTP_BACKOFF_FACTOR = float(os.environ.get('COMFY_HTTP_BACKOFF_FACTOR', get_default('comfyui.http.backoff_factor', 0.3)))
+
+# ComfyUI WebSocket listener
+# A stable client_id lets every prompt queued by this process report to the same socket
+COMFY_CLIENT_ID = os.environ.get('COMFY_CLIENT_ID') or get_default('comfyui.client_id') or f"ai-content-creator-{uuid.uuid4().hex}"
+COMFY_WS_PING_INTERVAL = float(os.environ.get('COMFY_WS_PING_INTERVAL', get_default('comfyui.ws.ping_interval', 30)))
+COMFY_WS_RECONNECT_MAX_DELAY = float(os.environ.get('COMFY_WS_RECONNECT_MAX_DELAY', get_default('comfyui.ws.reconnect_max_delay', 30)))
+
+# Fallback /history polling while waiting for a prompt (exponential backoff)
+COMFY_POLL_INITIAL_INTERVAL = float(os.environ.get('COMFY_POLL_INITIAL_INTERVAL', get_default('comfyui.poll.initial_interval', 1.0)))
+COMFY_POLL_MAX_INTERVAL = float(os.environ.get('COMFY_POLL_MAX_INTERVAL', get_default('comfyui.poll.max_interval', 15.0)))
+COMFY_HISTORY_SETTLE_TIMEOUT = float(os.environ.get('COMFY_HISTORY_SETTLE_TIMEOUT', get_default('comfyui.poll.history_settle_timeout', 5.0)))
+
+# Backend pools: how often /queue and /system_stats are polled on each backend
+COMFY_POOL_POLL_INTERVAL = float(os.environ.get('COMFY_POOL_POLL_INTERVAL', get_default('comfyui.pool.poll_interval', 2.0)))
+COMFY_POOL_PROBE_TIMEOUT = float(os.environ.get('COMFY_POOL_PROBE_TIMEOUT', get_default('comfyui.pool.probe_timeout', 3.0)))
+# Active /system_stats health probes of every backend (0 disables)
+COMFY_HEALTH_PROBE_INTERVAL = float(os.environ.get('COMFY_HEALTH_PROBE_INTERVAL', get_default('comfyui.health.probe_interval', 15.0)))
+# Circuit breakers: consecutive failed requests or probes before a backend is skipped (0 disables),
+# and seconds an open circuit waits before letting a trial request through
+COMFY_BREAKER_FAILURE_THRESHOLD = int(os.environ.get('COMFY_BREAKER_FAILURE_THRESHOLD', get_default('comfyui.health.failure_threshold', 3)))
+COMFY_BREAKER_RESET_TIMEOUT = float(os.environ.get('COMFY_BREAKER_RESET_TIMEOUT', get_default('comfyui.health.reset_timeout', 30.0)))
+# Extra queued prompts accepted to route a prompt to a backend that already has its models loaded (0 disables)
+COMFY_MODEL_AFFINITY_SLACK = int(os.environ.get('COMFY_MODEL_AFFINITY_SLACK', get_default('comfyui.pool.model_affinity_slack', 1)))
+
+# Fair-share dispatch: prompts of this process kept in flight per backend (0 sends them straight away)
+# and weighted fair queuing weight of each priority class
+COMFY_SCHEDULER_WINDOW = int(os.environ.get('COMFY_SCHEDULER_WINDOW', get_default('comfyui.scheduler.window', 2)))
+COMFY_SCHEDULER_WEIGHTS = {
+    'interactive': float(os.environ.get('COMFY_SCHEDULER_WEIGHT_INTERACTIVE', get_default('comfyui.scheduler.weights.interactive', 4.0))),
+    'batch': float(os.environ.get('COMFY_SCHEDULER_WEIGHT_BATCH', get_default('comfyui.scheduler.weights.batch', 1.0))),
+}
+# Order in which waiting prompts are dispatched: 'fair' (weighted fair queuing) or 'sejf'
+# (shortest expected job first), and the seconds of expected runtime a prompt gains per
+# second it waits under 'sejf', so long prompts are not starved
+COMFY_SCHEDULER_POLICY = os.environ.get('COMFY_SCHEDULER_POLICY', get_default('comfyui.scheduler.policy', 'fair')).strip().lower()
+COMFY_SCHEDULER_AGING = float(os.environ.get('COMFY_SCHEDULER_AGING', get_default('comfyui.scheduler.aging', 0.5)))
+
+# Generation cost model: recent samples kept per (backend, workflow), samples needed before an
+# estimate is trusted, and the adaptive execution timeout (factor x expected + margin; factor 0 disables)
+COST_MODEL_HISTORY = int(os.environ.get('COST_MODEL_HISTORY', get_default('comfyui.cost_model.history', 200)))
+COST_MODEL_MIN_SAMPLES = int(os.environ.get('COST_MODEL_MIN_SAMPLES', get_default('comfyui.cost_model.min_samples', 5)))
+COST_MODEL_TIMEOUT_FACTOR = float(os.environ.get('COST_MODEL_TIMEOUT_FACTOR', get_default('comfyui.cost_model.timeout_factor', 3.0)))
+COST_MODEL_TIMEOUT_MARGIN = float(os.environ.get('COST_MODEL_TIMEOUT_MARGIN', get_default('comfyui.cost_model.timeout_margin', 60.0)))
+
+# Keep-warm of serverless backends that scale to zero: which backends ('off', 'modal' for *.modal.run
+# hosts, 'all') and the seconds their idle container survives (Modal's scaledown_window). A backend is
+# kept warm for some minutes after its last prompt, during fixed local hours ('9-18' or '8-12,14-19';
+# empty for none) and in hours of the week that saw prompts on at least N different days (0 disables),
+# up to a ceiling of kept-warm hours per backend and day (0 for no ceiling)
+COMFY_KEEP_WARM = os.environ.get('COMFY_KEEP_WARM', get_default('modal.keep_warm.backends', 'off')).strip().lower()
+COMFY_KEEP_WARM_SCALEDOWN = float(os.environ.get('COMFY_KEEP_WARM_SCALEDOWN', get_default('modal.keep_warm.scaledown_window', 300)))
+COMFY_KEEP_WARM_RECENT_MINUTES = float(os.environ.get('COMFY_KEEP_WARM_RECENT_MINUTES', get_default('modal.keep_warm.recent_minutes', 30)))
+COMFY_KEEP_WARM_HOURS = os.environ.get('COMFY_KEEP_WARM_HOURS', get_default('modal.keep_warm.hours', '')) or ''
+COMFY_KEEP_WARM_LEARNED_DAYS = int(os.environ.get('COMFY_KEEP_WARM_LEARNED_DAYS', get_default('modal.keep_warm.learned_days', 3)))
+COMFY_KEEP_WARM_MAX_HOURS = float(os.environ.get('COMFY_KEEP_WARM_MAX_HOURS', get_default('modal.keep_warm.max_hours_per_day', 8)))
+
+# Model pre-warming: when the app starts and whenever a backend (re)connects or recovers, a minimal
+# variant of every registered workflow is run on it so its models are loaded before the first user
+# prompt. Seconds one warm-up prompt may take, and seconds before the same backend is warmed again
+COMFY_WARMUP = (
+    os.environ.get('COMFY_WARMUP', '').strip().lower() or
+    str(get_default('comfyui.warmup.enabled', True)).lower()
+) not in {'0', 'false', 'no', 'off', ''}
+COMFY_WARMUP_TIMEOUT = float(os.environ.get('COMFY_WARMUP_TIMEOUT', get_default('comfyui.warmup.timeout', 600)))
+COMFY_WARMUP_COOLDOWN = float(os.environ.get('COMFY_WARMUP_COOLDOWN', get_default('comfyui.warmup.cooldown', 300)))
+
+# Local validation of patched workflows against each backend's cached /object_info
+COMFY_VALIDATE_WORKFLOWS = (
+    os.environ.get('COMFY_VALIDATE_WORKFLOWS', '').strip().lower() or
+    str(get_default('comfyui.validation.enabled', True)).lower()
+) not in {'0', 'false', 'no', 'off', ''}
+COMFY_OBJECT_INFO_TTL = float(os.environ.get('COMFY_OBJECT_INFO_TTL', get_default('comfyui.validation.object_info_ttl', 600)))
+
+# Result cache for deterministic generations (explicit seed)
+RESULT_CACHE_ENABLED = (
+    os.environ.get('RESULT_CACHE_ENABLED', '').strip().lower() or
+    str(get_default('result_cache.enabled', True)).lower()
+) not in {'0', 'false', 'no', 'off', ''}
+RESULT_CACHE_MAX_ENTRIES = int(os.environ.get('RESULT_CACHE_MAX_ENTRIES', get_default('result_cache.max_entries', 1000)))
+RESULT_CACHE_MAX_AGE_SECONDS = int(os.environ.get('RESULT_CACHE_MAX_AGE_SECONDS', get_default('result_cache.max_age_seconds', 7 * 24 * 3600)))
+
+# Request deadlines: time budget of a generation, in seconds, by mode (a client "timeout" can only shorten it)
+REQUEST_DEADLINE_IMAGE = float(os.environ.get('REQUEST_DEADLINE_IMAGE', get_default('deadlines.image', 300)))
+REQUEST_DEADLINE_VIDEO = float(os.environ.get('REQUEST_DEADLINE_VIDEO', get_default('deadlines.video', 1200)))
+REQUEST_DEADLINE_MIN = float(os.environ.get('REQUEST_DEADLINE_MIN', get_default('deadlines.min', 10)))
+# Read timeout when downloading a file to upload it to Google Drive
+DRIVE_DOWNLOAD_TIMEOUT = float(os.environ.get('DRIVE_DOWNLOAD_TIMEOUT', get_default('google.download_timeout', 120)))
+
+# Admission control by mode: generations running at once and admitted requests waiting for a slot;
+# requests beyond both get 429 with Retry-After (a max_active of 0 disables the limit)
+ADMISSION_MAX_ACTIVE = {
+    mode: int(os.environ.get(f'ADMISSION_MAX_ACTIVE_{mode.upper()}', get_default(f'admission.{mode}.max_active', default)))
+    for mode, default in (('generate', 4), ('edit', 4), ('video', 2))
+}
+ADMISSION_MAX_QUEUED = {
+    mode: int(os.environ.get(f'ADMISSION_MAX_QUEUED_{mode.upper()}', get_default(f'admission.{mode}.max_queued', default)))
+    for mode, default in (('generate', 16), ('edit', 16), ('video', 4))
+}
+
+# Background jobs
+JOB_MAX_WORKERS = int(os.environ.get('JOB_MAX_WORKERS', get_default('jobs.max_workers', 4)))
+JOB_RETENTION_SECONDS = int(os.environ.get('JOB_RETENTION_SECONDS', get_default('jobs.retention_seconds', 3600)))
+# Finished jobs older than this are deleted from data/jobs.db
+JOB_STORE_MAX_AGE_SECONDS = int(os.environ.get('JOB_STORE_MAX_AGE_SECONDS', get_default('jobs.store_max_age_seconds', 7 * 24 * 3600)))
+JOB_RESUME_ON_STARTUP = (
+    os.environ.get('JOB_RESUME_ON_STARTUP', '').strip().lower() or
+    str(get_default('jobs.resume_on_startup', True)).lower()
+) not in {'0', 'false', 'no', 'off', ''}
+# Client heartbeats of async jobs: seconds between heartbeats and seconds without one
+# before the job is treated as abandoned and cancelled (0 disables)
+JOB_HEARTBEAT_INTERVAL = float(os.environ.get('JOB_HEARTBEAT_INTERVAL', get_default('jobs.heartbeat_interval', 15.0)))
+JOB_HEARTBEAT_GRACE = float(os.environ.get('JOB_HEARTBEAT_GRACE', get_default('jobs.heartbeat_grace', 120.0)))
+# Bulkheads: worker threads of each workload class; image generation jobs default to JOB_MAX_WORKERS
+BULKHEAD_WORKERS = {
+    name: int(os.environ.get(f'BULKHEAD_WORKERS_{name.upper()}', get_default(f'bulkheads.{name}', default)))
+    for name, default in (('generate', JOB_MAX_WORKERS), ('edit', 2), ('video', 2), ('media', 2))
+}
@@ -1,10 +1,12 @@
 """
 Domain logic for image editing
 """
-import json
-import uuid
-from utils.workflow import EDIT_WORKFLOW, find_save_image_nodes
+from utils.workflow import get_workflow_template
 from utils.comfy import queue_prompt, wait_for_completion
+from utils.comfy_ws import get_comfy_client_id
+from utils.jobs import register_job_kind
+from utils.comfy_pool import pinned_backend, backend_scope, resolve_backend_name, set_backend_affinity
+from utils.cost_model import describe_generation
 from utils.media import (
     persist_media_locally,
     upload_image_data_url_to_comfy,
@@ -17,50 +19,21 @@ def generate_random_seed():
     import random
     return random.randint(0, 2**32 - 1)
 
-def _find_nodes_by_class(workflow, class_types):
-    """Obtener todos los nodos cuyo class_type esté en class_types."""
-    class_set = set(class_types)
-    return [
-        node_id
-        for node_id, node_data in workflow.items()
-        if isinstance(node_data, dict) and node_data.get("class_type") in class_set
-    ]
-
-
-def _find_first_node_by_class(workflow, class_types):
-    """Obtener el primer nodo que coincida con class_types."""
-    nodes = _find_nodes_by_class(workflow, class_types)
-    return nodes[0] if nodes else None
-
-
-def _get_prompt_text(inputs):
-    if not isinstance(inputs, dict):
-        return ""
-    return inputs.get("text") or inputs.get("prompt") or ""
-
-
-def _set_prompt_text(inputs, value):
-    if not isinstance(inputs, dict):
-        return
-    if "text" in inputs:
-        inputs["text"] = value
-    elif "prompt" in inputs:
-        inputs["prompt"] = value
-    else:
-        inputs["text"] = value
-
-
+@pinned_backend('edit')
 def generate_image_edit(positive_prompt, source_image, width=None, height=None, steps=20, seed=None):
     """Editar una imagen existente usando el workflow Qwen AIO."""
-    if not EDIT_WORKFLOW:
-        raise ValueError("Edit workflow is not available")
+    try:
+        template = get_workflow_template('edit')
+    except (OSError, ValueError) as e:
+        raise ValueError(f"Edit workflow is not available: {e}")
 
     if not source_image or (
         not source_image.get('filename') and not source_image.get('data_url')
     ):
         raise ValueError("No source image provided for edit mode")
 
-    workflow = json.loads(json.dumps(EDIT_WORKFLOW))
+    # Models do not depend on the patches: set the affinity before uploading the image
+    set_backend_affinity('edit', template.workflow)
 
     if source_image.get('data_url'):
         upload_name = upload_image_data_url_to_comfy(
@@ -79,55 +52,41 @@ def generate_image_edit(positive_prompt, source_image, width=None, height=None,
             filename=source_image.get('filename', ''),
             subfolder=source_image.get('subfolder', ''),
             image_type=source_image.get('type', 'output'),
-            mode='edit'
+            mode='edit',
+            source_url=resolve_backend_name(source_image.get('backend'))
         )
 
-    load_image_node = _find_first_node_by_class(workflow, {"LoadImage", "LoadImageMask"})
-    if load_image_node and "inputs" in workflow[load_image_node]:
-        workflow[load_image_node]["inputs"]["image"] = upload_name
-
-    positive_nodes = [
-        node_id for node_id, node_data in workflow.items()
-        if isinstance(node_data, dict)
-        and node_data.get("class_type") in ("TextEncodeQwenImageEditPlus", "CLIPTextEncode")
-        and "positive" in node_data.get("_meta", {}).get("title", "").lower()
-    ]
-    if not positive_nodes:
-        positive_nodes = _find_nodes_by_class(workflow, {"TextEncodeQwenImageEditPlus"})
-
-    for node_id in positive_nodes:
-        _set_prompt_text(workflow.get(node_id, {}).get("inputs", {}), positive_prompt or "")
-
-    latent_nodes = _find_nodes_by_class(workflow, {"EmptyLatentImage", "EmptySD3LatentImage"})
+    # Resolution only when both values are valid
+    w = h = None
     if width is not None and height is not None:
         try:
             w = int(width)
             h = int(height)
-            for node_id in latent_nodes:
-                inputs = workflow.get(node_id, {}).get("inputs", {})
-                if isinstance(inputs, dict):
-                    inputs["width"] = w
-                    inputs["height"] = h
         except (ValueError, TypeError):
-            pass
-
-    steps_value = int(steps)
-    seed_value = int(seed) if seed is not None else generate_random_seed()
-
-    sampler_nodes = _find_nodes_by_class(workflow, {"KSampler", "KSamplerAdvanced"})
-    for node_id in sampler_nodes:
-        inputs = workflow.get(node_id, {}).get("inputs", {})
-        if isinstance(inputs, dict):
-            if "steps" in inputs:
-                inputs["steps"] = steps_value
-            if "seed" in inputs:
-                inputs["seed"] = seed_value
+            w = h = None
+
+    # Apply image, prompt, resolution, steps and seed following the template's plan
+    workflow = template.instantiate(
+        image=upload_name,
+        positive=positive_prompt or "",
+        width=w,
+        height=h,
+        steps=int(steps),
+        seed=int(seed) if seed is not None else generate_random_seed(),
+    )
+    # Profile for the cost model (ETA, adaptive timeout)
+    describe_generation('edit', template.name, workflow, width=w, height=h, steps=steps)
 
-    client_id = str(uuid.uuid4())
+    client_id = get_comfy_client_id()
     result = queue_prompt(workflow, client_id, mode='edit')
     prompt_id = result["prompt_id"]
 
-    target_nodes = find_save_image_nodes(workflow)
+    target_nodes = template.output_nodes
+    return _collect_edited_images(client_id, prompt_id, target_nodes)
+
+
+def _collect_edited_images(client_id, prompt_id, target_nodes):
+    """Wait for an edit prompt and save its images locally."""
     images = wait_for_completion(
         client_id,
         prompt_id,
@@ -150,3 +109,12 @@ def generate_image_edit(positive_prompt, source_image, width=None, height=None,
         "client_id": client_id
     }
 
+
+def resume_edit_job(job):
+    """Resume an edit job after a restart by waiting on its prompt_id."""
+    with backend_scope('edit', job.backend_url, job.prompt_id):
+        return _collect_edited_images(get_comfy_client_id(), job.prompt_id, job.target_nodes)
+
+
+register_job_kind('edit', generate_image_edit, resume_edit_job)
+
@@ -1,11 +1,14 @@
 """
 Domain logic for image generation (text-to-image)
 """
-import json
-import uuid
-from utils.workflow import get_workflow_by_model, find_save_image_nodes
-from utils.comfy import queue_prompt, wait_for_completion
+from utils.workflow import get_template_by_model
+from utils.comfy import queue_prompt, wait_for_completion, ComfyExecutionError, WorkflowValidationError, BackendUnavailableError, DeadlineExceeded
+from utils.comfy_ws import get_comfy_client_id
 from utils.media import persist_media_locally
+from utils.jobs import register_job_kind, JobCancelled
+from utils.result_cache import workflow_cache_key, get_cached_result, store_cached_result
+from utils.comfy_pool import pinned_backend, backend_scope, set_backend_affinity
+from utils.cost_model import describe_generation
 
 CHROMA_DEFAULT_NEGATIVE = (
     "Blurry, Low res, Bad Quality, Low Quality, blurry, low quality, pixelated, noisy, distorted, "
@@ -21,110 +24,57 @@ def generate_random_seed():
     import random
     return random.randint(0, 2**32 - 1)
 
-def _get_prompt_text(inputs):
-    """Obtener el campo de texto/prompt disponible."""
-    if not isinstance(inputs, dict):
-        return ""
-    return inputs.get("text") or inputs.get("prompt") or ""
+def _collect_generated_images(client_id, prompt_id, save_image_nodes):
+    """Wait for a queued prompt and save its images locally."""
+    # Wait for completion on the detected output nodes
+    images = wait_for_completion(client_id, prompt_id, target_nodes=save_image_nodes, mode='generate')
+    print(f"[INFO] Received {len(images) if images else 0} image(s) from wait_for_completion")
+    
+    if not images:
+        print(f"[ERROR] No images returned from wait_for_completion for prompt_id: {prompt_id}")
+        raise ValueError(f"No images were returned from ComfyUI for prompt_id: {prompt_id}")
+    
+    local_images = persist_media_locally(images, prompt_id, media_category="images", mode='generate')
+    if not local_images:
+        print(f"[ERROR] Failed to persist images locally for prompt_id: {prompt_id}")
+        raise ValueError("No images were persisted locally after generation.")
+    
+    return {
+        "success": True,
+        "prompt_id": prompt_id,
+        "images": local_images,
+        "client_id": client_id
+    }
 
 
-def _set_prompt_text(inputs, value):
-    """Actualizar el texto/prompt respetando el campo disponible."""
-    if not isinstance(inputs, dict):
-        return
-    if "text" in inputs:
-        inputs["text"] = value
-    elif "prompt" in inputs:
-        inputs["prompt"] = value
-    else:
-        inputs["text"] = value
+def resume_generate_job(job):
+    """Resume a generate job after a restart by waiting on its prompt_id."""
+    with backend_scope('generate', job.backend_url, job.prompt_id):
+        return _collect_generated_images(get_comfy_client_id(), job.prompt_id, job.target_nodes)
 
 
-def generate_images(positive_prompt, negative_prompt=None, width=1024, height=1024, steps=20, seed=None, model='lumina'):
-    """Generar imágenes usando ComfyUI
+@pinned_backend('generate')
+def generate_images(positive_prompt, negative_prompt=None, width=1024, height=1024, steps=20, seed=None, model='lumina', use_cache=True):
+    """Generate images with ComfyUI
     
     Args:
-        positive_prompt: Prompt positivo para la generación
-        negative_prompt: Prompt negativo (opcional)
-        width: Ancho de la imagen
-        height: Alto de la imagen
-        steps: Número de pasos de inferencia
-        seed: Semilla para la generación (opcional)
-        model: Modelo a usar ('lumina', 'chroma' o 'qwen')
+        positive_prompt: Positive prompt of the generation
+        negative_prompt: Negative prompt (optional)
+        width: Image width
+        height: Image height
+        steps: Number of inference steps
+        seed: Seed of the generation (optional)
+        model: Model to use ('lumina', 'chroma' or 'qwen')
+        use_cache: Reuse the result of an identical workflow generated before
+            (only applies with an explicit seed)
     """
-    client_id = str(uuid.uuid4())
+    client_id = get_comfy_client_id()
     
-    # Cargar workflow según el modelo seleccionado
-    base_workflow = get_workflow_by_model(model)
-    workflow = json.loads(json.dumps(base_workflow))
-
-    # Detectar nodos automáticamente según el tipo de workflow
-    positive_nodes = []
-    negative_nodes = []
-    latent_nodes = []
-    sampler_nodes = []
-    scheduler_nodes = []
-    noise_nodes = []
-    
-    # Nodos conocidos por modelo (fallback)
-    known_positive_nodes = {"lumina": ["6", "15"], "chroma": ["748"], "qwen": ["10"]}
-    known_negative_nodes = {"lumina": ["7", "16"], "chroma": ["749"], "qwen": ["7"]}
-    known_latent_nodes = {"lumina": ["13", "5"], "chroma": ["737"], "qwen": ["5"]}
-    known_scheduler_nodes = {"lumina": ["3", "10", "11"], "chroma": ["734"], "qwen": ["3"]}
-    known_noise_nodes = {"lumina": [], "chroma": ["718"], "qwen": []}
-    
-    for node_id, node_data in workflow.items():
-        if isinstance(node_data, dict):
-            class_type = node_data.get("class_type", "")
-            inputs = node_data.get("inputs", {})
-            meta = node_data.get("_meta", {})
-            title = meta.get("title", "").lower() if meta else ""
-            
-            # Detectar nodos de prompts por class_type y título
-            if class_type in ("CLIPTextEncode", "TextEncodeQwenImageEditPlus"):
-                text = _get_prompt_text(inputs).lower()
-                if "positive" in text or "positive" in title or node_id in known_positive_nodes.get(model, []):
-                    positive_nodes.append(node_id)
-                elif "negative" in text or "negative" in title or node_id in known_negative_nodes.get(model, []):
-                    negative_nodes.append(node_id)
-            
-            # Detectar nodos de latente
-            if class_type in ["EmptyLatentImage", "EmptySD3LatentImage"]:
-                latent_nodes.append(node_id)
-            
-            # Detectar nodos de sampler
-            if class_type in ["KSampler", "KSamplerAdvanced", "SamplerCustomAdvanced"]:
-                sampler_nodes.append(node_id)
-            
-            # Detectar nodos de scheduler
-            if class_type == "BasicScheduler" or (class_type == "KSampler" and "steps" in inputs):
-                scheduler_nodes.append(node_id)
-            
-            # Detectar nodos de noise/seed
-            if class_type == "RandomNoise":
-                noise_nodes.append(node_id)
-            elif "noise_seed" in inputs:
-                noise_nodes.append(node_id)
-
-    # Usar valores por defecto si no se detectaron nodos
-    if not positive_nodes:
-        positive_nodes = known_positive_nodes.get(model, ["6"])
-    if not negative_nodes:
-        negative_nodes = known_negative_nodes.get(model, ["7"])
-    if not latent_nodes:
-        latent_nodes = known_latent_nodes.get(model, ["13"])
-    if not scheduler_nodes:
-        scheduler_nodes = known_scheduler_nodes.get(model, ["3"])
-    if not noise_nodes:
-        noise_nodes = known_noise_nodes.get(model, [])
-
-    # Actualizar prompts positivos
-    base_positive = ""
-    for node_id in positive_nodes:
-        base_positive = _get_prompt_text(workflow.get(node_id, {}).get("inputs", {}))
-        if base_positive:
-            break
+    # Precompiled template of the model (nodes per role resolved at load time)
+    template = get_template_by_model(model)
 
+    # Compose the positive prompt on top of the workflow's base text
+    base_positive = template.base_text("positive")
     if base_positive:
         if "<Prompt Start>" in base_positive:
             parts = base_positive.split("<Prompt Start>")
@@ -134,62 +84,53 @@ def generate_images(positive_prompt, negative_prompt=None, width=1024, height=10
     else:
         new_positive = positive_prompt
     
-    for node_id in positive_nodes:
-        if node_id in workflow and "inputs" in workflow[node_id]:
-            _set_prompt_text(workflow[node_id]["inputs"], new_positive)
-    
-    # Aplicar negative prompt por defecto para Chroma
+    # Apply the default negative prompt for Chroma
     if model == 'chroma':
         if negative_prompt:
             negative_prompt = f"{negative_prompt}, {CHROMA_DEFAULT_NEGATIVE}"
         else:
             negative_prompt = CHROMA_DEFAULT_NEGATIVE
 
-    # Actualizar prompts negativos si se proporciona
+    # Compose the negative prompt when one is given
+    new_negative = None
     if negative_prompt:
-        base_negative = ""
-        for node_id in negative_nodes:
-            base_negative = _get_prompt_text(workflow.get(node_id, {}).get("inputs", {}))
-            if base_negative:
-                break
+        base_negative = template.base_text("negative")
         if base_negative:
             new_negative = f"{base_negative} {negative_prompt}".strip()
         else:
             new_negative = negative_prompt
 
-        for node_id in negative_nodes:
-            if node_id in workflow and "inputs" in workflow[node_id]:
-                _set_prompt_text(workflow[node_id]["inputs"], new_negative)
-
-    # Actualizar resolución
-    for node_id in latent_nodes:
-        if node_id in workflow and "inputs" in workflow[node_id]:
-            workflow[node_id]["inputs"]["width"] = int(width)
-            workflow[node_id]["inputs"]["height"] = int(height)
-
-    # Actualizar configuración de muestreo (steps y seed)
-    steps_value = int(steps)
+    # Apply prompts, resolution, steps and seed following the template's plan
     seed_value = int(seed) if seed is not None else generate_random_seed()
-
-    # Actualizar steps en scheduler nodes
-    for node_id in scheduler_nodes:
-        if node_id in workflow and "inputs" in workflow[node_id]:
-            sampler_inputs = workflow[node_id]["inputs"]
-            if "steps" in sampler_inputs:
-                sampler_inputs["steps"] = steps_value
-
-    # Actualizar seed en sampler nodes y noise nodes
-    for node_id in sampler_nodes + noise_nodes:
-        if node_id in workflow and "inputs" in workflow[node_id]:
-            sampler_inputs = workflow[node_id]["inputs"]
-            if "noise_seed" in sampler_inputs:
-                sampler_inputs["noise_seed"] = seed_value
-            if "seed" in sampler_inputs:
-                sampler_inputs["seed"] = seed_value
-    
-    # Detectar automáticamente los nodos SaveImage en el workflow
-    save_image_nodes = find_save_image_nodes(workflow)
-    print(f"[INFO] Model: {model}, Detected SaveImage nodes: {save_image_nodes}")
+    workflow = template.instantiate(
+        positive=new_positive,
+        negative=new_negative,
+        width=int(width),
+        height=int(height),
+        steps=int(steps),
+        seed=seed_value,
+    )
+    # Prefer a backend that already has this workflow's models loaded
+    set_backend_affinity('generate', workflow)
+    # Profile for the cost model (ETA, adaptive timeout)
+    describe_generation('generate', template.name, workflow, width=width, height=height, steps=steps)
+
+    save_image_nodes = template.output_nodes
+    print(f"[INFO] Model: {model}, SaveImage nodes: {save_image_nodes}")
+
+    # With an explicit seed the result is deterministic: reuse images already saved
+    cache_key = workflow_cache_key(workflow, mode='generate') if seed is not None else None
+    if cache_key and use_cache:
+        cached = get_cached_result(cache_key)
+        if cached:
+            print(f"[CACHE] Hit for prompt {cached['prompt_id']}, skipping ComfyUI")
+            return {
+                "success": True,
+                "prompt_id": cached["prompt_id"],
+                "images": cached["media"],
+                "client_id": client_id,
+                "cached": True
+            }
     
     try:
         # Enviar a la cola usando modo 'generate'
@@ -197,28 +138,18 @@ def generate_images(positive_prompt, negative_prompt=None, width=1024, height=10
         prompt_id = result["prompt_id"]
         print(f"[INFO] Prompt queued with ID: {prompt_id}, waiting for completion with target nodes: {save_image_nodes}")
         
-        # Esperar a que se complete usando los nodos detectados
-        images = wait_for_completion(client_id, prompt_id, target_nodes=save_image_nodes, mode='generate')
-        print(f"[INFO] Received {len(images) if images else 0} image(s) from wait_for_completion")
-        
-        if not images:
-            print(f"[ERROR] No images returned from wait_for_completion for prompt_id: {prompt_id}")
-            raise ValueError(f"No images were returned from ComfyUI for prompt_id: {prompt_id}")
-        
-        local_images = persist_media_locally(images, prompt_id, media_category="images", mode='generate')
-        if not local_images:
-            print(f"[ERROR] Failed to persist images locally for prompt_id: {prompt_id}")
-            raise ValueError("No images were persisted locally after generation.")
-        
-        return {
-            "success": True,
-            "prompt_id": prompt_id,
-            "images": local_images,
-            "client_id": client_id
-        }
+        result = _collect_generated_images(client_id, prompt_id, save_image_nodes)
+        if cache_key:
+            store_cached_result(cache_key, 'generate', prompt_id, result["images"])
+        return result
+    except (ComfyExecutionError, WorkflowValidationError, BackendUnavailableError, DeadlineExceeded, JobCancelled):
+        # The route maps these to 502 / 422 / 503 / 504 / 409 and the job runner records them as failures
+        raise
     except Exception as e:
         return {
             "success": False,
             "error": str(e)
         }
 
+
+register_job_kind('generate', generate_images, resume_generate_job)
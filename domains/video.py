@@ -1,34 +1,41 @@
 """
 Domain logic for video generation (image-to-video)
 """
-import json
-import uuid
-import requests
-from utils.workflow import VIDEO_WORKFLOW, load_workflow, find_video_output_nodes
-from utils.comfy import queue_prompt, wait_for_completion
-from utils.media import persist_media_locally, upload_image_data_url_to_comfy, upload_local_media_to_comfy, upload_image_to_comfy
-from utils.comfy_config import get_comfy_url, build_comfy_headers
-from config import VIDEO_WORKFLOW_PATH
+import os
+from utils.workflow import get_workflow_template
+from utils.comfy import queue_prompt, wait_for_completion, ComfyExecutionError, WorkflowValidationError, BackendUnavailableError, DeadlineExceeded
+from utils.comfy_ws import get_comfy_client_id
+from utils.media import persist_media_locally, upload_image_data_url_to_comfy, upload_local_media_to_comfy, upload_image_to_comfy, resolve_local_media_path
+from utils.comfy_http import comfy_get
+from utils.jobs import update_current_job, register_job_kind, JobCancelled
+from utils.comfy_pool import pinned_backend, backend_scope, resolve_backend_name, set_backend_affinity
+from utils.video_utils import extract_last_frame, combine_videos_with_extension
+from utils.bulkheads import run_in_bulkhead
+from utils.cost_model import describe_generation
 
+@pinned_backend('video')
 def generate_video_from_image(positive_prompt, source_image, width=None, height=None, negative_prompt=None, length=None, fps=None, nsfw=False, no_sound=False):
     """Generar un video a partir de una imagen usando ComfyUI"""
     # Seleccionar workflow según NSFW y no_sound
     # NSFW tiene prioridad sobre no_sound
     if nsfw:
-        workflow_path = 'workflows/image-to-video/video_wan2_2_14B_i2v_remix_sound_nsfw.json'
-        print(f"[VIDEO] Using NSFW workflow: {workflow_path}")
+        workflow_name = 'video_nsfw'
+        print(f"[VIDEO] Using NSFW workflow: {workflow_name}")
     elif no_sound:
-        workflow_path = 'workflows/image-to-video/video_wan2_2_14B_i2v_remix.json'
-        print(f"[VIDEO] Using no-sound workflow: {workflow_path}")
+        workflow_name = 'video_no_sound'
+        print(f"[VIDEO] Using no-sound workflow: {workflow_name}")
     else:
-        workflow_path = 'workflows/image-to-video/video_wan2_2_14B_i2v_remix_sound.json'
-        print(f"[VIDEO] Using standard workflow with sound: {workflow_path}")
+        workflow_name = 'video'
+        print(f"[VIDEO] Using standard workflow with sound: {workflow_name}")
     
-    workflow = load_workflow(VIDEO_WORKFLOW_PATH, workflow_path)
-    if not workflow:
-        raise ValueError(f"Video workflow could not be loaded: {workflow_path}")
+    try:
+        template = get_workflow_template(workflow_name)
+    except (OSError, ValueError) as e:
+        raise ValueError(f"Video workflow could not be loaded: {workflow_name} ({e})")
 
-    workflow = json.loads(json.dumps(workflow))
+    # Copy-on-write instance: only the patched nodes are copied
+    workflow = template.instantiate()
+    set_backend_affinity('video', workflow)
 
     # Extraer prompt de audio del prompt principal
     # Buscar "Audio:" y tomar lo que está después
@@ -47,11 +54,11 @@ def generate_video_from_image(positive_prompt, source_image, width=None, height=
 
     # Actualizar prompt de video (nodo 93)
     if "93" in workflow:
-        workflow["93"]["inputs"]["text"] = video_prompt
+        workflow.set_input("93", "text", video_prompt)
 
     # Actualizar prompt de audio (nodo 115 - MMAudioSampler) solo si el workflow tiene sonido
     if audio_prompt and "115" in workflow and not no_sound:
-        workflow["115"]["inputs"]["prompt"] = audio_prompt
+        workflow.set_input("115", "prompt", audio_prompt)
         print(f"[VIDEO] Updated audio prompt in node 115")
     elif no_sound:
         print(f"[VIDEO] No-sound mode: skipping audio prompt update")
@@ -59,25 +66,25 @@ def generate_video_from_image(positive_prompt, source_image, width=None, height=
     # Actualizar negative prompt (nodo 89)
     if negative_prompt and "89" in workflow:
         base_negative = workflow["89"]["inputs"].get("text", "")
-        workflow["89"]["inputs"]["text"] = f"{base_negative} {negative_prompt}".strip()
+        workflow.set_input("89", "text", f"{base_negative} {negative_prompt}".strip())
 
     # Actualizar dimensiones y length (nodo 98 - WanImageToVideo)
     if "98" in workflow:
         if length is not None:
             try:
-                workflow["98"]["inputs"]["length"] = int(length)
+                workflow.set_input("98", "length", int(length))
             except (ValueError, TypeError):
                 pass
         
         if width is not None:
             try:
-                workflow["98"]["inputs"]["width"] = int(width)
+                workflow.set_input("98", "width", int(width))
             except (ValueError, TypeError):
                 pass
         
         if height is not None:
             try:
-                workflow["98"]["inputs"]["height"] = int(height)
+                workflow.set_input("98", "height", int(height))
             except (ValueError, TypeError):
                 pass
 
@@ -86,15 +93,33 @@ def generate_video_from_image(positive_prompt, source_image, width=None, height=
         try:
             # Workflow con sonido usa VHS_VideoCombine (nodo 110)
             if "110" in workflow:
-                workflow["110"]["inputs"]["frame_rate"] = int(fps)
+                workflow.set_input("110", "frame_rate", int(fps))
                 print(f"[VIDEO] Updated fps in VHS_VideoCombine (node 110): {fps}")
             # Workflow sin sonido usa CreateVideo (nodo 94)
             elif "94" in workflow:
-                workflow["94"]["inputs"]["fps"] = int(fps)
+                workflow.set_input("94", "fps", int(fps))
                 print(f"[VIDEO] Updated fps in CreateVideo (node 94): {fps}")
         except (ValueError, TypeError, KeyError):
             pass
 
+    # Profile for the cost model with the effective workflow values (defaults included)
+    size_inputs = workflow["98"]["inputs"] if "98" in workflow else {}
+    if "110" in workflow:
+        effective_fps = workflow["110"]["inputs"].get("frame_rate")
+    elif "94" in workflow:
+        effective_fps = workflow["94"]["inputs"].get("fps")
+    else:
+        effective_fps = None
+    describe_generation(
+        'video',
+        workflow_name,
+        workflow,
+        width=size_inputs.get("width"),
+        height=size_inputs.get("height"),
+        length=size_inputs.get("length"),
+        fps=effective_fps,
+    )
+
     # Subir imagen de entrada
     upload_name = None
     
@@ -136,19 +161,17 @@ def generate_video_from_image(positive_prompt, source_image, width=None, height=
     # Para video, siempre necesitamos que esté en 'input'
     elif source_image.get('filename'):
         source_image_type = (source_image.get('type') or '').lower()
-        modal_headers = build_comfy_headers()
         
         # Intentar verificar si la imagen existe en el endpoint de video en 'input'
         try:
-            comfy_url = get_comfy_url('video')
             # Verificar si existe en 'input' (donde LoadImage la busca)
-            check_response = requests.get(
-                f"{comfy_url}/view",
+            check_response = comfy_get(
+                "/view",
+                mode='video',
                 params={
                     'filename': source_image.get('filename'),
                     'type': 'input'
                 },
-                headers=modal_headers,
                 timeout=5
             )
             
@@ -158,31 +181,34 @@ def generate_video_from_image(positive_prompt, source_image, width=None, height=
             else:
                 # No existe en 'input', necesitamos descargarla y re-subirla a 'input'
                 try:
-                    from utils.comfy_config import get_comfy_url
                     from utils.media import upload_image_bytes_to_comfy
                     
                     # Intentar descargar desde el endpoint donde esté (generate o video)
                     download_urls = []
+                    # Pool backend where the image was uploaded or generated, if known
+                    source_url = resolve_backend_name(source_image.get('backend'))
+                    if source_url:
+                        download_urls.append(('generate', source_image_type or 'output', source_url))
                     if source_image_type == 'output':
                         # Si viene de output, intentar desde generate primero
-                        download_urls.append(('generate', 'output'))
-                        download_urls.append(('video', 'output'))
+                        download_urls.append(('generate', 'output', None))
+                        download_urls.append(('video', 'output', None))
                     else:
                         # Si viene de input, intentar desde generate primero
-                        download_urls.append(('generate', 'input'))
-                        download_urls.append(('video', 'input'))
+                        download_urls.append(('generate', 'input', None))
+                        download_urls.append(('video', 'input', None))
                     
                     download_response = None
-                    for endpoint_mode, img_type in download_urls:
+                    for endpoint_mode, img_type, endpoint_url in download_urls:
                         try:
-                            endpoint_url = get_comfy_url(endpoint_mode)
-                            download_response = requests.get(
-                                f"{endpoint_url}/view",
+                            download_response = comfy_get(
+                                "/view",
+                                mode=endpoint_mode,
+                                base_url=endpoint_url,
                                 params={
                                     'filename': source_image.get('filename'),
                                     'type': img_type
                                 },
-                                headers=modal_headers,
                                 timeout=10
                             )
                             if download_response.status_code == 200:
@@ -215,7 +241,8 @@ def generate_video_from_image(positive_prompt, source_image, width=None, height=
                     filename=source_image.get('filename', ''),
                     subfolder=source_image.get('subfolder', ''),
                     image_type=source_image_type or 'output',
-                    mode='video'
+                    mode='video',
+                    source_url=resolve_backend_name(source_image.get('backend'))
                 )
                 print(f"[VIDEO] Re-uploaded image to video endpoint (fallback): {upload_name}")
             except Exception as e2:
@@ -228,23 +255,28 @@ def generate_video_from_image(positive_prompt, source_image, width=None, height=
 
     # Actualizar nodo LoadImage (puede ser 97 o 117 dependiendo del workflow)
     if "117" in workflow:
-        workflow["117"]["inputs"]["image"] = upload_name
+        workflow.set_input("117", "image", upload_name)
         print(f"[VIDEO] Updated LoadImage node 117 with: {upload_name}")
     elif "97" in workflow:
-        workflow["97"]["inputs"]["image"] = upload_name
+        workflow.set_input("97", "image", upload_name)
         print(f"[VIDEO] Updated LoadImage node 97 with: {upload_name}")
 
-    client_id = str(uuid.uuid4())
+    client_id = get_comfy_client_id()
 
     result = queue_prompt(workflow, client_id, mode='video')
     prompt_id = result.get("prompt_id")
     print(f"[VIDEO] Prompt queued with ID: {prompt_id}")
 
     # Detectar automáticamente los nodos de salida de video
-    video_output_nodes = find_video_output_nodes(workflow)
+    video_output_nodes = template.video_output_nodes
     print(f"[VIDEO] Detected video output nodes: {video_output_nodes}")
 
-    # Buscar video en los nodos detectados
+    return _collect_generated_videos(client_id, prompt_id, video_output_nodes)
+
+
+def _collect_generated_videos(client_id, prompt_id, video_output_nodes):
+    """Wait for a video prompt and save its videos locally."""
+    # Look for videos on the detected output nodes
     videos = wait_for_completion(
         client_id,
         prompt_id,
@@ -269,3 +301,117 @@ def generate_video_from_image(positive_prompt, source_image, width=None, height=
         "videos": normalized_videos
     }
 
+
+def resume_video_job(job):
+    """Resume a video job after a restart by waiting on its prompt_id."""
+    with backend_scope('video', job.backend_url, job.prompt_id):
+        return _collect_generated_videos(get_comfy_client_id(), job.prompt_id, job.target_nodes)
+
+
+def extend_video(positive_prompt, base_video_path, video_info=None, width=None, height=None, negative_prompt=None, length=None, fps=None, nsfw=False):
+    """Extend a local video by generating a new segment from its last frame and appending it."""
+    update_current_job(stage='extracting_frame')
+    try:
+        last_frame_info = run_in_bulkhead('media', extract_last_frame, base_video_path)
+    except DeadlineExceeded:
+        raise
+    except Exception as exc:
+        raise RuntimeError(f"Unable to extract the last frame: {exc}") from exc
+
+    frame_source_image = {
+        "filename": last_frame_info["filename"],
+        "local_path": last_frame_info["local_path"],
+        "type": "local",
+        "mime_type": last_frame_info.get("mime_type"),
+    }
+
+    try:
+        generation_result = generate_video_from_image(
+            positive_prompt=positive_prompt,
+            source_image=frame_source_image,
+            width=width,
+            height=height,
+            negative_prompt=negative_prompt,
+            length=length,
+            fps=fps,
+            nsfw=nsfw
+        )
+    except (ComfyExecutionError, WorkflowValidationError, BackendUnavailableError, DeadlineExceeded, JobCancelled):
+        raise
+    except Exception as exc:
+        raise RuntimeError(f"Unable to generate extension video: {exc}") from exc
+
+    return _combine_video_extension(base_video_path, video_info, last_frame_info, generation_result)
+
+
+def _combine_video_extension(base_video_path, video_info, last_frame_info, generation_result):
+    """Append the generated segment to the base video."""
+    if not generation_result.get("success"):
+        raise RuntimeError(generation_result.get("error") or "Video generation failed.")
+
+    generated_videos = generation_result.get("videos") or []
+    if not generated_videos:
+        raise RuntimeError("Video extension generation returned no results.")
+
+    extension_video = generated_videos[0]
+    extension_reference = extension_video.get("local_path") or extension_video.get("filename")
+    if not extension_reference:
+        raise RuntimeError("Generated video lacks a valid local reference.")
+
+    try:
+        extension_video_path = resolve_local_media_path(extension_reference)
+    except ValueError as exc:
+        raise RuntimeError(f"Invalid extension video reference: {exc}") from exc
+
+    update_current_job(stage='combining')
+    try:
+        combined_video = run_in_bulkhead(
+            'media',
+            combine_videos_with_extension,
+            base_video_path,
+            extension_video_path,
+            base_metadata=video_info or {},
+            new_metadata=extension_video,
+        )
+    except DeadlineExceeded:
+        raise
+    except Exception as exc:
+        raise RuntimeError(f"Unable to combine videos: {exc}") from exc
+
+    return {
+        "success": True,
+        "frame_image": last_frame_info,
+        "generated_video": extension_video,
+        "combined_video": combined_video,
+        "prompt_id": generation_result.get("prompt_id"),
+    }
+
+
+def resume_video_extend_job(job):
+    """Resume a video extension after a restart: wait for the segment and append it."""
+    kwargs = (job.params or {}).get("kwargs") or {}
+    base_video_path = kwargs.get("base_video_path")
+    if not base_video_path or not os.path.exists(base_video_path):
+        raise RuntimeError("Base video for the extension is no longer available.")
+
+    update_current_job(stage='extracting_frame')
+    try:
+        last_frame_info = run_in_bulkhead('media', extract_last_frame, base_video_path)
+    except DeadlineExceeded:
+        raise
+    except Exception as exc:
+        raise RuntimeError(f"Unable to extract the last frame: {exc}") from exc
+
+    try:
+        with backend_scope('video', job.backend_url, job.prompt_id):
+            generation_result = _collect_generated_videos(get_comfy_client_id(), job.prompt_id, job.target_nodes)
+    except (ComfyExecutionError, BackendUnavailableError, DeadlineExceeded, JobCancelled):
+        raise
+    except Exception as exc:
+        raise RuntimeError(f"Unable to generate extension video: {exc}") from exc
+
+    return _combine_video_extension(base_video_path, kwargs.get("video_info"), last_frame_info, generation_result)
+
+
+register_job_kind('video', generate_video_from_image, resume_video_job)
+register_job_kind('video_extend', extend_video, resume_video_extend_job)
@@ -8,21 +8,30 @@ import uuid
 import requests
 import traceback
 import mimetypes
-from flask import Blueprint, request, jsonify, send_file, Response
+from flask import Blueprint, request, jsonify, send_file, Response, session
 from werkzeug.utils import secure_filename
-from utils.comfy_config import get_comfy_url, update_comfy_endpoint, get_all_endpoints, build_comfy_headers
+from utils.comfy_config import update_comfy_endpoint, get_all_endpoints
+from utils.comfy_http import comfy_get, comfy_post
+from utils.comfy_health import BackendUnavailableError
+from utils.comfy_pool import get_backend_name, resolve_backend_name, get_pool_status
+from utils.comfy_capabilities import get_capabilities
+from utils.jobs import get_job
+from utils.job_reaper import get_reaper_status
+from utils.admission import get_admission_status
+from utils.bulkheads import get_bulkhead_status
+from utils.comfy_scheduler import get_scheduler_status
+from utils.cost_model import estimate_job_eta, get_cost_model_status
+from utils.keep_warm import get_keep_warm_status
+from utils.warmup import get_warmup_status
 from utils.media import resolve_local_media_path, upload_image_data_url_to_comfy, upload_image_bytes_to_comfy
 from utils.google_drive import get_authorization_url, exchange_code_for_credentials, get_drive_service, upload_file_to_drive
 from auth import api_login_required
 from urllib.parse import urlparse
-from config import SCRIPT_DIR, GOOGLE_CLIENT_ID, GOOGLE_CLIENT_SECRET, OPENAI_API_KEY, OPENAI_API_BASE, OPENAI_MODEL, PREFERRED_URL_SCHEME
+from config import SCRIPT_DIR, GOOGLE_CLIENT_ID, GOOGLE_CLIENT_SECRET, OPENAI_API_KEY, OPENAI_API_BASE, OPENAI_MODEL, PREFERRED_URL_SCHEME, COMFY_HTTP_CONNECT_TIMEOUT, DRIVE_DOWNLOAD_TIMEOUT
 
 # Cache de tags removido en favor de SQLite
 # from utils.db import get_tags_by_category
 
-# Almacenar estados de generación
-generation_status = {}
-
 def create_api_blueprint(app):
     """Crear blueprint de API general"""
     api_bp = Blueprint('api', __name__)
@@ -48,12 +57,11 @@ def create_api_blueprint(app):
             upload_name = f"user_upload_{uuid.uuid4().hex}{extension}"
             mime_type = image_file.mimetype or 'image/png'
 
-            comfy_url = get_comfy_url('generate')
-            upload_response = requests.post(
-                f"{comfy_url}/upload/image",
+            upload_response = comfy_post(
+                "/upload/image",
+                mode='generate',
                 data={'type': 'input', 'overwrite': 'true'},
-                files={'image': (upload_name, file_data, mime_type)},
-                headers=build_comfy_headers()
+                files={'image': (upload_name, file_data, mime_type)}
             )
 
             if upload_response.status_code != 200:
@@ -68,9 +76,12 @@ def create_api_blueprint(app):
                     "filename": upload_name,
                     "subfolder": "input",
                     "type": "input",
-                    "original_name": original_name
+                    "original_name": original_name,
+                    "backend": get_backend_name('generate')
                 }
             })
+        except BackendUnavailableError as e:
+            return jsonify({"success": False, "error": str(e), "error_details": e.to_dict()}), 503, {"Retry-After": str(e.retry_after_seconds())}
         except Exception as e:
             return jsonify({"success": False, "error": str(e)}), 500
 
@@ -119,9 +130,12 @@ def create_api_blueprint(app):
                     "filename": upload_name,
                     "subfolder": image_type,
                     "type": image_type,
-                    "original_name": filename
+                    "original_name": filename,
+                    "backend": get_backend_name(mode)
                 }
             })
+        except BackendUnavailableError as e:
+            return jsonify({"success": False, "error": str(e), "error_details": e.to_dict()}), 503, {"Retry-After": str(e.retry_after_seconds())}
         except Exception as e:
             return jsonify({"success": False, "error": str(e)}), 500
 
@@ -199,6 +213,57 @@ def create_api_blueprint(app):
             "updated": updated_endpoints
         })
 
+    @api_bp.route('/api/backends')
+    @api_login_required(app)
+    def api_backends():
+        """Load and availability of every ComfyUI backend by mode."""
+        return jsonify({"success": True, "backends": get_pool_status()})
+
+    @api_bp.route('/api/admission')
+    @api_login_required(app)
+    def api_admission():
+        """Admission limits and current occupancy by mode"""
+        return jsonify({"success": True, "admission": get_admission_status()})
+
+    @api_bp.route('/api/bulkheads')
+    @api_login_required(app)
+    def api_bulkheads():
+        """Size, occupancy and saturation of every worker pool"""
+        return jsonify({"success": True, "bulkheads": get_bulkhead_status()})
+
+    @api_bp.route('/api/scheduler')
+    @api_login_required(app)
+    def api_scheduler():
+        """Window of every backend and prompts held back by user and priority"""
+        return jsonify({"success": True, "scheduler": get_scheduler_status()})
+
+    @api_bp.route('/api/cost-model')
+    @api_login_required(app)
+    def api_cost_model():
+        """Duration history and cost model fit by backend and workflow"""
+        return jsonify({"success": True, "cost_model": get_cost_model_status()})
+
+    @api_bp.route('/api/keep-warm')
+    @api_login_required(app)
+    def api_keep_warm():
+        """Serverless backends kept warm, their cost in hours and cold starts"""
+        return jsonify({"success": True, "keep_warm": get_keep_warm_status()})
+
+    @api_bp.route('/api/warmup')
+    @api_login_required(app)
+    def api_warmup():
+        """Last model warm-up of every backend and how long each workflow took"""
+        return jsonify({"success": True, "warmup": get_warmup_status()})
+
+    @api_bp.route('/api/capabilities')
+    @api_login_required(app)
+    def api_capabilities():
+        """Nodes and models of every backend and the workflows each one can run."""
+        try:
+            return jsonify({"success": True, **get_capabilities()})
+        except Exception as e:
+            return jsonify({"success": False, "error": str(e)}), 500
+
     @api_bp.route('/api/image/<filename>')
     @api_login_required(app)
     def serve_image(filename):
@@ -236,15 +301,12 @@ def create_api_blueprint(app):
                 if format_param:
                     params["format"] = format_param
 
+                # Pool backend holding the file (by name, never a URL from the client)
+                backend_url = resolve_backend_name(request.args.get('backend'))
+
                 print(f"[MEDIA] Proxying request to /view with params: {params}")
 
-                comfy_url = get_comfy_url('generate')
-                response = requests.get(
-                    f"{comfy_url}/view",
-                    params=params,
-                    headers=build_comfy_headers(),
-                    stream=True
-                )
+                response = comfy_get("/view", mode='generate', base_url=backend_url, params=params, stream=True)
                 if response.status_code == 200:
                     return Response(
                         response.iter_content(chunk_size=8192),
@@ -254,6 +316,8 @@ def create_api_blueprint(app):
                 else:
                     print(f"Error getting image from ComfyUI: HTTP {response.status_code} for {filename}")
                     return jsonify({"error": f"Image not found: {filename} (HTTP {response.status_code})"}), 404
+            except BackendUnavailableError as e:
+                return jsonify({"error": str(e)}), 503, {"Retry-After": str(e.retry_after_seconds())}
             except Exception as e:
                 print(f"Error getting image from ComfyUI: {e}")
                 traceback.print_exc()
@@ -265,10 +329,40 @@ def create_api_blueprint(app):
     @api_bp.route('/api/status/<prompt_id>')
     @api_login_required(app)
     def get_status(prompt_id):
-        """Obtener estado de una generación"""
-        if prompt_id in generation_status:
-            return jsonify(generation_status[prompt_id])
-        return jsonify({"error": "Prompt ID not found"}), 404
+        """Status of a generation (by job_id or prompt_id)"""
+        job = get_job(prompt_id)
+        # Another user's job is reported as missing so its params and media are not exposed
+        if job is None or (job.user and job.user != session.get('user_email')):
+            return jsonify({"error": "Prompt ID not found"}), 404
+        # ETA estimated from the measured durations (None without history)
+        return jsonify({"success": True, **job.to_dict(), "eta": estimate_job_eta(job)})
+
+    @api_bp.route('/api/jobs/heartbeat', methods=['POST'])
+    @api_login_required(app)
+    def jobs_heartbeat():
+        """Keep alive the jobs the client is still waiting for (job_ids or job_id)"""
+        data = request.get_json(silent=True) or {}
+        job_ids = data.get('job_ids') or ([data['job_id']] if data.get('job_id') else [])
+        if not isinstance(job_ids, list) or not job_ids:
+            return jsonify({"success": False, "error": "job_ids is required"}), 400
+
+        user = session.get('user_email')
+        jobs = {}
+        for job_id in job_ids[:50]:
+            job = get_job(str(job_id))
+            if job is None or (job.user and job.user != user):
+                jobs[str(job_id)] = None
+                continue
+            job.heartbeat()
+            # The state lets the client stop sending heartbeats for finished jobs
+            jobs[job.id] = job.state
+        return jsonify({"success": True, "jobs": jobs})
+
+    @api_bp.route('/api/jobs/reaper')
+    @api_login_required(app)
+    def jobs_reaper():
+        """Abandoned jobs cancelled and GPU time reclaimed"""
+        return jsonify({"success": True, "reaper": get_reaper_status()})
 
     @api_bp.route('/api/convert-to-natural-language', methods=['POST'])
     @api_login_required(app)
@@ -631,7 +725,7 @@ def create_api_blueprint(app):
                     }), 400
             else:
                 # Si es una URL normal, descargarla
-                response = requests.get(file_url, stream=True)
+                response = requests.get(file_url, stream=True, timeout=(COMFY_HTTP_CONNECT_TIMEOUT, DRIVE_DOWNLOAD_TIMEOUT))
                 if response.status_code != 200:
                     return jsonify({
                         "success": False,
@@ -671,6 +765,11 @@ def create_api_blueprint(app):
                     "error": result.get('error', 'Unknown error')
                 }), 500
                 
+        except requests.exceptions.Timeout as e:
+            return jsonify({
+                "success": False,
+                "error": f"Timed out downloading the file: {str(e)}"
+            }), 504
         except Exception as e:
             traceback.print_exc()
             return jsonify({
@@ -1,10 +1,16 @@
 """
 Routes for image generation
 """
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, session
 from domains.generate import generate_images
+from domains.edit import generate_image_edit
 from auth import api_login_required
-from utils.comfy import interrupt_comfy_execution
+from utils.comfy import cancel_generation, ComfyExecutionError, WorkflowValidationError, BackendUnavailableError, DeadlineExceeded
+from utils.jobs import submit_job, wants_async, wants_heartbeat, job_accepted_payload, get_job, JobCancelled
+from utils.deadlines import deadline_scope, resolve_deadline_budget, get_deadline_hint
+from utils.admission import admit_request, AdmissionRejected
+from utils.bulkheads import run_in_bulkhead
+from utils.comfy_scheduler import dispatch_scope, resolve_priority
 
 def create_generate_blueprint(app):
     """Crear blueprint de generación de imágenes"""
@@ -56,13 +62,18 @@ def create_generate_blueprint(app):
             if mode == 'generate':
                 if model not in ('lumina', 'chroma', 'qwen'):
                     return jsonify({"success": False, "error": "Invalid model. Must be 'lumina', 'chroma' or 'qwen'"}), 400
-                result = generate_images(prompt, width=width, height=height, steps=steps, seed=seed, model=model)
+                job_func = generate_images
+                job_args = (prompt,)
+                # no_cache forces a new run even when an identical result exists
+                use_cache = not bool(data.get('no_cache'))
+                job_kwargs = dict(width=width, height=height, steps=steps, seed=seed, model=model, use_cache=use_cache)
             else:
-                from domains.edit import generate_image_edit
                 source_image = data.get('image') or {}
                 if not source_image.get('filename'):
                     return jsonify({"success": False, "error": "No source image available for edit mode"}), 400
-                result = generate_image_edit(
+                job_func = generate_image_edit
+                job_args = ()
+                job_kwargs = dict(
                     positive_prompt=prompt,
                     source_image=source_image,
                     width=width,
@@ -70,20 +81,62 @@ def create_generate_blueprint(app):
                     steps=steps,
                     seed=seed
                 )
+
+            # Time budget of the mode; the client may shorten it with "timeout"
+            budget = resolve_deadline_budget(mode, get_deadline_hint(data, request.args))
+            # Priority class for the fair share of the backends ('interactive' or 'batch')
+            priority = resolve_priority(data.get('priority'), mode)
+            # Reject with 429 when the mode already has every slot and its queue taken; from here on the
+            # ticket is owned by the job (async) or released by the with block (sync)
+            ticket = admit_request(mode)
+
+            if wants_async(data, request.args):
+                job = submit_job(mode, job_func, *job_args, mode=mode, user=session.get('user_email'), deadline=budget,
+                                 heartbeat=wants_heartbeat(data, request.args), admission=ticket, priority=priority,
+                                 **job_kwargs)
+                return jsonify(job_accepted_payload(job)), 202
+
+            # Synchronous requests also run on the worker pool of their mode
+            with deadline_scope(budget), dispatch_scope(session.get('user_email'), priority), ticket:
+                result = run_in_bulkhead(mode, job_func, *job_args, **job_kwargs)
             
             return jsonify(result)
+        except ComfyExecutionError as e:
+            return jsonify({"success": False, "error": str(e), "error_details": e.to_dict()}), 502
+        except WorkflowValidationError as e:
+            return jsonify({"success": False, "error": str(e), "error_details": e.to_dict()}), 422
+        except BackendUnavailableError as e:
+            return jsonify({"success": False, "error": str(e), "error_details": e.to_dict()}), 503, {"Retry-After": str(e.retry_after_seconds())}
+        except DeadlineExceeded as e:
+            return jsonify({"success": False, "error": str(e), "error_details": e.to_dict()}), 504
+        except JobCancelled as e:
+            return jsonify({"success": False, "error": str(e), "error_details": e.to_dict()}), 409
+        except AdmissionRejected as e:
+            return jsonify({"success": False, "error": str(e), "error_details": e.to_dict()}), 429, {"Retry-After": str(e.retry_after_seconds())}
         except Exception as e:
             return jsonify({"success": False, "error": str(e)}), 500
 
     @generate_bp.route('/api/generate/stop', methods=['POST'])
     @api_login_required(app)
     def api_generate_stop():
-        """Detener la generación actual en ComfyUI."""
+        """Cancel one generation (by job_id or prompt_id) without affecting the others."""
         try:
             data = request.get_json(silent=True) or {}
+            target_id = (data.get('job_id') or data.get('prompt_id') or '').strip()
+            if not target_id:
+                return jsonify({"success": False, "error": "job_id or prompt_id is required"}), 400
             mode = (data.get('mode') or 'generate').strip().lower()
-            interrupt_comfy_execution(mode if mode in ('generate', 'edit') else 'generate')
-            return jsonify({"success": True})
+            if mode not in ('generate', 'edit', 'video'):
+                mode = 'generate'
+
+            job = get_job(target_id)
+            if job is not None and job.user and job.user != session.get('user_email'):
+                return jsonify({"success": False, "error": "This generation belongs to another user"}), 403
+
+            result = cancel_generation(target_id, mode=mode)
+            if result is None:
+                return jsonify({"success": False, "error": "Job or prompt not found"}), 404
+            return jsonify({"success": True, **result})
         except Exception as e:
             return jsonify({"success": False, "error": str(e)}), 500
 
@@ -4,9 +4,16 @@ Routes for video generation
 from flask import Blueprint, request, jsonify, render_template, session
 from domains.video import generate_video_from_image
 from domains.video import generate_video_from_image as generate_video
-from utils.video_utils import extract_last_frame, combine_videos_with_extension, get_video_resolution
+from domains.video import extend_video
+from utils.video_utils import get_video_resolution
 from utils.media import resolve_local_media_path, upload_image_data_url_to_comfy
 from auth import login_required, api_login_required
+from utils.comfy import ComfyExecutionError, WorkflowValidationError, BackendUnavailableError, DeadlineExceeded
+from utils.deadlines import deadline_scope, resolve_deadline_budget, get_deadline_hint
+from utils.admission import admit_request, AdmissionRejected
+from utils.bulkheads import run_in_bulkhead
+from utils.comfy_scheduler import dispatch_scope, resolve_priority
+from utils.jobs import submit_job, wants_async, wants_heartbeat, job_accepted_payload, JobCancelled
 
 def create_video_blueprint(app):
     """Crear blueprint de generación de video"""
@@ -86,7 +93,7 @@ def create_video_blueprint(app):
                 except (TypeError, ValueError):
                     return jsonify({"success": False, "error": "Invalid height"}), 400
 
-            result = generate_video(
+            video_kwargs = dict(
                 positive_prompt=prompt,
                 source_image=image_info,
                 width=width,
@@ -98,7 +105,37 @@ def create_video_blueprint(app):
                 no_sound=no_sound
             )
 
+            budget = resolve_deadline_budget('video', get_deadline_hint(data, request.args))
+            priority = resolve_priority(data.get('priority'), 'video')
+            ticket = admit_request('video')
+
+            if wants_async(data, request.args):
+                job = submit_job('video', generate_video, mode='video', user=session.get('user_email'), deadline=budget,
+                                 heartbeat=wants_heartbeat(data, request.args), admission=ticket, priority=priority,
+                                 **video_kwargs)
+                return jsonify(job_accepted_payload(job)), 202
+
+            with deadline_scope(budget), dispatch_scope(session.get('user_email'), priority), ticket:
+                result = run_in_bulkhead('video', generate_video, **video_kwargs)
+
             return jsonify(result)
+        except ComfyExecutionError as e:
+            print(f"[ERROR] ComfyUI execution failed in api_generate_video: {e}")
+            return jsonify({"success": False, "error": str(e), "error_details": e.to_dict()}), 502
+        except WorkflowValidationError as e:
+            print(f"[ERROR] Workflow rejected in api_generate_video: {e}")
+            return jsonify({"success": False, "error": str(e), "error_details": e.to_dict()}), 422
+        except BackendUnavailableError as e:
+            print(f"[ERROR] Video backend unavailable in api_generate_video: {e}")
+            return jsonify({"success": False, "error": str(e), "error_details": e.to_dict()}), 503, {"Retry-After": str(e.retry_after_seconds())}
+        except DeadlineExceeded as e:
+            print(f"[ERROR] Deadline exceeded in api_generate_video: {e}")
+            return jsonify({"success": False, "error": str(e), "error_details": e.to_dict()}), 504
+        except JobCancelled as e:
+            return jsonify({"success": False, "error": str(e), "error_details": e.to_dict()}), 409
+        except AdmissionRejected as e:
+            print(f"[ERROR] Video admission rejected in api_generate_video: {e}")
+            return jsonify({"success": False, "error": str(e), "error_details": e.to_dict()}), 429, {"Retry-After": str(e.retry_after_seconds())}
         except ValueError as e:
             import traceback
             print(f"[ERROR] ValueError in api_generate_video: {e}")
@@ -140,7 +177,7 @@ def create_video_blueprint(app):
         height = data.get('height')
         if width is None or height is None:
             try:
-                width, height = get_video_resolution(base_video_path)
+                width, height = run_in_bulkhead('media', get_video_resolution, base_video_path)
             except Exception as exc:
                 return jsonify({"success": False, "error": f"Unable to determine base video resolution: {exc}"}), 400
         else:
@@ -155,66 +192,52 @@ def create_video_blueprint(app):
         fps = data.get('fps')
         nsfw = data.get('nsfw', False)
 
-        try:
-            last_frame_info = extract_last_frame(base_video_path)
-        except Exception as exc:
-            return jsonify({"success": False, "error": f"Unable to extract the last frame: {exc}"}), 500
-
-        frame_source_image = {
-            "filename": last_frame_info["filename"],
-            "local_path": last_frame_info["local_path"],
-            "type": "local",
-            "mime_type": last_frame_info.get("mime_type"),
-        }
+        extend_kwargs = dict(
+            positive_prompt=prompt,
+            base_video_path=base_video_path,
+            video_info=video_info,
+            width=width,
+            height=height,
+            negative_prompt=negative_prompt,
+            length=length,
+            fps=fps,
+            nsfw=nsfw
+        )
 
+        budget = resolve_deadline_budget('video', get_deadline_hint(data, request.args))
+        priority = resolve_priority(data.get('priority'), 'video')
         try:
-            generation_result = generate_video(
-                positive_prompt=prompt,
-                source_image=frame_source_image,
-                width=width,
-                height=height,
-                negative_prompt=negative_prompt,
-                length=length,
-                fps=fps,
-                nsfw=nsfw
-            )
-        except Exception as exc:
-            return jsonify({"success": False, "error": f"Unable to generate extension video: {exc}"}), 500
-
-        if not generation_result.get("success"):
-            return jsonify({"success": False, "error": generation_result.get("error") or "Video generation failed."}), 500
-
-        generated_videos = generation_result.get("videos") or []
-        if not generated_videos:
-            return jsonify({"success": False, "error": "Video extension generation returned no results."}), 500
+            ticket = admit_request('video')
+        except AdmissionRejected as exc:
+            return jsonify({"success": False, "error": str(exc), "error_details": exc.to_dict()}), 429, {"Retry-After": str(exc.retry_after_seconds())}
 
-        extension_video = generated_videos[0]
-        extension_reference = extension_video.get("local_path") or extension_video.get("filename")
-        if not extension_reference:
-            return jsonify({"success": False, "error": "Generated video lacks a valid local reference."}), 500
+        if wants_async(data, request.args):
+            job = submit_job('video_extend', extend_video, mode='video', user=session.get('user_email'), deadline=budget,
+                             heartbeat=wants_heartbeat(data, request.args), admission=ticket, priority=priority,
+                             **extend_kwargs)
+            return jsonify(job_accepted_payload(job)), 202
 
         try:
-            extension_video_path = resolve_local_media_path(extension_reference)
-        except ValueError as exc:
-            return jsonify({"success": False, "error": f"Invalid extension video reference: {exc}"}), 500
-
-        try:
-            combined_video = combine_videos_with_extension(
-                base_video_path,
-                extension_video_path,
-                base_metadata=video_info,
-                new_metadata=extension_video,
-            )
+            with deadline_scope(budget), dispatch_scope(session.get('user_email'), priority), ticket:
+                result = run_in_bulkhead('video', extend_video, **extend_kwargs)
+        except ComfyExecutionError as exc:
+            return jsonify({
+                "success": False,
+                "error": f"Unable to generate extension video: {exc}",
+                "error_details": exc.to_dict()
+            }), 502
+        except WorkflowValidationError as exc:
+            return jsonify({"success": False, "error": str(exc), "error_details": exc.to_dict()}), 422
+        except BackendUnavailableError as exc:
+            return jsonify({"success": False, "error": str(exc), "error_details": exc.to_dict()}), 503, {"Retry-After": str(exc.retry_after_seconds())}
+        except DeadlineExceeded as exc:
+            return jsonify({"success": False, "error": str(exc), "error_details": exc.to_dict()}), 504
+        except JobCancelled as exc:
+            return jsonify({"success": False, "error": str(exc), "error_details": exc.to_dict()}), 409
         except Exception as exc:
-            return jsonify({"success": False, "error": f"Unable to combine videos: {exc}"}), 500
-
-        return jsonify({
-            "success": True,
-            "frame_image": last_frame_info,
-            "generated_video": extension_video,
-            "combined_video": combined_video,
-            "prompt_id": generation_result.get("prompt_id"),
-        })
+            return jsonify({"success": False, "error": str(exc)}), 500
+
+        return jsonify(result)
 
     return video_bp
 
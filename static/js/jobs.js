@@ -0,0 +1,95 @@
+// Shared client for the asynchronous job API (/api/status/<job_id>)
+const JobClient = (() => {
+    const TERMINAL_STATES = ['completed', 'failed', 'cancelled'];
+
+    function sleep(ms, signal) {
+        return new Promise((resolve, reject) => {
+            if (signal && signal.aborted) {
+                reject(new DOMException('Aborted', 'AbortError'));
+                return;
+            }
+            const timer = setTimeout(resolve, ms);
+            if (signal) {
+                signal.addEventListener('abort', () => {
+                    clearTimeout(timer);
+                    reject(new DOMException('Aborted', 'AbortError'));
+                }, { once: true });
+            }
+        });
+    }
+
+    async function waitForJob(jobId, { signal, onUpdate, pollInterval = 1000 } = {}) {
+        while (true) {
+            const response = await fetch(`/api/status/${encodeURIComponent(jobId)}`, { signal });
+            const job = await response.json();
+            if (!response.ok) {
+                throw new Error(job.error || `Unable to read job status (HTTP ${response.status})`);
+            }
+            if (onUpdate) {
+                onUpdate(job);
+            }
+            if (TERMINAL_STATES.includes(job.state)) {
+                return job;
+            }
+            await sleep(pollInterval, signal);
+        }
+    }
+
+    // Send heartbeats for a job until stop() is called. When they stop (tab closed,
+    // request aborted) the server cancels the job after its grace period.
+    function startHeartbeat(jobId, { url, interval }) {
+        if (!url || !interval) {
+            return () => {};
+        }
+        const timer = setInterval(() => {
+            fetch(url, {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ job_ids: [jobId] })
+            }).catch(() => {});
+        }, interval * 1000);
+        return () => clearInterval(timer);
+    }
+
+    // Submit a payload to an endpoint as a job and resolve with the job's result payload.
+    // Returns { ok, data, job } where data has the same shape as the synchronous response.
+    async function run(url, payload, { signal, onJobId, onUpdate, pollInterval } = {}) {
+        const response = await fetch(url, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            signal,
+            body: JSON.stringify({ ...payload, async: true, heartbeat: true })
+        });
+        const data = await response.json();
+        if (response.status !== 202 || !data.job_id) {
+            return { ok: response.ok, data, job: null };
+        }
+
+        if (onJobId) {
+            onJobId(data.job_id);
+        }
+        const stopHeartbeat = startHeartbeat(data.job_id, {
+            url: data.heartbeat_url,
+            interval: data.heartbeat_interval
+        });
+        let job;
+        try {
+            job = await waitForJob(data.job_id, { signal, onUpdate, pollInterval });
+        } finally {
+            stopHeartbeat();
+        }
+        if (job.state === 'completed') {
+            return { ok: true, data: job.result || { success: true }, job };
+        }
+        const error = job.state === 'cancelled'
+            ? (job.error || 'Job cancelled.')
+            : (job.error || 'Job failed.');
+        return {
+            ok: false,
+            data: { ...(job.result || {}), success: false, error, error_details: job.error_details },
+            job
+        };
+    }
+
+    return { run, waitForJob };
+})();
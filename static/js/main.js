@@ -59,7 +59,11 @@ createApp({
             driveAuthenticated: false,
             isUploadingToDrive: false,
             generationAbortController: null,
-            isStoppingGeneration: false
+            currentJobId: null,
+            isStoppingGeneration: false,
+            workflowAvailability: {},
+            modeAvailability: {},
+            capabilitiesTimer: null
         };
     },
     computed: {
@@ -151,6 +155,9 @@ createApp({
 
         this.fetchComfyEndpoint();
         this.checkDriveStatus();
+        // Capacidades de los backends: deshabilitar modos que ningún backend sano puede ejecutar
+        this.fetchCapabilities();
+        this.capabilitiesTimer = setInterval(() => this.fetchCapabilities(), 30000);
 
         // Verificar si viene de autorización exitosa de Drive
         const urlParams = new URLSearchParams(window.location.search);
@@ -654,32 +661,32 @@ createApp({
                         if (lastImage.prompt_id) {
                             lastImagePayload.prompt_id = lastImage.prompt_id;
                         }
+                        if (lastImage.backend) {
+                            lastImagePayload.backend = lastImage.backend;
+                        }
                     }
                 }
 
                 // Obtener la resolución seleccionada
                 const [width, height] = this.selectedResolution.split('x').map(Number);
 
-                const response = await fetch('/api/generate', {
-                    method: 'POST',
-                    headers: {
-                        'Content-Type': 'application/json',
-                    },
+                // Submit as an async job and wait for its result through /api/status
+                const { data } = await JobClient.run('/api/generate', {
+                    prompt: promptToUse,
+                    width: width,
+                    height: height,
+                    steps: steps,
+                    seed: seedToUse,
+                    mode: this.generationMode,
+                    model: this.generationMode === 'generate' ? this.selectedModel : null,
+                    image: lastImagePayload
+                }, {
                     signal: abortController.signal,
-                    body: JSON.stringify({
-                        prompt: promptToUse,
-                        width: width,
-                        height: height,
-                        steps: steps,
-                        seed: seedToUse,
-                        mode: this.generationMode,
-                        model: this.generationMode === 'generate' ? this.selectedModel : null,
-                        image: lastImagePayload
-                    })
+                    onJobId: (jobId) => {
+                        this.currentJobId = jobId;
+                    }
                 });
 
-                const data = await response.json();
-
                 // Actualizar el mensaje con la respuesta
                 const messageIndex = this.chatMessages.findIndex(m => m.id === messageId);
                 if (messageIndex !== -1) {
@@ -711,6 +718,7 @@ createApp({
             } finally {
                 if (this.generationAbortController === abortController) {
                     this.generationAbortController = null;
+                    this.currentJobId = null;
                 }
                 const wasAborted = abortController.signal.aborted;
                 this.isGenerating = false;
@@ -727,18 +735,25 @@ createApp({
                 return;
             }
             this.isStoppingGeneration = true;
+            // Cancelar solo este job: capturar el id antes de abortar (el finally lo limpia)
+            const jobId = this.currentJobId;
 
             if (this.generationAbortController) {
                 this.generationAbortController.abort();
             }
 
+            if (!jobId) {
+                this.isStoppingGeneration = false;
+                return;
+            }
+
             try {
                 await fetch('/api/generate/stop', {
                     method: 'POST',
                     headers: {
                         'Content-Type': 'application/json',
                     },
-                    body: JSON.stringify({ mode: this.generationMode })
+                    body: JSON.stringify({ job_id: jobId, mode: this.generationMode })
                 });
             } catch (error) {
                 console.error('Error sending stop request:', error);
@@ -922,7 +937,8 @@ createApp({
             }
             const subfolder = media.subfolder || '';
             const type = media.type || 'output';
-            return `/api/image/${media.filename}?subfolder=${subfolder}&type=${type}`;
+            const backend = media.backend ? `&backend=${encodeURIComponent(media.backend)}` : '';
+            return `/api/image/${media.filename}?subfolder=${subfolder}&type=${type}${backend}`;
         },
 
         getImageUrl(image) {
@@ -1112,6 +1128,32 @@ createApp({
             this.modalImage = null;
         },
 
+        async fetchCapabilities() {
+            try {
+                const response = await fetch('/api/capabilities');
+                const data = await response.json();
+                if (data.success) {
+                    const availability = {};
+                    Object.entries(data.workflows || {}).forEach(([name, info]) => {
+                        availability[name] = info.available;
+                    });
+                    this.workflowAvailability = availability;
+                    this.modeAvailability = data.modes || {};
+                }
+            } catch (error) {
+                console.error('Error checking backend capabilities:', error);
+            }
+        },
+
+        // Un workflow sin información se considera disponible
+        isWorkflowAvailable(name) {
+            return this.workflowAvailability[name] !== false;
+        },
+
+        isModeAvailable(mode) {
+            return this.modeAvailability[mode] !== false;
+        },
+
         async checkDriveStatus() {
             try {
                 const response = await fetch('/api/drive/status');
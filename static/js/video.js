@@ -83,6 +83,7 @@ createApp({
             lastVideoPrompt: sessionPrompt !== null ? sessionPrompt : (initial.prompt || ''),
             selectedOrientation: initialOrientation,
             isGeneratingVideo: false,
+            currentVideoJobId: null,
             isExtendingVideo: false,
             extendingVideoId: null,
             videoResults: [],
@@ -90,6 +91,9 @@ createApp({
             previewMode: 'image',
             enableNSFW: false,
             enableNoSound: false,
+            workflowAvailability: {},
+            modeAvailability: {},
+            capabilitiesTimer: null,
             showSettingsModal: false,
             settingsEndpoints: {
                 generate: '',
@@ -125,7 +129,8 @@ createApp({
             }
             const subfolder = this.videoSourceImage.subfolder || '';
             const type = this.videoSourceImage.type || 'output';
-            return `/api/image/${this.videoSourceImage.filename}?subfolder=${subfolder}&type=${type}`;
+            const backend = this.videoSourceImage.backend ? `&backend=${encodeURIComponent(this.videoSourceImage.backend)}` : '';
+            return `/api/image/${this.videoSourceImage.filename}?subfolder=${subfolder}&type=${type}${backend}`;
         },
         videoResolutionOptions() {
             return VIDEO_PRESET_ORDER.map((key) => ({
@@ -181,6 +186,9 @@ createApp({
 
         this.fetchComfyEndpoint();
         this.checkDriveStatus();
+        // Capacidades de los backends: deshabilitar modos que ningún backend sano puede ejecutar
+        this.fetchCapabilities();
+        this.capabilitiesTimer = setInterval(() => this.fetchCapabilities(), 30000);
     },
     methods: {
         openSettings() {
@@ -287,9 +295,38 @@ createApp({
             if (media.format) {
                 params.append('format', media.format);
             }
+            if (media.backend) {
+                params.append('backend', media.backend);
+            }
             return `/api/image/${media.filename}?${params.toString()}`;
         },
         
+        async fetchCapabilities() {
+            try {
+                const response = await fetch('/api/capabilities');
+                const data = await response.json();
+                if (data.success) {
+                    const availability = {};
+                    Object.entries(data.workflows || {}).forEach(([name, info]) => {
+                        availability[name] = info.available;
+                    });
+                    this.workflowAvailability = availability;
+                    this.modeAvailability = data.modes || {};
+                }
+            } catch (error) {
+                console.error('Error checking backend capabilities:', error);
+            }
+        },
+
+        // Un workflow sin información se considera disponible
+        isWorkflowAvailable(name) {
+            return this.workflowAvailability[name] !== false;
+        },
+
+        isModeAvailable(mode) {
+            return this.modeAvailability[mode] !== false;
+        },
+
         async checkDriveStatus() {
             try {
                 const response = await fetch('/api/drive/status');
@@ -416,7 +453,8 @@ createApp({
                             this.videoSourceImage = {
                                 filename: uploadData.image.filename,
                                 subfolder: uploadData.image.subfolder || '',
-                                type: uploadData.image.type || 'input'
+                                type: uploadData.image.type || 'input',
+                                backend: uploadData.image.backend || null
                             };
                         } else {
                             throw new Error(uploadData.error || 'Unable to upload source image.');
@@ -445,25 +483,25 @@ createApp({
                 if (this.videoSourceImage.prompt_id) {
                     imagePayload.prompt_id = this.videoSourceImage.prompt_id;
                 }
+                if (this.videoSourceImage.backend) {
+                    imagePayload.backend = this.videoSourceImage.backend;
+                }
 
-                const response = await fetch('/api/generate-video', {
-                    method: 'POST',
-                    headers: {
-                        'Content-Type': 'application/json'
+                const { ok, data } = await JobClient.run('/api/generate-video', {
+                    prompt,
+                    image: imagePayload,
+                    width,
+                    height,
+                    nsfw: this.enableNSFW,
+                    no_sound: this.enableNoSound
+                }, {
+                    onJobId: (jobId) => {
+                        this.currentVideoJobId = jobId;
                     },
-                    body: JSON.stringify({
-                        prompt,
-                        image: imagePayload,
-                        width,
-                        height,
-                        nsfw: this.enableNSFW,
-                        no_sound: this.enableNoSound
-                    })
+                    pollInterval: 2000
                 });
 
-                const data = await response.json();
-
-                if (!response.ok || !data.success) {
+                if (!ok || !data.success) {
                     throw new Error(data.error || 'Failed to generate video');
                 }
 
@@ -490,6 +528,7 @@ createApp({
                 this.videoError = error.message || 'Unexpected error generating video.';
             } finally {
                 this.isGeneratingVideo = false;
+                this.currentVideoJobId = null;
             }
         },
 
@@ -530,25 +569,23 @@ createApp({
             this.videoError = null;
 
             try {
-                const response = await fetch('/api/video/extend', {
-                    method: 'POST',
-                    headers: {
-                        'Content-Type': 'application/json'
+                const { ok, data } = await JobClient.run('/api/video/extend', {
+                    prompt,
+                    video: {
+                        filename: baseVideo.filename,
+                        subfolder: baseVideo.subfolder || '',
+                        type: baseVideo.type || 'output',
+                        local_path: baseVideo.local_path || '',
+                        prompt_id: baseVideo.prompt_id || ''
+                    }
+                }, {
+                    onJobId: (jobId) => {
+                        this.currentVideoJobId = jobId;
                     },
-                    body: JSON.stringify({
-                        prompt,
-                        video: {
-                            filename: baseVideo.filename,
-                            subfolder: baseVideo.subfolder || '',
-                            type: baseVideo.type || 'output',
-                            local_path: baseVideo.local_path || '',
-                            prompt_id: baseVideo.prompt_id || ''
-                        }
-                    })
+                    pollInterval: 2000
                 });
 
-                const data = await response.json();
-                if (!response.ok || !data.success) {
+                if (!ok || !data.success) {
                     throw new Error(data.error || 'Failed to extend the video');
                 }
 
@@ -577,6 +614,7 @@ createApp({
             } finally {
                 this.isExtendingVideo = false;
                 this.extendingVideoId = null;
+                this.currentVideoJobId = null;
             }
         },
         canExtendVideo(video) {
@@ -0,0 +1,87 @@
+"""
+Admission control: 429 decisions, Retry-After arithmetic and slot hand-over
+"""
+import pytest
+from utils.admission import AdmissionController, AdmissionRejected
+from utils.deadlines import deadline_scope, DeadlineExceeded
+
+
+def test_rejects_once_slots_and_queue_are_full():
+    controller = AdmissionController('generate', max_active=2, max_queued=1)
+    tickets = [controller.admit() for _ in range(3)]
+    with pytest.raises(AdmissionRejected) as rejected:
+        controller.admit()
+    assert rejected.value.to_dict()["status"] == 'overloaded'
+    assert (controller.admitted, controller.rejected) == (3, 1)
+    tickets[0].release()
+    controller.admit()
+
+
+def test_retry_after_drains_the_queue_through_the_slots():
+    controller = AdmissionController('generate', max_active=2, max_queued=2)
+    controller.average_duration = 10.0
+    for _ in range(4):
+        controller.admit()
+    # 4 waiting tickets + the rejected one, 2 slots, 10 s each
+    with pytest.raises(AdmissionRejected) as rejected:
+        controller.admit()
+    assert rejected.value.retry_after == pytest.approx(25.0)
+    assert rejected.value.retry_after_seconds() == 25
+
+
+def test_retry_after_is_at_least_one_second():
+    error = AdmissionRejected('edit', 0.2, 1, 0, 1, 0)
+    assert error.retry_after_seconds() == 1
+
+
+def test_forced_admission_ignores_the_limits():
+    controller = AdmissionController('video', max_active=1, max_queued=0)
+    controller.admit()
+    controller.admit(force=True)
+    assert controller.queued == 2
+
+
+def test_average_duration_is_smoothed_on_release(monkeypatch):
+    from utils import admission
+    now = [100.0]
+    monkeypatch.setattr(admission.time, 'time', lambda: now[0])
+    controller = AdmissionController('generate', max_active=1, max_queued=1)
+    for duration in (10.0, 20.0):
+        ticket = controller.admit()
+        ticket.acquire()
+        now[0] += duration
+        ticket.release()
+    assert controller.average_duration == pytest.approx(12.0)
+
+
+def test_async_tickets_get_free_slots_in_arrival_order():
+    controller = AdmissionController('generate', max_active=1, max_queued=5)
+    started = []
+    first, second, third = (controller.admit() for _ in range(3))
+    first.acquire_async(lambda: started.append('first'))
+    second.acquire_async(lambda: started.append('second'))
+    third.acquire_async(lambda: started.append('third'))
+    assert started == ['first']
+    # A ticket given up while waiting never gets its slot
+    second.release()
+    first.release()
+    assert started == ['first', 'third']
+    assert (controller.active, controller.queued) == (1, 0)
+
+
+def test_blocking_acquire_gives_up_its_place_when_the_deadline_expires():
+    controller = AdmissionController('generate', max_active=1, max_queued=1)
+    holder = controller.admit()
+    holder.acquire()
+    waiting = controller.admit()
+    with deadline_scope(0.05), pytest.raises(DeadlineExceeded):
+        waiting.acquire()
+    assert (controller.active, controller.queued) == (1, 0)
+
+
+def test_disabled_controller_never_waits():
+    controller = AdmissionController('generate')
+    started = []
+    for _ in range(3):
+        controller.admit().acquire_async(lambda: started.append(True))
+    assert len(started) == 3
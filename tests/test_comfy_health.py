@@ -0,0 +1,103 @@
+"""
+Circuit breaker state transitions
+"""
+import pytest
+from utils import comfy_health
+from utils.comfy_health import CircuitBreaker, BackendUnavailableError, CLOSED, OPEN, HALF_OPEN
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(comfy_health.time, 'time', fake)
+    return fake
+
+
+def test_opens_after_threshold_consecutive_failures(clock):
+    breaker = CircuitBreaker('http://b', failure_threshold=3, reset_timeout=30)
+    breaker.record_failure('boom')
+    breaker.record_failure('boom')
+    assert breaker.state == CLOSED
+    assert breaker.allow_request()
+    breaker.record_failure('boom')
+    assert breaker.state == OPEN
+    assert not breaker.allow_request()
+    assert not breaker.available()
+
+
+def test_success_resets_the_failure_count(clock):
+    breaker = CircuitBreaker('http://b', failure_threshold=2, reset_timeout=30)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == CLOSED
+
+
+def test_half_open_lets_a_single_trial_through(clock):
+    breaker = CircuitBreaker('http://b', failure_threshold=1, reset_timeout=30)
+    breaker.record_failure()
+    clock.now += 29
+    assert not breaker.allow_request()
+    assert breaker.retry_after() == pytest.approx(1)
+    clock.now += 1
+    assert breaker.available()
+    assert breaker.allow_request()
+    assert breaker.state == HALF_OPEN
+    # Only one trial at a time until it reports back or times out
+    assert not breaker.allow_request()
+    clock.now += 30
+    assert breaker.allow_request()
+
+
+def test_trial_success_closes_and_failure_reopens(clock):
+    breaker = CircuitBreaker('http://b', failure_threshold=1, reset_timeout=30)
+    breaker.record_failure()
+    clock.now += 30
+    breaker.allow_request()
+    breaker.record_failure('still down')
+    assert breaker.state == OPEN
+    assert breaker.opened_at == clock.now
+    clock.now += 30
+    breaker.allow_request()
+    breaker.record_success()
+    assert breaker.state == CLOSED
+    assert breaker.consecutive_failures == 0
+    assert breaker.retry_after() == 0.0
+
+
+def test_recovery_observer_is_told_when_the_circuit_closes(clock, monkeypatch):
+    recovered = []
+    monkeypatch.setattr(comfy_health, '_recovery_observer', recovered.append)
+    breaker = CircuitBreaker('http://b', failure_threshold=1, reset_timeout=30)
+    breaker.record_success()
+    assert recovered == []
+    breaker.record_failure()
+    breaker.record_success()
+    assert recovered == ['http://b']
+
+
+def test_disabled_breaker_never_blocks(clock):
+    breaker = CircuitBreaker('http://b', failure_threshold=0, reset_timeout=30)
+    for _ in range(10):
+        breaker.record_failure()
+    assert breaker.state == CLOSED
+    assert breaker.allow_request()
+
+
+def test_unavailable_error_rounds_retry_after_up(clock):
+    breaker = CircuitBreaker('http://b', failure_threshold=1, reset_timeout=30)
+    breaker.record_failure('refused')
+    clock.now += 28.5
+    error = breaker.unavailable_error(mode='generate')
+    assert isinstance(error, BackendUnavailableError)
+    assert error.retry_after_seconds() == 2
+    assert error.to_dict()["backend_url"] == 'http://b'
+    assert 'circuit open' in error.reason
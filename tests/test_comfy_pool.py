@@ -0,0 +1,80 @@
+"""
+Backend restart detection from /system_stats
+"""
+import pytest
+from utils import comfy_pool
+from utils.comfy_pool import BackendPool, BackendState
+
+
+def system_stats(torch_vram=0, version='0.3.40', argv=('main.py',)):
+    return {
+        "system": {"comfyui_version": version, "pytorch_version": '2.7', "argv": list(argv), "ram_total": 64e9},
+        "devices": [{"name": 'cuda:0', "vram_total": 24e9, "vram_free": 20e9, "torch_vram_total": torch_vram}],
+    }
+
+
+class FakeResponse:
+    def __init__(self, payload):
+        self.payload = payload
+        self.status_code = 200
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.payload
+
+
+@pytest.fixture
+def restarts(monkeypatch):
+    seen = []
+    monkeypatch.setattr(comfy_pool, '_restart_observer', seen.append)
+    return seen
+
+
+def probe_with(monkeypatch, pool, state, stats):
+    monkeypatch.setattr(comfy_pool, 'comfy_get', lambda *args, **kwargs: FakeResponse(stats))
+    assert pool.probe(state)
+
+
+def test_first_stats_are_not_a_restart(monkeypatch, restarts):
+    pool, state = BackendPool(), BackendState('http://b', 'generate', 'generate-0')
+    probe_with(monkeypatch, pool, state, system_stats(torch_vram=0))
+    assert restarts == []
+    assert state.restarts == 0
+
+
+def test_models_unloaded_is_a_restart(monkeypatch, restarts):
+    pool, state = BackendPool(), BackendState('http://b', 'generate', 'generate-0')
+    state.last_models = ('model.safetensors',)
+    probe_with(monkeypatch, pool, state, system_stats(torch_vram=8e9))
+    probe_with(monkeypatch, pool, state, system_stats(torch_vram=9e9))
+    assert restarts == []
+    probe_with(monkeypatch, pool, state, system_stats(torch_vram=0))
+    assert restarts == ['http://b']
+    assert state.restarts == 1
+    assert state.last_models is None
+
+
+def test_models_loading_is_not_a_restart(monkeypatch, restarts):
+    pool, state = BackendPool(), BackendState('http://b', 'generate', 'generate-0')
+    probe_with(monkeypatch, pool, state, system_stats(torch_vram=0))
+    probe_with(monkeypatch, pool, state, system_stats(torch_vram=8e9))
+    assert restarts == []
+
+
+def test_changed_setup_is_a_restart(monkeypatch, restarts):
+    pool, state = BackendPool(), BackendState('http://b', 'generate', 'generate-0')
+    probe_with(monkeypatch, pool, state, system_stats(version='0.3.40'))
+    probe_with(monkeypatch, pool, state, system_stats(version='0.3.41'))
+    assert restarts == ['http://b']
+
+
+def test_observer_errors_do_not_break_the_probe(monkeypatch):
+    def failing(url):
+        raise RuntimeError('boom')
+    monkeypatch.setattr(comfy_pool, '_restart_observer', failing)
+    pool, state = BackendPool(), BackendState('http://b', 'generate', 'generate-0')
+    probe_with(monkeypatch, pool, state, system_stats(torch_vram=8e9))
+    probe_with(monkeypatch, pool, state, system_stats(torch_vram=0))
+    assert state.reachable
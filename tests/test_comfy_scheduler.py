@@ -0,0 +1,159 @@
+"""
+Weighted fair queuing and shortest-expected-job-first dispatch
+"""
+import pytest
+from utils.comfy_scheduler import (
+    FairQueue, BackendScheduler, DispatchTicket, PRIORITY_INTERACTIVE, PRIORITY_BATCH, POLICY_SEJF,
+    resolve_priority,
+)
+from utils.deadlines import deadline_scope, DeadlineExceeded
+
+WEIGHTS = {PRIORITY_INTERACTIVE: 4.0, PRIORITY_BATCH: 1.0}
+
+
+def _hold(scheduler, name, user, priority=PRIORITY_INTERACTIVE, expected=None, waited=0.0):
+    """Queue a prompt behind a full window without blocking, as acquire() would."""
+    start, finish = scheduler._fair.tag(user, priority)
+    ticket = DispatchTicket(scheduler, user, priority, start, finish, expected)
+    ticket.name = name
+    ticket.enqueued_at -= waited
+    with scheduler._cond:
+        scheduler.waiting.append(ticket)
+        scheduler._dispatch_locked()
+    return ticket
+
+
+def _drain(scheduler, holder, tickets):
+    """Free the window one prompt at a time and return the order in which the others got it."""
+    order, current = [], holder
+    while True:
+        current.release()
+        granted = [ticket for ticket in tickets if ticket.granted and ticket.name not in order]
+        if not granted:
+            return order
+        current = granted[0]
+        order.append(current.name)
+
+
+def test_fair_queue_tags_follow_the_weights():
+    queue = FairQueue(WEIGHTS)
+    assert queue.tag('a', PRIORITY_BATCH) == (0.0, 1.0)
+    assert queue.tag('a', PRIORITY_BATCH) == (1.0, 2.0)
+    assert queue.tag('b', PRIORITY_INTERACTIVE) == (0.0, 0.25)
+
+
+def test_idle_flows_keep_no_credit():
+    queue = FairQueue(WEIGHTS)
+    queue.tag('a', PRIORITY_BATCH)
+    queue.served(5.0)
+    queue.idle()
+    # A returning flow starts at the current virtual time, not at its old finish tag
+    assert queue.tag('a', PRIORITY_BATCH) == (5.0, 6.0)
+
+
+def test_interactive_prompt_overtakes_a_batch_backlog():
+    scheduler = BackendScheduler('http://b', window=1, weights=WEIGHTS)
+    holder = scheduler.acquire('batchy', PRIORITY_BATCH)
+    tickets = [_hold(scheduler, f"batch{i}", 'batchy', PRIORITY_BATCH) for i in range(3)]
+    tickets.append(_hold(scheduler, 'image', 'alice', PRIORITY_INTERACTIVE))
+    assert _drain(scheduler, holder, tickets) == ['image', 'batch0', 'batch1', 'batch2']
+
+
+def test_users_of_the_same_class_alternate():
+    scheduler = BackendScheduler('http://b', window=1, weights=WEIGHTS)
+    holder = scheduler.acquire('a')
+    tickets = [_hold(scheduler, f"a{i}", 'a') for i in range(3)] + [_hold(scheduler, f"b{i}", 'b') for i in range(2)]
+    # 'a' already has the prompt in flight, so 'b' goes first
+    assert _drain(scheduler, holder, tickets) == ['b0', 'a0', 'b1', 'a1', 'a2']
+
+
+def _ticket(scheduler, name, user, priority=PRIORITY_INTERACTIVE, expected=None, waited=0.0):
+    start, finish = scheduler._fair.tag(user, priority)
+    ticket = DispatchTicket(scheduler, user, priority, start, finish, expected)
+    ticket.name = name
+    ticket.enqueued_at -= waited
+    return ticket
+
+
+def _pick(scheduler, tickets):
+    """Name of the waiting ticket the scheduler would dispatch next."""
+    with scheduler._cond:
+        scheduler.waiting = list(tickets)
+        return scheduler._next_locked().name
+
+
+@pytest.fixture
+def sejf():
+    return BackendScheduler('http://b', window=1, weights=WEIGHTS, policy=POLICY_SEJF, aging=0.0)
+
+
+def test_sejf_prefers_the_shortest_expected_job(sejf):
+    tickets = [
+        _ticket(sejf, 'long', 'u1', expected=100.0),
+        _ticket(sejf, 'short', 'u2', expected=10.0),
+        _ticket(sejf, 'medium', 'u3', expected=40.0),
+    ]
+    assert _pick(sejf, tickets) == 'short'
+    assert _pick(sejf, [tickets[0], tickets[2]]) == 'medium'
+
+
+def test_sejf_counts_unknown_estimates_as_the_average_of_known_ones(sejf):
+    # Known: 100 (batch) and 300 / 4 = 75 (interactive); unknown interactive: 200 / 4 = 50
+    assert _pick(sejf, [
+        _ticket(sejf, 'batch', 'u1', PRIORITY_BATCH, expected=100.0),
+        _ticket(sejf, 'interactive', 'u2', expected=300.0),
+        _ticket(sejf, 'unknown', 'u3'),
+    ]) == 'unknown'
+    # Known: 40 / 4 = 10 and 200 / 4 = 50; unknown batch: 120
+    assert _pick(sejf, [
+        _ticket(sejf, 'unknown', 'u3', PRIORITY_BATCH),
+        _ticket(sejf, 'quick', 'u1', expected=40.0),
+        _ticket(sejf, 'slow', 'u2', expected=200.0),
+    ]) == 'quick'
+
+
+def test_sejf_divides_the_expected_time_by_the_class_weight(sejf):
+    assert _pick(sejf, [
+        _ticket(sejf, 'batch', 'u1', PRIORITY_BATCH, expected=20.0),
+        _ticket(sejf, 'interactive', 'u2', expected=60.0),
+    ]) == 'interactive'
+
+
+def test_sejf_aging_lets_a_long_waiting_job_through(sejf):
+    sejf.aging = 0.5
+    # 100 - 0.5 * 200 = 0 beats 10
+    assert _pick(sejf, [
+        _ticket(sejf, 'long', 'u1', expected=100.0, waited=200.0),
+        _ticket(sejf, 'short', 'u2', expected=10.0),
+    ]) == 'long'
+
+
+def test_sejf_without_estimates_falls_back_to_fair_order(sejf):
+    first = _ticket(sejf, 'first', 'a')
+    second = _ticket(sejf, 'second', 'a')
+    other = _ticket(sejf, 'other', 'b')
+    assert _pick(sejf, [second, first]) == 'first'
+    assert _pick(sejf, [second, other]) == 'other'
+
+
+def test_waiting_prompt_gives_up_its_place_when_the_deadline_expires():
+    scheduler = BackendScheduler('http://b', window=1, weights=WEIGHTS)
+    scheduler.acquire('a')
+    with deadline_scope(0.05), pytest.raises(DeadlineExceeded):
+        scheduler.acquire('b')
+    assert scheduler.waiting == []
+    assert scheduler.inflight == 1
+
+
+def test_disabled_window_grants_nothing_to_wait_for():
+    scheduler = BackendScheduler('http://b', window=0)
+    ticket = scheduler.acquire('a')
+    ticket.release()
+    assert scheduler.inflight == 0
+
+
+def test_resolve_priority_defaults_by_mode():
+    assert resolve_priority(None, 'video') == PRIORITY_BATCH
+    assert resolve_priority(None, 'generate') == PRIORITY_INTERACTIVE
+    assert resolve_priority(' Batch ', 'generate') == PRIORITY_BATCH
+    assert resolve_priority('urgent', 'edit') == PRIORITY_INTERACTIVE
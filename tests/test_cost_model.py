@@ -0,0 +1,103 @@
+"""
+Generation cost model: linear fit and the estimate fallback chain
+"""
+import pytest
+from utils.cost_model import CostModel, GenerationProfile, _Sample, _fit
+
+URL = 'http://gpu-a'
+OTHER = 'http://gpu-b'
+
+
+def _profile(workflow='lumina', width=1024, height=1024, steps=20, mode='generate'):
+    return GenerationProfile(mode, workflow, width=width, height=height, steps=steps)
+
+
+def _samples(points):
+    return [_Sample(None, work, None, seconds) for work, seconds in points]
+
+
+def test_fit_recovers_intercept_and_slope():
+    intercept, slope = _fit(_samples([(1.0, 7.0), (2.0, 9.0), (4.0, 13.0)]))
+    assert intercept == pytest.approx(5.0)
+    assert slope == pytest.approx(2.0)
+
+
+def test_fit_is_proportional_when_work_does_not_vary():
+    assert _fit(_samples([(2.0, 10.0), (2.0, 14.0)])) == (0.0, pytest.approx(6.0))
+
+
+def test_fit_rejects_a_negative_intercept():
+    # A line through these points would cross zero at work 1.5
+    intercept, slope = _fit(_samples([(2.0, 1.0), (4.0, 5.0)]))
+    assert intercept == 0.0
+    assert slope == pytest.approx(1.0)
+
+
+def test_profile_work_is_megapixels_times_steps_times_frames():
+    assert GenerationProfile('video', 'video', width=1000, height=500, steps=4, length=81).work == pytest.approx(162.0)
+    assert GenerationProfile('generate', 'lumina').work == 1.0
+
+
+def test_no_history_gives_no_estimate():
+    model = CostModel(min_samples=2)
+    assert model.estimate(_profile(), URL) is None
+    assert model.execution_timeout(_profile(), URL) is None
+
+
+def test_exact_profile_uses_the_median():
+    model = CostModel(min_samples=3)
+    for seconds in (10.0, 12.0, 30.0):
+        model.record(_profile(), URL, 1.0, seconds)
+    estimate = model.estimate(_profile(), URL)
+    assert (estimate["basis"], estimate["execution"], estimate["samples"]) == ('exact', 12.0, 3)
+
+
+def test_backend_fit_scales_to_a_new_size():
+    model = CostModel(min_samples=2)
+    model.record(_profile(steps=10), URL, 0.0, 10.0)
+    model.record(_profile(steps=20), URL, 0.0, 20.0)
+    estimate = model.estimate(_profile(steps=40), URL)
+    assert estimate["basis"] == 'backend'
+    assert estimate["execution"] == pytest.approx(40.0)
+
+
+def test_other_backends_are_used_before_the_mode_median():
+    model = CostModel(min_samples=2)
+    model.record(_profile(steps=10), OTHER, 0.0, 10.0)
+    model.record(_profile(steps=20), OTHER, 0.0, 20.0)
+    estimate = model.estimate(_profile(steps=30), URL)
+    assert estimate["basis"] == 'workflow'
+    assert estimate["execution"] == pytest.approx(30.0)
+
+
+def test_mode_median_is_the_last_resort_and_gets_no_timeout():
+    model = CostModel(min_samples=5)
+    model.record(_profile('chroma'), URL, 0.0, 8.0)
+    estimate = model.estimate(_profile('qwen'), URL)
+    assert (estimate["basis"], estimate["execution"]) == ('mode', 8.0)
+    assert model.execution_timeout(_profile('qwen'), URL) is None
+    assert model.estimate(_profile('qwen', mode='video'), URL) is None
+
+
+def test_execution_timeout_is_factor_times_expected_plus_margin():
+    model = CostModel(min_samples=1, timeout_factor=3.0, timeout_margin=60.0)
+    model.record(_profile(), URL, 0.0, 20.0)
+    assert model.execution_timeout(_profile(), URL) == pytest.approx(120.0)
+    model.timeout_factor = 0
+    assert model.execution_timeout(_profile(), URL) is None
+
+
+def test_queue_wait_is_smoothed_per_backend_and_mode():
+    model = CostModel(min_samples=1)
+    model.record(_profile(), URL, 10.0, 5.0)
+    model.record(_profile(), URL, 20.0, 5.0)
+    assert model.estimate(_profile(), URL)["queue"] == pytest.approx(12.0)
+    # A backend without its own history falls back to the mode's average
+    assert model.estimate(_profile(), OTHER)["queue"] == pytest.approx(12.0)
+
+
+def test_invalid_durations_are_ignored():
+    model = CostModel(min_samples=1)
+    model.record(_profile(), URL, 0.0, 0)
+    model.record(_profile(), URL, 0.0, None)
+    assert model.estimate(_profile(), URL) is None
@@ -0,0 +1,63 @@
+"""
+Job store retention
+"""
+import time
+import pytest
+from utils import job_store
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(job_store, 'JOBS_DB_PATH', str(tmp_path / 'jobs.db'))
+    monkeypatch.setattr(job_store, 'JOB_STORE_MAX_AGE_SECONDS', 3600)
+    job_store.init_job_store()
+    return job_store
+
+
+def record(job_id, state, age, now):
+    finished_at = now - age if state not in ('queued', 'running') else None
+    return {'id': job_id, 'kind': 'generate', 'mode': 'generate', 'state': state,
+            'created_at': now - age, 'updated_at': now - age, 'finished_at': finished_at}
+
+
+def test_finishing_a_job_deletes_old_finished_rows(store):
+    now = time.time()
+    store.save_job_record(record('old-done', 'completed', 7200, now))
+    store.save_job_record(record('old-failed', 'failed', 7200, now))
+    store.save_job_record(record('old-running', 'running', 7200, now))
+    store.save_job_record(record('recent', 'completed', 60, now))
+    assert store.load_job_record('old-done') is None
+    assert store.load_job_record('old-failed') is None
+    assert store.load_job_record('old-running') is not None
+    assert store.load_job_record('recent') is not None
+
+
+def test_startup_prunes_finished_rows(store, monkeypatch):
+    now = time.time()
+    store.save_job_record(record('kept', 'queued', 7200, now))
+    store.save_job_record(record('done', 'cancelled', 60, now))
+    monkeypatch.setattr(job_store, 'JOB_STORE_MAX_AGE_SECONDS', 10)
+    store.init_job_store()
+    assert store.load_job_record('done') is None
+    assert [row['id'] for row in store.load_unfinished_job_records()] == ['kept']
+
+
+def test_priority_is_stored(store):
+    now = time.time()
+    store.save_job_record({**record('batch-job', 'queued', 0, now), 'priority': 'batch'})
+    assert store.load_job_record('batch-job')['priority'] == 'batch'
+
+
+def test_priority_column_is_added_to_older_databases(tmp_path, monkeypatch):
+    path = tmp_path / 'old.db'
+    monkeypatch.setattr(job_store, 'JOBS_DB_PATH', str(path))
+    conn = job_store.get_job_db_connection()
+    conn.execute('CREATE TABLE jobs (id TEXT PRIMARY KEY, kind TEXT NOT NULL, mode TEXT NOT NULL, user TEXT, '
+                 'state TEXT NOT NULL, stage TEXT, params TEXT, prompt_id TEXT, backend_url TEXT, '
+                 'target_nodes TEXT, media_key TEXT, result TEXT, error TEXT, error_details TEXT, '
+                 'created_at REAL, started_at REAL, finished_at REAL, updated_at REAL)')
+    conn.commit()
+    conn.close()
+    job_store.init_job_store()
+    job_store.save_job_record({**record('job', 'running', 0, time.time()), 'priority': 'interactive'})
+    assert job_store.load_job_record('job')['priority'] == 'interactive'
@@ -0,0 +1,74 @@
+"""
+Job scheduling: admission slots, worker pools and the order between them
+"""
+import time
+import pytest
+from utils import jobs
+from utils.admission import AdmissionController
+from utils.bulkheads import Bulkhead
+from utils.deadlines import deadline_scope
+from utils.jobs import JobManager, JOB_COMPLETED, JOB_CANCELLED
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    bulkhead = Bulkhead('t', 1)
+    monkeypatch.setattr(jobs, 'get_bulkhead', lambda mode: bulkhead)
+    return bulkhead
+
+
+def _wait_finished(job, timeout=5.0):
+    expires = time.time() + timeout
+    while not job.is_finished and time.time() < expires:
+        time.sleep(0.01)
+    return job.is_finished
+
+
+def test_sync_request_holding_a_slot_is_not_blocked_by_a_waiting_job(pool):
+    controller = AdmissionController('generate', max_active=1, max_queued=5)
+    # A synchronous request takes its slot in the request thread...
+    sync_ticket = controller.admit()
+    sync_ticket.acquire()
+    # ...while an async job is waiting for the same slot
+    job = JobManager().submit('test', lambda: {"success": True}, admission=controller.admit(), deadline=10)
+    assert pool.queued == 0 and pool.busy == 0
+    with deadline_scope(3):
+        assert pool.call(lambda: 'sync done') == 'sync done'
+    sync_ticket.release()
+    assert _wait_finished(job)
+    assert job.state == JOB_COMPLETED
+    assert (controller.active, controller.queued) == (0, 0)
+
+
+def test_job_cancelled_while_waiting_for_a_slot_never_runs(pool):
+    controller = AdmissionController('generate', max_active=1, max_queued=5)
+    holder = controller.admit()
+    holder.acquire()
+    ran = []
+    manager = JobManager()
+    job = manager.submit('test', lambda: ran.append(True), admission=controller.admit(), deadline=10)
+    manager.request_cancel(job)
+    holder.release()
+    assert job.state == JOB_CANCELLED
+    assert ran == []
+    assert (controller.active, controller.queued) == (0, 0)
+
+
+def test_ticket_is_released_when_the_job_cannot_be_queued(pool, monkeypatch):
+    controller = AdmissionController('generate', max_active=1, max_queued=1)
+    manager = JobManager()
+
+    def fail(*args):
+        raise RuntimeError('pool is gone')
+
+    monkeypatch.setattr(manager, '_enqueue', fail)
+    with pytest.raises(RuntimeError):
+        manager.submit('test', lambda: None, admission=controller.admit())
+    assert controller.queued == 0
+
+
+def test_priority_survives_the_job_store_round_trip():
+    job = jobs.Job('generate', mode='generate', user='alice', priority='batch')
+    restored = jobs.Job.from_record(job.to_record())
+    assert restored.priority == 'batch'
+    assert jobs.Job.from_record({**job.to_record(), 'priority': None}).priority == 'interactive'
@@ -0,0 +1,140 @@
+"""
+Keep-warm hours, socket-aware cold starts and socket suspension
+"""
+import pytest
+from utils import keep_warm as keep_warm_module
+from utils.keep_warm import KeepWarmController, parse_hours
+
+URL = 'https://app--comfy.modal.run'
+
+
+class FakeClock:
+    def __init__(self, now=1_000_000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(keep_warm_module.time, 'time', fake)
+    return fake
+
+
+@pytest.fixture
+def sockets(monkeypatch):
+    """Record the socket calls of the controller instead of opening real ones."""
+    calls = []
+    monkeypatch.setattr(keep_warm_module, 'get_comfy_urls', lambda mode: [URL])
+    monkeypatch.setattr(keep_warm_module, 'get_ws_listener', lambda base_url=None: calls.append(('open', base_url)))
+    monkeypatch.setattr(keep_warm_module, 'suspend_ws_listener', lambda url: calls.append(('close', url)) or True)
+    return calls
+
+
+def controller(**kwargs):
+    kwargs.setdefault('backends', 'modal')
+    kwargs.setdefault('scaledown', 300)
+    kwargs.setdefault('hours', '')
+    kwargs.setdefault('learned_days', 0)
+    kwargs.setdefault('max_hours', 8)
+    return KeepWarmController(**kwargs)
+
+
+def test_parse_hours_plain_range_excludes_the_end():
+    assert parse_hours('9-18') == set(range(9, 18))
+
+
+def test_parse_hours_several_ranges_and_single_hour():
+    assert parse_hours('8-10, 14-15,20') == {8, 9, 14, 20}
+
+
+def test_parse_hours_wraps_midnight():
+    assert parse_hours('22-6') == {22, 23, 0, 1, 2, 3, 4, 5}
+    assert parse_hours('23') == {23}
+    assert parse_hours('0-24') == set(range(24))
+
+
+def test_parse_hours_empty_range_is_ignored():
+    assert parse_hours('9-9') == set()
+    assert parse_hours('0-0,10-11') == {10}
+
+
+def test_parse_hours_invalid_parts_are_ignored():
+    assert parse_hours('') == set()
+    assert parse_hours('abc,9-x') == set()
+    assert parse_hours('25-3,-1,7-8') == {7}
+
+
+def test_http_gap_longer_than_scaledown_is_a_cold_start(clock):
+    warm = controller()
+    warm.observe(URL, 0.1)
+    clock.now += 400
+    warm.observe(URL, 20.0)
+    state = warm._state(URL)
+    assert state.cold_starts == 1
+    assert state.pending_cold
+
+
+def test_open_socket_counts_as_contact(clock):
+    warm = controller()
+    warm.observe_socket(URL, True, 0.5)
+    clock.now += 3600
+    warm.observe(URL, 0.1)
+    assert warm._state(URL).cold_starts == 0
+
+
+def test_socket_reopened_after_scaledown_is_a_cold_start(clock):
+    warm = controller()
+    warm.observe_socket(URL, True, 0.5)
+    clock.now += 100
+    warm.observe_socket(URL, False)
+    clock.now += 100
+    warm.observe_socket(URL, True, 1.0)
+    assert warm._state(URL).cold_starts == 0
+    warm.observe_socket(URL, False)
+    clock.now += 600
+    warm.observe_socket(URL, True, 25.0)
+    state = warm._state(URL)
+    assert state.cold_starts == 1
+    assert state.cold_start_seconds == 25.0
+
+
+def test_tick_closes_the_socket_of_an_idle_backend(clock, sockets):
+    warm = controller()
+    warm.tick()
+    assert sockets == [('close', URL)]
+    assert not warm.should_contact(URL)
+
+
+def test_tick_keeps_the_socket_open_after_a_prompt(clock, sockets):
+    warm = controller(recent_minutes=30)
+    warm.note_prompt(URL)
+    warm.observe_socket(URL, True, 0.2)
+    warm.tick()
+    assert sockets == [('open', URL)]
+    assert warm.should_contact(URL)
+    sockets.clear()
+    clock.now += 31 * 60
+    warm.tick()
+    assert sockets == [('close', URL)]
+
+
+def test_tick_closes_the_socket_once_the_ceiling_is_reached(clock, sockets):
+    warm = controller(recent_minutes=600, max_hours=0.05)
+    warm.note_prompt(URL)
+    warm.observe_socket(URL, True, 0.2)
+    for _ in range(4):
+        warm.tick()
+        clock.now += warm.interval
+    assert sockets[-1] == ('close', URL)
+    assert warm._state(URL).ceiling_reached
+    assert not warm.should_contact(URL)
+
+
+def test_unmanaged_backends_are_left_alone(clock, sockets):
+    warm = controller()
+    warm.observe_socket('http://127.0.0.1:8188', True, 0.1)
+    assert 'http://127.0.0.1:8188' not in warm._states
+    assert warm.should_contact('http://127.0.0.1:8188')
@@ -0,0 +1,256 @@
+"""
+Admission control
+Caps, per mode, how many generations run at once and how many admitted
+requests may wait for a slot. A request arriving when both are full is
+rejected with AdmissionRejected (HTTP 429) and a Retry-After derived from the
+current queue depth and the average time a generation holds its slot, instead
+of piling another prompt and another waiting thread onto the backend
+"""
+import math
+import time
+import threading
+from collections import deque
+from config import ADMISSION_MAX_ACTIVE, ADMISSION_MAX_QUEUED
+from utils.comfy_config import normalize_mode
+from utils.comfy_pool import get_average_latency, MODES
+from utils.deadlines import get_current_deadline, deadline_error
+
+# Slot time assumed before any generation of a mode has finished
+_DEFAULT_JOB_SECONDS = 30.0
+# Weight of the newest sample in the average slot time
+_DURATION_SMOOTHING = 0.2
+# How often a waiting ticket rechecks its deadline and cancellation
+_WAIT_SLICE = 1.0
+
+_WAITING = 'waiting'
+_ACTIVE = 'active'
+_RELEASED = 'released'
+
+
+class AdmissionRejected(Exception):
+    """Raised when a mode has no free slot and its wait queue is full."""
+
+    def __init__(self, mode, retry_after, active, queued, max_active, max_queued):
+        self.mode = mode
+        self.retry_after = retry_after
+        self.active = active
+        self.queued = queued
+        self.max_active = max_active
+        self.max_queued = max_queued
+        super().__init__(
+            f"Too many '{mode}' generations in progress ({active} running, {queued} waiting); "
+            f"retry in {self.retry_after_seconds()}s"
+        )
+
+    def retry_after_seconds(self):
+        """Whole seconds for a Retry-After header (at least 1)."""
+        return max(1, int(math.ceil(self.retry_after or 0)))
+
+    def to_dict(self):
+        return {
+            "status": "overloaded",
+            "mode": self.mode,
+            "retry_after": self.retry_after_seconds(),
+            "active": self.active,
+            "queued": self.queued,
+            "max_active": self.max_active,
+            "max_queued": self.max_queued,
+        }
+
+
+class AdmissionTicket:
+    """Place of one admitted request: waiting for a slot, holding one, or released."""
+
+    def __init__(self, controller):
+        self.controller = controller
+        self.state = _WAITING
+        self.admitted_at = time.time()
+        self.activated_at = None
+        # Called once the ticket gets its slot when it waits without a thread (acquire_async)
+        self.on_active = None
+
+    def acquire(self, cancel_event=None):
+        """Block until the ticket holds a slot.
+
+        Raises:
+            DeadlineExceeded: If the current deadline runs out while waiting
+        """
+        self.controller._acquire(self, cancel_event)
+
+    def acquire_async(self, on_active):
+        """Wait for a slot without blocking; on_active() is called once the ticket holds it.
+
+        on_active runs on the thread that freed the slot (or on the caller's,
+        when a slot is free right away), so it must only hand the work over,
+        e.g. submit it to a worker pool.
+        """
+        self.controller._acquire_async(self, on_active)
+
+    def release(self):
+        """Free the slot (or the place in the wait queue); safe to call twice."""
+        self.controller._release(self)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+        return False
+
+
+class AdmissionController:
+    """Slots and wait queue of one mode."""
+
+    def __init__(self, mode, max_active=0, max_queued=0):
+        self.mode = mode
+        self.max_active = max_active
+        self.max_queued = max_queued
+        self.active = 0
+        self.queued = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.average_duration = None
+        # Tickets waiting for a slot, served in arrival order
+        self._waiting = deque()
+        self._cond = threading.Condition()
+
+    @property
+    def enabled(self):
+        return self.max_active > 0
+
+    def _average_locked(self):
+        return self.average_duration or get_average_latency(self.mode) or _DEFAULT_JOB_SECONDS
+
+    def _retry_after_locked(self):
+        # Every running slot and every waiting request ahead has to drain through max_active slots
+        return self._average_locked() * (self.queued + 1) / max(1, self.max_active)
+
+    def admit(self, force=False):
+        """Admit a request and return its ticket.
+
+        force admits even when the mode is full (jobs resumed after a restart).
+
+        Raises:
+            AdmissionRejected: If every slot is taken and the wait queue is full
+        """
+        with self._cond:
+            if self.enabled and not force and self.active + self.queued >= self.max_active + self.max_queued:
+                self.rejected += 1
+                raise AdmissionRejected(self.mode, self._retry_after_locked(), self.active, self.queued,
+                                        self.max_active, self.max_queued)
+            self.admitted += 1
+            self.queued += 1
+            return AdmissionTicket(self)
+
+    def _grant_locked(self):
+        """Hand free slots to the oldest waiting tickets; returns the callbacks to run unlocked."""
+        callbacks = []
+        while self._waiting and (not self.enabled or self.active < self.max_active):
+            ticket = self._waiting.popleft()
+            self.queued -= 1
+            self.active += 1
+            ticket.state = _ACTIVE
+            ticket.activated_at = time.time()
+            if ticket.on_active is not None:
+                callbacks.append(ticket.on_active)
+        self._cond.notify_all()
+        return callbacks
+
+    def _abandon_locked(self, ticket):
+        """Give up a waiting ticket's place without a slot."""
+        try:
+            self._waiting.remove(ticket)
+        except ValueError:
+            pass
+        self.queued -= 1
+        ticket.state = _RELEASED
+
+    def _acquire(self, ticket, cancel_event=None):
+        deadline = get_current_deadline()
+        callbacks = []
+        try:
+            with self._cond:
+                if ticket.state != _WAITING:
+                    return
+                self._waiting.append(ticket)
+                callbacks = self._grant_locked()
+                while ticket.state == _WAITING:
+                    if cancel_event is not None and cancel_event.is_set():
+                        # The caller sees the cancellation at its next check
+                        self._abandon_locked(ticket)
+                        break
+                    timeout = _WAIT_SLICE
+                    if deadline is not None:
+                        if deadline.expired:
+                            self._abandon_locked(ticket)
+                            raise deadline_error(f"waiting for a '{self.mode}' slot")
+                        timeout = min(timeout, deadline.remaining())
+                    self._cond.wait(timeout)
+        finally:
+            # Slots handed to async tickets ahead of this one
+            _run_callbacks(callbacks)
+
+    def _acquire_async(self, ticket, on_active):
+        with self._cond:
+            if ticket.state != _WAITING:
+                return
+            ticket.on_active = on_active
+            self._waiting.append(ticket)
+            callbacks = self._grant_locked()
+        _run_callbacks(callbacks)
+
+    def _release(self, ticket):
+        with self._cond:
+            if ticket.state == _WAITING:
+                self._abandon_locked(ticket)
+            elif ticket.state == _ACTIVE:
+                self.active -= 1
+                ticket.state = _RELEASED
+                duration = time.time() - ticket.activated_at
+                if self.average_duration is None:
+                    self.average_duration = duration
+                else:
+                    self.average_duration += _DURATION_SMOOTHING * (duration - self.average_duration)
+            else:
+                return
+            callbacks = self._grant_locked()
+        _run_callbacks(callbacks)
+
+    def to_dict(self):
+        with self._cond:
+            return {
+                "enabled": self.enabled,
+                "max_active": self.max_active,
+                "max_queued": self.max_queued,
+                "active": self.active,
+                "queued": self.queued,
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "average_duration": round(self.average_duration, 3) if self.average_duration is not None else None,
+                "retry_after": round(self._retry_after_locked(), 1),
+            }
+
+
+def _run_callbacks(callbacks):
+    for callback in callbacks:
+        try:
+            callback()
+        except Exception as e:
+            print(f"[ADMISSION] Slot callback failed: {e}")
+
+
+_controllers = {
+    mode: AdmissionController(mode, ADMISSION_MAX_ACTIVE.get(mode, 0), ADMISSION_MAX_QUEUED.get(mode, 0))
+    for mode in MODES
+}
+
+
+def admit_request(mode='generate', force=False):
+    """Admit a generation of a mode (see AdmissionController.admit)."""
+    return _controllers[normalize_mode(mode)].admit(force=force)
+
+
+def get_admission_status():
+    """Limits and current occupancy of every mode."""
+    return {mode: controller.to_dict() for mode, controller in _controllers.items()}
@@ -0,0 +1,172 @@
+"""
+Bulkhead worker pools
+Each workload class (image generation, edit, video, media post-processing)
+runs on its own bounded pool of workers, sized independently, so minutes-long
+video jobs or a burst of ffmpeg/OpenCV work saturate only their own pool and
+never take the workers image generations or the interactive API depend on.
+Tasks waiting for a worker are served in weighted fair order of their user
+and priority class rather than first come, first served. A generation always
+takes its admission slot (utils.admission) before it takes a worker, on the
+synchronous and the job path alike, so a worker never waits for a slot held
+by a request that is itself waiting for a worker
+"""
+import heapq
+import itertools
+import time
+import threading
+from contextlib import ExitStack
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from config import BULKHEAD_WORKERS
+from utils.deadlines import get_current_deadline, deadline_scope, deadline_error
+from utils.comfy_scheduler import FairQueue, get_dispatch_context, dispatch_scope, PRIORITY_INTERACTIVE
+
+# Pools by workload class; generation modes map to the class of the same name
+BULKHEAD_CLASSES = ('generate', 'edit', 'video', 'media')
+
+
+class Bulkhead:
+    """Bounded worker pool of one workload class, with a fair wait queue and saturation counters."""
+
+    def __init__(self, name, workers):
+        self.name = name
+        self.workers = max(1, workers)
+        self.busy = 0
+        self.peak_busy = 0
+        self.peak_queued = 0
+        self.completed = 0
+        self.total_wait = 0.0
+        self.saturated_since = None
+        # Heap of (finish tag, sequence, start tag, submitted_at, future, task)
+        self._waiting = []
+        self._sequence = itertools.count()
+        self._fair = FairQueue()
+        self._cond = threading.Condition()
+        self._threads = []
+
+    @property
+    def queued(self):
+        return len(self._waiting)
+
+    def _start_workers_locked(self):
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._work, name=f'{self.name}-worker_{len(self._threads)}', daemon=True)
+            self._threads.append(thread)
+            thread.start()
+
+    def _next_task(self):
+        with self._cond:
+            while not self._waiting:
+                self._cond.wait()
+            _, _, start, submitted_at, future, task = heapq.heappop(self._waiting)
+            self._fair.served(start)
+            if not self._waiting:
+                self._fair.idle()
+            self.busy += 1
+            self.peak_busy = max(self.peak_busy, self.busy)
+            self.total_wait += time.time() - submitted_at
+            if self.busy >= self.workers and self.saturated_since is None:
+                self.saturated_since = time.time()
+            if self.busy >= self.workers and self._waiting:
+                print(f"[BULKHEAD] Pool '{self.name}' saturated ({self.workers} busy, {len(self._waiting)} waiting)")
+            return future, task
+
+    def _work(self):
+        while True:
+            future, task = self._next_task()
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(task())
+                    except BaseException as e:
+                        future.set_exception(e)
+            finally:
+                with self._cond:
+                    self.busy -= 1
+                    self.completed += 1
+                    if self.busy < self.workers:
+                        self.saturated_since = None
+
+    def submit(self, func, *args, **kwargs):
+        """Queue func(*args, **kwargs) on the pool and return its Future.
+
+        The caller's deadline and dispatch context (user and priority), if
+        any, are bound to the worker running func; the dispatch context also
+        decides the task's turn among the waiting ones.
+        """
+        deadline = get_current_deadline()
+        context = get_dispatch_context()
+
+        def task():
+            with ExitStack() as stack:
+                if deadline is not None:
+                    stack.enter_context(deadline_scope(deadline=deadline))
+                if context is not None:
+                    stack.enter_context(dispatch_scope(*context))
+                return func(*args, **kwargs)
+
+        user, priority = context or (None, PRIORITY_INTERACTIVE)
+        future = Future()
+        with self._cond:
+            start, finish = self._fair.tag(user, priority)
+            heapq.heappush(self._waiting, (finish, next(self._sequence), start, time.time(), future, task))
+            self.peak_queued = max(self.peak_queued, len(self._waiting))
+            self._start_workers_locked()
+            self._cond.notify()
+        return future
+
+    def _discard(self, future):
+        """Drop a cancelled task that is still waiting for a worker."""
+        with self._cond:
+            waiting = [item for item in self._waiting if item[4] is not future]
+            if len(waiting) != len(self._waiting):
+                heapq.heapify(waiting)
+                self._waiting = waiting
+
+    def call(self, func, *args, **kwargs):
+        """Run func on the pool and wait for its result (or exception).
+
+        Raises:
+            DeadlineExceeded: If the caller's deadline runs out first; a call
+                that has not started yet is dropped from the queue
+        """
+        future = self.submit(func, *args, **kwargs)
+        deadline = get_current_deadline()
+        try:
+            return future.result(timeout=deadline.remaining() if deadline is not None else None)
+        except FutureTimeoutError:
+            if future.cancel():
+                self._discard(future)
+            raise deadline_error(f"waiting for the '{self.name}' pool")
+
+    def to_dict(self):
+        with self._cond:
+            started = self.completed + self.busy
+            return {
+                "workers": self.workers,
+                "busy": self.busy,
+                "queued": len(self._waiting),
+                "saturation": round(self.busy / self.workers, 3),
+                "saturated_for": round(time.time() - self.saturated_since, 1) if self.saturated_since else None,
+                "peak_busy": self.peak_busy,
+                "peak_queued": self.peak_queued,
+                "completed": self.completed,
+                "avg_queue_wait": round(self.total_wait / started, 3) if started else None,
+            }
+
+
+_bulkheads = {name: Bulkhead(name, BULKHEAD_WORKERS.get(name, 2)) for name in BULKHEAD_CLASSES}
+
+
+def get_bulkhead(name):
+    """Pool of a workload class or generation mode."""
+    return _bulkheads[name if name in _bulkheads else 'generate']
+
+
+def run_in_bulkhead(name, func, *args, **kwargs):
+    """Run func on a workload class's pool and wait for it (see Bulkhead.call)."""
+    return get_bulkhead(name).call(func, *args, **kwargs)
+
+
+def get_bulkhead_status():
+    """Size, occupancy and saturation of every pool."""
+    return {name: bulkhead.to_dict() for name, bulkhead in _bulkheads.items()}
@@ -3,442 +3,533 @@ ComfyUI integration utilities
 Functions for interacting with ComfyUI API
 """
 import json
-import uuid
 import time
-import threading
 import requests
-import websocket
-from utils.comfy_config import get_comfy_url, COMFYUI_HOST, COMFYUI_PORT, WS_PROTOCOL, build_comfy_headers
+from config import COMFY_POLL_INITIAL_INTERVAL, COMFY_POLL_MAX_INTERVAL, COMFY_HISTORY_SETTLE_TIMEOUT
+from utils.comfy_config import get_comfy_url, get_comfy_urls
+from utils.comfy_http import comfy_get, comfy_post
+from utils.comfy_pool import note_prompt_queued, hold_dispatch_slot, release_dispatch_slot
+from utils.comfy_scheduler import acquire_dispatch_slot
+from utils.cost_model import record_generation, expected_prompt_seconds, prompt_execution_timeout
+from utils.keep_warm import note_backend_prompt
+from utils.comfy_schema import validate_prompt, invalidate_object_info, WorkflowValidationError
+from utils.comfy_health import BackendUnavailableError
+from utils.deadlines import get_current_deadline, DeadlineExceeded
+from utils.comfy_ws import get_comfy_client_id, get_ws_listener
+from utils.jobs import get_current_job, get_job, request_job_cancel, JobCancelled
+
+class ComfyExecutionError(Exception):
+    """Raised when ComfyUI reports that a prompt failed or was interrupted."""
+
+    def __init__(self, prompt_id, status='error', node_id=None, node_type=None,
+                 exception_type=None, exception_message=None):
+        self.prompt_id = prompt_id
+        self.status = status
+        self.node_id = node_id
+        self.node_type = node_type
+        self.exception_type = exception_type
+        self.exception_message = exception_message
+        if status == 'interrupted':
+            message = f"ComfyUI execution interrupted for prompt {prompt_id}"
+        else:
+            message = f"ComfyUI execution failed for prompt {prompt_id}"
+        if node_id:
+            message += f" at node {node_id}" + (f" ({node_type})" if node_type else "")
+        if exception_message:
+            message += f": {exception_message.strip()}"
+        super().__init__(message)
+
+    def to_dict(self):
+        return {
+            "prompt_id": self.prompt_id,
+            "status": self.status,
+            "node_id": self.node_id,
+            "node_type": self.node_type,
+            "exception_type": self.exception_type,
+            "exception_message": self.exception_message,
+        }
+
+
+def execution_error_from_history(prompt_id, history_entry):
+    """Build a ComfyExecutionError from a history entry whose status is 'error', else None."""
+    status = (history_entry or {}).get("status") or {}
+    if status.get("status_str") != "error":
+        return None
+    error_status = 'error'
+    details = {}
+    for message in status.get("messages") or []:
+        if not isinstance(message, (list, tuple)) or len(message) < 2:
+            continue
+        event_type, data = message[0], message[1] or {}
+        if event_type == "execution_error":
+            error_status, details = 'error', data
+            break
+        if event_type == "execution_interrupted":
+            error_status, details = 'interrupted', data
+    return ComfyExecutionError(
+        prompt_id,
+        status=error_status,
+        node_id=details.get("node_id"),
+        node_type=details.get("node_type"),
+        exception_type=details.get("exception_type"),
+        exception_message=details.get("exception_message"),
+    )
+
+
+def execution_error_from_waiter(waiter):
+    """Build a ComfyExecutionError from a WebSocket waiter that ended badly, else None."""
+    if waiter.status not in ('error', 'interrupted'):
+        return None
+    details = waiter.error or {}
+    return ComfyExecutionError(
+        waiter.prompt_id,
+        status=waiter.status,
+        node_id=details.get("node_id"),
+        node_type=details.get("node_type"),
+        exception_type=details.get("exception_type"),
+        exception_message=details.get("exception_message"),
+    )
+
 
 def queue_prompt(workflow, client_id=None, mode='generate'):
     """Enviar prompt a la cola de ComfyUI"""
     if client_id is None:
-        client_id = str(uuid.uuid4())
+        client_id = get_comfy_client_id()
+    # A job cancelled while it prepared its inputs never takes a queue slot
+    current_job = get_current_job()
+    if current_job is not None:
+        current_job.check_cancelled()
+    # Reject locally the workflows the backend cannot run
+    validate_prompt(workflow, mode)
+    # Make sure the backend socket is listening before the prompt can emit events
+    get_ws_listener(mode)
+    # Wait for a turn in the backend's window (fair share across users and priorities)
+    base_url = get_comfy_url(mode)
+    dispatch = acquire_dispatch_slot(
+        base_url,
+        cancel_event=current_job.cancel_event if current_job is not None else None,
+        expected=expected_prompt_seconds(mode, base_url)
+    )
     try:
-        comfy_url = get_comfy_url(mode)
-        p = {"prompt": workflow, "client_id": client_id}
-        data = json.dumps(p).encode('utf-8')
+        if current_job is not None:
+            current_job.check_cancelled()
+        if hasattr(workflow, "to_json"):
+            # WorkflowInstance: only the patched nodes are serialized
+            data = f'{{"prompt": {workflow.to_json()}, "client_id": {json.dumps(client_id)}}}'.encode('utf-8')
+        else:
+            p = {"prompt": workflow, "client_id": client_id}
+            data = json.dumps(p).encode('utf-8')
         
-        response = requests.post(
-            f"{comfy_url}/prompt",
+        response = comfy_post(
+            "/prompt",
+            mode=mode,
             data=data,
-            headers=build_comfy_headers({"Content-Type": "application/json"})
+            headers={"Content-Type": "application/json"}
         )
         
         if response.status_code == 200:
-            return response.json()
+            result = response.json()
+            note_prompt_queued(mode, result.get("prompt_id"))
+            note_backend_prompt(base_url)
+            # The slot stays taken until the prompt finishes (wait_for_completion) or its scope closes
+            if not hold_dispatch_slot(mode, dispatch):
+                dispatch.release()
+            return result
         else:
+            if response.status_code == 400:
+                # ComfyUI rejected the prompt: the cached schema may be stale
+                invalidate_object_info(base_url)
             raise Exception(f"Error sending prompt: {response.status_code} - {response.text}")
     except Exception as e:
+        dispatch.release()
         print(f"Error in queue_prompt: {e}")
         raise
 
-def get_media_outputs(prompt_id, target_nodes=None, media_key="images", mode='generate'):
-    """Obtener archivos generados (imágenes, videos, etc.) para un prompt_id específico"""
+VIDEO_EXTENSIONS = ('.mp4', '.webm', '.avi', '.mov', '.mkv', '.gif')
+AUDIO_EXTENSIONS = ('.wav', '.mp3', '.flac', '.ogg', '.m4a')
+MEDIA_TYPES = ('images', 'videos', 'gifs', 'audio')
+
+# Media types accepted for each requested media_key, in order of preference
+MEDIA_KEY_PREFERENCES = {
+    "images": ("images",),
+    "videos": ("videos", "gifs", "images"),
+    "gifs": ("gifs", "videos"),
+    "audio": ("audio",),
+}
+
+# Output keys whose items are classified by their file extension
+_GENERIC_OUTPUT_KEYS = {"images", "image", "videos", "video", "mp4", "output", "files"}
+
+
+def _classify_media_item(filename, default_type):
+    """Decide the media type of a file from its extension; None if it is not media."""
+    lowered = filename.lower()
+    if lowered.endswith(VIDEO_EXTENSIONS):
+        return "gifs" if default_type == "gifs" else "videos"
+    if lowered.endswith(AUDIO_EXTENSIONS):
+        return "audio"
+    return default_type
+
+
+def index_history_outputs(history_entry):
+    """Walk the outputs of a history entry once and index them by node and media type.
+
+    Returns:
+        dict node_id -> {"images": [...], "videos": [...], "gifs": [...], "audio": [...]}
+        with only the non-empty types present. Items are dicts with at least filename.
+    """
+    index = {}
+    if not isinstance(history_entry, dict):
+        return index
+    outputs = history_entry.get("outputs")
+    if not isinstance(outputs, dict):
+        return index
+
+    for node_id, node_outputs in outputs.items():
+        if not isinstance(node_outputs, dict):
+            continue
+        node_index = {}
+        for key, value in node_outputs.items():
+            items = value if isinstance(value, list) else [value]
+            if key == "gifs":
+                default_type = "gifs"
+            elif key == "audio":
+                default_type = "audio"
+            elif key in _GENERIC_OUTPUT_KEYS:
+                default_type = "images"
+            else:
+                # Unknown keys (text, flags, ...) only count when they hold media files
+                default_type = None
+            for item in items:
+                if isinstance(item, dict):
+                    filename = item.get("filename")
+                    if not filename:
+                        continue
+                    media_item = item
+                elif isinstance(item, str):
+                    filename = item
+                    media_item = {"filename": item, "subfolder": "", "type": "output"}
+                else:
+                    continue
+                media_type = _classify_media_item(filename, default_type)
+                if media_type is not None:
+                    node_index.setdefault(media_type, []).append(media_item)
+        if node_index:
+            index[str(node_id)] = node_index
+    return index
+
+
+def select_media_outputs(output_index, target_nodes=None, media_key="images"):
+    """Pick the media list of the requested kind, preferring the target nodes."""
+    preferences = MEDIA_KEY_PREFERENCES.get(media_key, (media_key,) + MEDIA_TYPES)
+    target_nodes = [str(node_id) for node_id in (target_nodes or [])]
+    other_nodes = [node_id for node_id in output_index if node_id not in target_nodes]
+    for node_id in target_nodes:
+        node_index = output_index.get(node_id, {})
+        for media_type in preferences:
+            if node_index.get(media_type):
+                return node_index[media_type]
+    for node_id in other_nodes:
+        node_index = output_index[node_id]
+        for media_type in preferences:
+            if node_index.get(media_type):
+                print(f"[INFO] Found {media_type} in node {node_id} (not in target_nodes)")
+                return node_index[media_type]
+    return None
+
+
+def get_history_entry(prompt_id, mode='generate'):
+    """Fetch the /history entry of a single prompt; None while it is not in history yet."""
+    response = comfy_get(f"/history/{prompt_id}", mode=mode)
+    if response.status_code != 200:
+        return None
+    history_data = response.json()
+    if isinstance(history_data, dict):
+        if isinstance(history_data.get(prompt_id), dict):
+            return history_data[prompt_id]
+        if "outputs" in history_data:
+            return history_data
+    return None
+
+def extract_media_outputs(history_entry, target_nodes=None, media_key="images"):
+    """Extract the generated files from an already fetched /history entry."""
     target_nodes = target_nodes or ["19"]
-    comfy_url = get_comfy_url(mode)
-    print(f"[DEBUG] get_media_outputs called: prompt_id={prompt_id}, target_nodes={target_nodes}, media_key={media_key}, mode={mode}")
-    
-    possible_keys = [media_key]
-    if media_key == "videos":
-        # VHS_VideoCombine puede usar diferentes claves
-        possible_keys.extend(["video", "videos", "files", "images", "mp4", "output"])
-    elif media_key == "images":
-        possible_keys.extend(["image", "images", "files"])
-    else:
-        possible_keys.extend(["videos", "images", "files", "video", "image"])
-    
+    output_index = index_history_outputs(history_entry)
+    media = select_media_outputs(output_index, target_nodes=target_nodes, media_key=media_key)
+    if media:
+        print(f"[OK] {len(media)} {media_key} item(s) found in history outputs")
+    return media
+
+def get_media_outputs(prompt_id, target_nodes=None, media_key="images", mode='generate'):
+    """Get the generated files (images, videos, etc.) of one prompt_id.
+
+    Only /history/{prompt_id} is fetched; the full /history is never downloaded.
+    """
     try:
-        # Intentar primero el endpoint específico /history/{prompt_id}
-        try:
-            response = requests.get(
-                f"{comfy_url}/history/{prompt_id}",
-                headers=build_comfy_headers()
-            )
-            if response.status_code == 200:
-                history_data = response.json()
-
-                candidates = []
-                if isinstance(history_data, dict):
-                    if "outputs" in history_data:
-                        candidates.append(history_data)
-                    if prompt_id in history_data and isinstance(history_data[prompt_id], dict):
-                        candidates.append(history_data[prompt_id])
-
-                for candidate in candidates:
-                    if "outputs" not in candidate:
-                        continue
-                    # Primero buscar en los nodos target específicos
-                    for node_id in target_nodes:
-                        if node_id in candidate["outputs"]:
-                            node_outputs = candidate["outputs"][node_id]
-                            print(f"[DEBUG] Node {node_id} outputs keys: {list(node_outputs.keys())}")
-                            try:
-                                print(f"[DEBUG] Node {node_id} outputs full structure: {json.dumps(node_outputs, indent=2, default=str)[:500]}")
-                            except Exception as e:
-                                print(f"[DEBUG] Node {node_id} outputs structure (could not serialize): {str(node_outputs)[:500]}")
-                            
-                            # Buscar en todas las claves posibles
-                            for key in possible_keys:
-                                if key in node_outputs:
-                                    media = node_outputs[key]
-                                    count = len(media) if isinstance(media, list) else 1
-                                    print(f"[OK] {key.capitalize()} found in node {node_id}: {count} item(s)")
-                                    if isinstance(media, list):
-                                        return media
-                                    return [media]
-                            
-                            # Si no encontramos en las claves esperadas, buscar cualquier lista que parezca un archivo de video
-                            for key, value in node_outputs.items():
-                                if isinstance(value, list) and len(value) > 0:
-                                    first_item = value[0]
-                                    if isinstance(first_item, dict):
-                                        filename = first_item.get("filename", "")
-                                        if any(ext in filename.lower() for ext in [".mp4", ".webm", ".avi", ".mov"]):
-                                            print(f"[INFO] Found video-like files in node {node_id}, key '{key}': {len(value)} item(s)")
-                                            return value
-                                    elif isinstance(first_item, str) and any(ext in first_item.lower() for ext in [".mp4", ".webm", ".avi", ".mov"]):
-                                        print(f"[INFO] Found video-like files in node {node_id}, key '{key}': {len(value)} item(s)")
-                                        return value
-                    
-                    # Si no se encontró en los nodos target, buscar en TODOS los nodos
-                    for node_id, node_outputs in candidate["outputs"].items():
-                        if isinstance(node_outputs, dict):
-                            print(f"[DEBUG] Checking all nodes in candidate - Node {node_id} outputs keys: {list(node_outputs.keys())}")
-                            
-                            # Buscar en claves esperadas
-                            for key in possible_keys:
-                                if key in node_outputs:
-                                    media = node_outputs[key]
-                                    count = len(media) if isinstance(media, list) else 1
-                                    print(f"[INFO] Found {key.capitalize()} in node {node_id} (not in target_nodes): {count}")
-                                    if isinstance(media, list):
-                                        return media
-                                    return [media]
-                            
-                            # Buscar cualquier lista que parezca contener videos
-                            for data_key, data_value in node_outputs.items():
-                                if isinstance(data_value, list) and len(data_value) > 0:
-                                    first_item = data_value[0]
-                                    if isinstance(first_item, dict):
-                                        filename = first_item.get("filename", "")
-                                        if any(ext in filename.lower() for ext in [".mp4", ".webm", ".avi", ".mov"]):
-                                            print(f"[INFO] Found video-like files in node {node_id}, key '{data_key}' (all nodes in candidate): {len(data_value)} item(s)")
-                                            return data_value
-                                    elif isinstance(first_item, str) and any(ext in first_item.lower() for ext in [".mp4", ".webm", ".avi", ".mov"]):
-                                        print(f"[INFO] Found video-like files in node {node_id}, key '{data_key}' (all nodes in candidate): {len(data_value)} item(s)")
-                                        return data_value
-
-        except requests.exceptions.RequestException as e:
-            print(f"[WARN] Endpoint /history/{prompt_id} not available (status: {getattr(e.response, 'status_code', 'N/A')}), using fallback")
-
-        # Fallback: obtener el historial completo y buscar el prompt_id
-        response = requests.get(
-            f"{comfy_url}/history",
-            headers=build_comfy_headers()
-        )
-        if response.status_code == 200:
-            history = response.json()
-            if prompt_id in history:
-                prompt_data = history[prompt_id]
-                if "outputs" in prompt_data:
-                    for node_id in target_nodes:
-                        if node_id in prompt_data["outputs"]:
-                            node_outputs = prompt_data["outputs"][node_id]
-                            print(f"[DEBUG] Node {node_id} outputs keys: {list(node_outputs.keys())}")
-                            try:
-                                print(f"[DEBUG] Node {node_id} outputs full structure: {json.dumps(node_outputs, indent=2, default=str)[:500]}")
-                            except Exception as e:
-                                print(f"[DEBUG] Node {node_id} outputs structure (could not serialize): {str(node_outputs)[:500]}")
-                            
-                            # Buscar en todas las claves posibles
-                            for key in possible_keys:
-                                if key in node_outputs:
-                                    media = node_outputs[key]
-                                    count = len(media) if isinstance(media, list) else 1
-                                    print(f"[OK] {key.capitalize()} found in node {node_id} (full history): {count} item(s)")
-                                    if isinstance(media, list):
-                                        print(f"  Filenames: {[item.get('filename', str(item)) if isinstance(item, dict) else item for item in media[:4]]}")
-                                        return media
-                                    print(f"  Filename: {media.get('filename', str(media)) if isinstance(media, dict) else media}")
-                                    return [media]
-                            
-                            # Si no encontramos en las claves esperadas, buscar cualquier lista que parezca un archivo de video
-                            for key, value in node_outputs.items():
-                                if isinstance(value, list) and len(value) > 0:
-                                    first_item = value[0]
-                                    if isinstance(first_item, dict):
-                                        filename = first_item.get("filename", "")
-                                        if any(ext in filename.lower() for ext in [".mp4", ".webm", ".avi", ".mov"]):
-                                            print(f"[INFO] Found video-like files in node {node_id}, key '{key}' (full history): {len(value)} item(s)")
-                                            return value
-                                    elif isinstance(first_item, str) and any(ext in first_item.lower() for ext in [".mp4", ".webm", ".avi", ".mov"]):
-                                        print(f"[INFO] Found video-like files in node {node_id}, key '{key}' (full history): {len(value)} item(s)")
-                                        return value
-
-            # Buscar en toda la estructura como último recurso
-            for key, value in history.items():
-                if key == prompt_id and isinstance(value, dict) and "outputs" in value:
-                    for node_id, node_data in value.get("outputs", {}).items():
-                        if node_id in target_nodes:
-                            print(f"[DEBUG] Node {node_id} (fallback) outputs keys: {list(node_data.keys())}")
-                            for media_key_candidate in possible_keys:
-                                if media_key_candidate in node_data:
-                                    media = node_data[media_key_candidate]
-                                    if isinstance(media, list):
-                                        return media
-                                    return [media]
-            
-            # Si no se encontró en los nodos target, buscar en TODOS los nodos que tengan outputs
-            for key, value in history.items():
-                if key == prompt_id and isinstance(value, dict) and "outputs" in value:
-                    for node_id, node_data in value.get("outputs", {}).items():
-                        if isinstance(node_data, dict):
-                            print(f"[DEBUG] Checking all nodes - Node {node_id} outputs keys: {list(node_data.keys())}")
-                            
-                            # Buscar en claves esperadas
-                            for media_key_candidate in possible_keys:
-                                if media_key_candidate in node_data:
-                                    media = node_data[media_key_candidate]
-                                    print(f"[INFO] Found {media_key_candidate} in node {node_id} (not in target_nodes)")
-                                    if isinstance(media, list):
-                                        return media
-                                    return [media]
-                            
-                            # Buscar cualquier lista que parezca contener videos
-                            for data_key, data_value in node_data.items():
-                                if isinstance(data_value, list) and len(data_value) > 0:
-                                    first_item = data_value[0]
-                                    if isinstance(first_item, dict):
-                                        filename = first_item.get("filename", "")
-                                        if any(ext in filename.lower() for ext in [".mp4", ".webm", ".avi", ".mov"]):
-                                            print(f"[INFO] Found video-like files in node {node_id}, key '{data_key}' (all nodes search): {len(data_value)} item(s)")
-                                            return data_value
-                                    elif isinstance(first_item, str) and any(ext in first_item.lower() for ext in [".mp4", ".webm", ".avi", ".mov"]):
-                                        print(f"[INFO] Found video-like files in node {node_id}, key '{data_key}' (all nodes search): {len(data_value)} item(s)")
-                                        return data_value
+        history_entry = get_history_entry(prompt_id, mode=mode)
+    except requests.exceptions.RequestException as e:
+        print(f"[WARN] Endpoint /history/{prompt_id} not available: {e}")
         return None
-    except Exception as e:
-        print(f"Error getting history for prompt_id {prompt_id}: {e}")
-        import traceback
-        traceback.print_exc()
+    if history_entry is None:
         return None
+    return extract_media_outputs(history_entry, target_nodes=target_nodes, media_key=media_key)
 
-def wait_for_completion(client_id, prompt_id, max_wait=300, target_nodes=None, media_key="images", mode='generate'):
-    """Esperar a que se complete la generación y obtener los archivos solicitados"""
-    target_nodes = target_nodes or ["19"]
-    print(f"[INFO] wait_for_completion: prompt_id={prompt_id}, target_nodes={target_nodes}, media_key={media_key}, max_wait={max_wait}")
-    media_items = []
-    execution_completed = False
-    
-    def on_message(ws, message):
-        nonlocal execution_completed
-        if message:
-            try:
-                data = json.loads(message)
-                if data.get("type") == "executed":
-                    node_id = data.get("data", {}).get("node")
-                    if node_id and node_id in target_nodes:
-                        execution_completed = True
-                elif data.get("type") == "execution_cached":
-                    execution_completed = True
-                elif data.get("type") == "executing":
-                    if not data.get("data", {}).get("node"):
-                        execution_completed = True
-            except Exception as e:
-                print(f"Error procesando mensaje WebSocket: {e}")
-    
-    def on_error(ws, error):
-        print(f"WebSocket error: {error}")
-    
-    def on_close(ws, close_status_code, close_msg):
-        pass
-    
-    def on_open(ws):
-        pass
-    
-    # Intentar conectar via WebSocket
-    ws = None
+def _normalize_media_items(media_info):
+    """Reduce media items to filename/subfolder/type."""
+    valid_media = []
+    for item in media_info or []:
+        if isinstance(item, dict):
+            valid_media.append({
+                "filename": item.get("filename", ""),
+                "subfolder": item.get("subfolder", ""),
+                "type": item.get("type", "output")
+            })
+        elif isinstance(item, str):
+            valid_media.append({
+                "filename": item,
+                "subfolder": "",
+                "type": "output"
+            })
+    return valid_media
+
+def _fetch_history_entry_safe(prompt_id, mode):
     try:
-        if COMFYUI_PORT == 443 and WS_PROTOCOL == "wss":
-            ws_url = f"{WS_PROTOCOL}://{COMFYUI_HOST}/ws?clientId={client_id}"
-        else:
-            ws_url = f"{WS_PROTOCOL}://{COMFYUI_HOST}:{COMFYUI_PORT}/ws?clientId={client_id}"
-
-        modal_headers = build_comfy_headers()
-        ws_header = [f"{key}: {value}" for key, value in modal_headers.items()] if modal_headers else None
-        ws = websocket.WebSocketApp(
-            ws_url,
-            on_message=on_message,
-            on_error=on_error,
-            on_close=on_close,
-            on_open=on_open,
-            header=ws_header
-        )
-        
-        def run_ws():
-            try:
-                ws.run_forever()
-            except Exception as e:
-                print(f"Error en WebSocket: {e}")
-        
-        thread = threading.Thread(target=run_ws, daemon=True)
-        thread.start()
-        time.sleep(1)
-    except Exception as e:
-        print(f"Error al conectar WebSocket: {e}")
-    
-    # Esperar hasta que se complete o timeout
+        return get_history_entry(prompt_id, mode=mode)
+    except requests.exceptions.RequestException as e:
+        print(f"[WARN] Could not fetch /history/{prompt_id}: {e}")
+        return None
+
+# Longest wait when no request deadline is active
+DEFAULT_MAX_WAIT = 300
+
+
+def wait_for_completion(client_id, prompt_id, max_wait=None, target_nodes=None, media_key="images", mode='generate'):
+    """Wait for the generation to finish and fetch the requested files.
+
+    Completion is driven by the backend WebSocket; /history is fetched once the
+    prompt finishes. Polling only runs as a fallback with exponential backoff,
+    in case the socket is down or an event was missed. The wait never outlives
+    the request deadline of the thread; without one it lasts at most max_wait
+    (default: DEFAULT_MAX_WAIT).
+
+    Raises:
+        ComfyExecutionError: as soon as the backend reports execution_error or
+            execution_interrupted, or history shows status_str == "error".
+        JobCancelled: as soon as the job or prompt is cancelled through cancel_generation.
+        BackendUnavailableError: when the backend's circuit opens while waiting
+            (its /history stops answering), instead of waiting up to max_wait.
+        DeadlineExceeded: when the request deadline passes before the prompt finishes.
+    """
+    deadline = get_current_deadline()
+    if max_wait is None:
+        max_wait = deadline.remaining() if deadline is not None else DEFAULT_MAX_WAIT
+    elif deadline is not None:
+        max_wait = min(max_wait, deadline.remaining())
+    target_nodes = target_nodes or ["19"]
+    print(f"[INFO] wait_for_completion: prompt_id={prompt_id}, target_nodes={target_nodes}, media_key={media_key}, max_wait={max_wait:.0f}s")
+    listener = get_ws_listener(mode)
+    waiter = listener.register(prompt_id)
     start_time = time.time()
-    check_interval = 0.5
-    last_check = 0
-    prompt_found_in_history = False
-    consecutive_no_outputs = 0
-    max_consecutive_no_outputs = 10
-    
-    # Primera verificación inmediata
-    media_info = get_media_outputs(prompt_id, target_nodes=target_nodes, media_key=media_key, mode=mode)
-    if media_info and len(media_info) > 0:
-        valid_media = []
-        for item in media_info:
-            if isinstance(item, dict):
-                valid_media.append({
-                    "filename": item.get("filename", ""),
-                    "subfolder": item.get("subfolder", ""),
-                    "type": item.get("type", "output")
-                })
-            elif isinstance(item, str):
-                valid_media.append({
-                    "filename": item,
-                    "subfolder": "",
-                    "type": "output"
-                })
-
-        if valid_media:
-            print(f"[OK] {media_key.capitalize()} found immediately, returning {len(valid_media)} item(s)")
-            if ws:
-                try:
-                    ws.close()
-                except:
-                    pass
-            return valid_media
-    
-    # Verificar si el prompt ya existe en el historial
-    comfy_url = get_comfy_url(mode)
+    poll_interval = COMFY_POLL_INITIAL_INTERVAL
+    base_url = get_comfy_url(mode)
+    # A prompt executing far longer than its history predicts is treated as stuck
+    execution_limit = prompt_execution_timeout(mode, base_url)
+
+    # WebSocket callbacks run on the listener thread, so bind the job explicitly
+    current_job = get_current_job()
+
+    def report_progress(event_waiter, event_type):
+        if event_type in ("execution_start", "executing", "execution_cached", "progress"):
+            if current_job.stage != 'executing':
+                current_job.update(stage='executing')
+        if event_type == "progress" and event_waiter.progress:
+            value = event_waiter.progress.get("value") or 0
+            maximum = event_waiter.progress.get("max") or 0
+            if maximum:
+                current_job.update(progress=round(value / maximum, 3))
+
+    if current_job is not None:
+        # Everything needed to reattach to this prompt after a restart
+        current_job.update(
+            prompt_id=prompt_id,
+            stage='waiting',
+            backend_url=base_url,
+            target_nodes=list(target_nodes) if target_nodes else None,
+            media_key=media_key,
+        )
+        waiter.add_callback(report_progress)
+
     try:
-        response = requests.get(
-            f"{comfy_url}/history/{prompt_id}",
-            headers=build_comfy_headers()
+        if current_job is not None and current_job.cancel_requested:
+            # Cancelled between queueing and this point, before anyone knew the prompt_id
+            cancel_prompt(prompt_id, mode=mode, base_url=base_url)
+            raise JobCancelled(current_job.id, prompt_id)
+
+        # ComfyUI only writes a prompt to history once it finished, so one
+        # immediate check covers prompts that completed before registration
+        history_entry = _fetch_history_entry_safe(prompt_id, mode)
+
+        while history_entry is None:
+            remaining = max_wait - (time.time() - start_time)
+            if remaining <= 0:
+                print(f"[WARN] Timed out after {max_wait:.0f}s waiting for prompt {prompt_id}")
+                if deadline is not None and deadline.expired:
+                    raise DeadlineExceeded(deadline.budget, stage=f"waiting for prompt {prompt_id}")
+                return []
+
+            if execution_limit and waiter.started_at and not waiter.done.is_set() \
+                    and time.time() - waiter.started_at > execution_limit:
+                print(f"[WARN] Prompt {prompt_id} has been executing for over {execution_limit:.0f}s, "
+                      f"far longer than expected; interrupting it")
+                try:
+                    cancel_prompt(prompt_id, mode=mode, base_url=base_url)
+                except Exception as e:
+                    print(f"[WARN] Could not interrupt prompt {prompt_id}: {e}")
+                raise DeadlineExceeded(execution_limit, stage=f"executing prompt {prompt_id} (adaptive timeout)")
+
+            if waiter.done.is_set():
+                if waiter.status == 'cancelled':
+                    print(f"[COMFY] Stopped waiting for cancelled prompt {prompt_id}")
+                    raise JobCancelled(current_job.id if current_job else None, prompt_id)
+                execution_error = execution_error_from_waiter(waiter)
+                if execution_error:
+                    print(f"[ERROR] {execution_error}")
+                    raise execution_error
+                # History is stored right after the final event; retry briefly
+                settle_delay = 0.1
+                settle_deadline = time.time() + min(COMFY_HISTORY_SETTLE_TIMEOUT, remaining)
+                history_entry = _fetch_history_entry_safe(prompt_id, mode)
+                while history_entry is None and time.time() < settle_deadline:
+                    time.sleep(settle_delay)
+                    history_entry = _fetch_history_entry_safe(prompt_id, mode)
+                    settle_delay = min(settle_delay * 2, 1.0)
+                if history_entry is None:
+                    print(f"[WARN] Prompt {prompt_id} finished ({waiter.status}) but is not in history")
+                    return []
+                break
+
+            # Sleep until an event arrives or the fallback poll is due
+            if waiter.wait(min(poll_interval, remaining)):
+                continue
+            history_entry = _fetch_history_entry_safe(prompt_id, mode)
+            poll_interval = min(poll_interval * 2, COMFY_POLL_MAX_INTERVAL)
+
+        execution_error = execution_error_from_history(prompt_id, history_entry)
+        if execution_error:
+            print(f"[ERROR] {execution_error}")
+            raise execution_error
+        if waiter.started_at:
+            # Queue wait and execution time feed the cost model (ETAs, timeouts, SEJF)
+            record_generation(mode, base_url, waiter.started_at - start_time, time.time() - waiter.started_at)
+
+        media_items = _normalize_media_items(
+            extract_media_outputs(history_entry, target_nodes=target_nodes, media_key=media_key)
         )
-        if response.status_code == 200:
-            history_data = response.json()
-            if prompt_id in history_data or "outputs" in history_data:
-                prompt_found_in_history = True
-                print(f"[INFO] Prompt {prompt_id} already exists in history")
-    except:
-        pass
-    
-    while time.time() - start_time < max_wait:
-        if time.time() - last_check >= check_interval:
-            comfy_url = get_comfy_url(mode)
-            try:
-                response = requests.get(
-                    f"{comfy_url}/history/{prompt_id}",
-                    headers=build_comfy_headers()
-                )
-                if response.status_code == 200:
-                    history_data = response.json()
-                    if prompt_id in history_data or "outputs" in history_data:
-                        prompt_found_in_history = True
-            except:
-                pass
-            
-            media_info = get_media_outputs(prompt_id, target_nodes=target_nodes, media_key=media_key, mode=mode)
-            if media_info and len(media_info) > 0:
-                consecutive_no_outputs = 0
-                valid_media = []
-                for item in media_info:
-                    if isinstance(item, dict):
-                        valid_media.append({
-                            "filename": item.get("filename", ""),
-                            "subfolder": item.get("subfolder", ""),
-                            "type": item.get("type", "output")
-                        })
-                    elif isinstance(item, str):
-                        valid_media.append({
-                            "filename": item,
-                            "subfolder": "",
-                            "type": "output"
-                        })
-
-                if valid_media:
-                    media_items = valid_media
-                    if len(media_items) >= 1:
-                        break
-                    if execution_completed:
-                        break
-            else:
-                if prompt_found_in_history:
-                    consecutive_no_outputs += 1
-                    if consecutive_no_outputs >= max_consecutive_no_outputs:
-                        print(f"[WARN] Prompt {prompt_id} exists in history but no {media_key} found after {max_consecutive_no_outputs} checks. Exiting wait loop.")
-                        break
-            last_check = time.time()
-        
-        if execution_completed:
-            time.sleep(2)
-            media_info = get_media_outputs(prompt_id, target_nodes=target_nodes, media_key=media_key, mode=mode)
-            if media_info and len(media_info) > 0:
-                valid_media = []
-                for item in media_info:
-                    if isinstance(item, dict):
-                        valid_media.append({
-                            "filename": item.get("filename", ""),
-                            "subfolder": item.get("subfolder", ""),
-                            "type": item.get("type", "output")
-                        })
-                    elif isinstance(item, str):
-                        valid_media.append({
-                            "filename": item,
-                            "subfolder": "",
-                            "type": "output"
-                        })
-                if valid_media:
-                    media_items = valid_media
-                    break
-        
-        time.sleep(0.5)
-    
-    if ws:
+        if not media_items:
+            print(f"[WARN] Prompt {prompt_id} completed but no {media_key} were found in its outputs")
+        return media_items
+    finally:
+        waiter.remove_callback(report_progress)
+        listener.release(prompt_id)
+        # The prompt left the backend: let the next waiting prompt in
+        release_dispatch_slot(mode)
+
+
+def _backend_queue_ids(base_url, mode):
+    """prompt_ids running and pending on one backend."""
+    response = comfy_get("/queue", mode=mode, base_url=base_url, timeout=5)
+    response.raise_for_status()
+    queue = response.json()
+
+    def ids(items):
+        return {item[1] for item in items or [] if isinstance(item, (list, tuple)) and len(item) > 1}
+
+    return ids(queue.get("queue_running")), ids(queue.get("queue_pending"))
+
+
+def _post_control(path, payload, base_url, mode):
+    response = comfy_post(path, mode=mode, base_url=base_url, json=payload, timeout=5)
+    if response.status_code not in (200, 204):
+        raise Exception(f"POST {path} failed: HTTP {response.status_code} - {response.text}")
+
+
+def cancel_prompt(prompt_id, mode='generate', base_url=None):
+    """Cancel a single prompt on its backend without touching other users' prompts.
+
+    A pending prompt is deleted from the backend queue; an interrupt is only
+    sent while this exact prompt is the one executing. Without base_url every
+    backend of the mode is checked; one that cannot be reached (or has an open
+    circuit) is logged and skipped, and the error is only raised when no
+    backend could be checked at all.
+
+    Returns:
+        'dequeued', 'interrupted' or 'not_found' (already finished or unknown)
+    """
+    urls = [base_url] if base_url else [url for url in get_comfy_urls(mode) if url]
+    checked, last_error = 0, None
+    for url in urls:
         try:
-            ws.close()
-        except:
-            pass
-    
-    if not media_items:
-        time.sleep(2)
-        media_info = get_media_outputs(prompt_id, target_nodes=target_nodes, media_key=media_key, mode=mode)
-        if media_info:
-            if isinstance(media_info, list):
-                media_items = media_info
-            else:
-                media_items = [media_info]
+            action = _cancel_on_backend(prompt_id, url, mode)
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            print(f"[COMFY] Could not check {url} for prompt {prompt_id}: {e}")
+            last_error = e
+            continue
+        checked += 1
+        if action:
+            print(f"[COMFY] Prompt {prompt_id} {action} on {url}")
+            return action
+    if not checked and last_error is not None:
+        raise last_error
+    return 'not_found'
 
-    return media_items
 
+def _cancel_on_backend(prompt_id, url, mode):
+    """Dequeue or interrupt a prompt on one backend; None when it is not there."""
+    running, pending = _backend_queue_ids(url, mode)
+    action = None
+    if prompt_id in pending:
+        _post_control("/queue", {"delete": [prompt_id]}, url, mode)
+        action = 'dequeued'
+        # It may have started in between, and deleting a running prompt does nothing
+        running, pending = _backend_queue_ids(url, mode)
+    if prompt_id in running:
+        # The prompt_id makes ComfyUI ignore the interrupt if another prompt started meanwhile
+        _post_control("/interrupt", {"prompt_id": prompt_id}, url, mode)
+        action = 'interrupted'
+    return action
 
-def interrupt_comfy_execution(mode='generate'):
-    """Enviar señal de interrupción a ComfyUI para detener la ejecución actual."""
-    comfy_url = get_comfy_url(mode)
-    try:
-        response = requests.post(
-            f"{comfy_url}/queue/interrupt",
-            headers=build_comfy_headers(),
-            timeout=5
-        )
-        if response.status_code not in (200, 204):
-            raise Exception(f"Interrupt failed: HTTP {response.status_code} - {response.text}")
-        return True
-    except Exception as exc:
-        print(f"[COMFY] Error interrupting execution: {exc}")
-        raise
+
+def cancel_generation(job_or_prompt_id, mode='generate', reason=None):
+    """Cancel a job (or a standalone prompt) by its id.
+
+    The thread waiting on the prompt is released first, so it reports a
+    cancellation rather than an interruption; then the prompt is removed from
+    its backend's queue or interrupted if it is the one running.
+
+    Returns:
+        dict with job_id, prompt_id and action ('dequeued', 'interrupted',
+        'cancelled' for a job that had not queued its prompt yet, 'finished'
+        or 'not_found'), or None if the id is unknown
+    """
+    job = get_job(job_or_prompt_id)
+    if job is not None:
+        if job.is_finished:
+            return {"job_id": job.id, "prompt_id": job.prompt_id, "action": "finished", "state": job.state}
+        mode = job.mode
+        request_job_cancel(job, reason=reason)
+    prompt_id = job.prompt_id if job is not None else job_or_prompt_id
+    base_url = job.backend_url if job is not None else None
+
+    action = 'cancelled' if job is not None else 'not_found'
+    if prompt_id:
+        for url in ([base_url] if base_url else get_comfy_urls(mode)):
+            if url:
+                get_ws_listener(mode, base_url=url).cancel(prompt_id)
+        backend_action = cancel_prompt(prompt_id, mode=mode, base_url=base_url)
+        if backend_action != 'not_found':
+            action = backend_action
+    if job is None and action == 'not_found':
+        return None
+    return {"job_id": job.id if job is not None else None, "prompt_id": prompt_id, "action": action}
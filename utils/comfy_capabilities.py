@@ -0,0 +1,97 @@
+"""
+Backend capability profiles
+Summarizes what each ComfyUI backend can run (installed node classes and the
+model files its loaders offer) from the cached /object_info, and maps every
+registered workflow to the healthy backends able to run it
+"""
+from utils.comfy_schema import get_object_info, missing_capabilities
+from utils.comfy_pool import backend_pool, MODES
+from utils.comfy_health import get_breaker
+from utils.workflow import workflow_registry
+
+# Model lists reported in a profile: kind -> (loader class, input)
+MODEL_LIST_INPUTS = {
+    "checkpoints": ("CheckpointLoaderSimple", "ckpt_name"),
+    "unets": ("UNETLoader", "unet_name"),
+    "clips": ("CLIPLoader", "clip_name"),
+    "vaes": ("VAELoader", "vae_name"),
+    "loras": ("LoraLoader", "lora_name"),
+}
+
+
+def _loader_options(object_info, class_type, input_name):
+    spec = (((object_info.get(class_type) or {}).get("input") or {}).get("required") or {}).get(input_name)
+    if not isinstance(spec, (list, tuple)) or not spec:
+        return []
+    if isinstance(spec[0], list):
+        return list(spec[0])
+    if len(spec) > 1 and isinstance(spec[1], dict) and isinstance(spec[1].get("options"), list):
+        return list(spec[1]["options"])
+    return []
+
+
+def build_profile(object_info):
+    """Capability profile of a backend from its /object_info."""
+    return {
+        "node_classes": len(object_info),
+        "models": {
+            kind: _loader_options(object_info, class_type, input_name)
+            for kind, (class_type, input_name) in MODEL_LIST_INPUTS.items()
+        },
+    }
+
+
+def _describe_missing(error):
+    if error["type"] == "missing_node_type":
+        return f"node:{error.get('class_type')}"
+    return f"{error.get('input')}:{error.get('value')}"
+
+
+def get_capabilities():
+    """Profiles of every backend and, per registered workflow, which backends can run it.
+
+    Only healthy backends count: a backend that is unreachable, whose circuit
+    is open or whose /object_info cannot be fetched is reported without a
+    profile and serves no workflow until it answers again.
+    """
+    backends = {}
+    workflows = {}
+    modes = {}
+    for mode in MODES:
+        states = backend_pool.backends(mode)
+        schemas = {}
+        for state in states:
+            circuit = get_breaker(state.url).to_dict()
+            healthy = state.reachable is not False and circuit["state"] != "open"
+            object_info = get_object_info(base_url=state.url) if healthy else None
+            schemas[state.name] = object_info
+            backends[state.name] = {
+                "mode": mode,
+                "reachable": state.reachable,
+                "circuit": circuit["state"],
+                "profile": build_profile(object_info) if object_info else None,
+            }
+
+        modes[mode] = False
+        for name in workflow_registry.names(mode):
+            entry = {"mode": mode, "backends": [], "missing": {}}
+            try:
+                template = workflow_registry.get(name)
+            except Exception as e:
+                entry.update(available=False, error=str(e))
+                workflows[name] = entry
+                continue
+            for state in states:
+                object_info = schemas[state.name]
+                if not object_info:
+                    entry["missing"][state.name] = ["unreachable"]
+                    continue
+                missing = missing_capabilities(template.workflow, object_info)
+                if missing:
+                    entry["missing"][state.name] = sorted({_describe_missing(error) for error in missing})
+                else:
+                    entry["backends"].append(state.name)
+            entry["available"] = bool(entry["backends"])
+            modes[mode] = modes[mode] or entry["available"]
+            workflows[name] = entry
+    return {"backends": backends, "workflows": workflows, "modes": modes}
@@ -1,9 +1,11 @@
 """
 ComfyUI configuration and URL management
 Supports three separate endpoints: Generate, Edit, Video
+Each endpoint may be a pool of backends (comma-separated URLs)
 """
 import os
 import json
+import threading
 from urllib.parse import urlparse
 
 # Load default configuration from defaults.json
@@ -44,25 +46,44 @@ def normalize_comfy_url(url_value: str, default_host='127.0.0.1', default_port=8
     
     return normalized.rstrip('/')
 
-# Inicializar tres endpoints separados
-# Prioridad: Variable de entorno > defaults.json > valores hardcodeados
-COMFYUI_URL_GENERATE = normalize_comfy_url(
+def parse_comfy_urls(value, default_port=8188):
+    """Parse one endpoint or a pool of endpoints (list or comma-separated string)."""
+    if isinstance(value, (list, tuple)):
+        items = [str(item) for item in value]
+    else:
+        items = str(value or '').split(',')
+    urls = []
+    for item in items:
+        if item.strip():
+            url = normalize_comfy_url(item, default_port=default_port)
+            if url not in urls:
+                urls.append(url)
+    return urls or [normalize_comfy_url('', default_port=default_port)]
+
+# Three separate endpoints (each one may be a pool of backends)
+# Priority: environment variable > defaults.json > hardcoded values
+COMFYUI_URLS_GENERATE = parse_comfy_urls(
     os.environ.get('COMFYUI_URL_GENERATE', '').strip() or get_default('comfyui.endpoints.generate', ''),
     default_port=8188
 )
-COMFYUI_URL_EDIT = normalize_comfy_url(
+COMFYUI_URLS_EDIT = parse_comfy_urls(
     os.environ.get('COMFYUI_URL_EDIT', '').strip() or 
     os.environ.get('COMFYUI_URL', '').strip() or 
     get_default('comfyui.endpoints.edit', ''),
     default_port=8189
 )
-COMFYUI_URL_VIDEO = normalize_comfy_url(
+COMFYUI_URLS_VIDEO = parse_comfy_urls(
     os.environ.get('COMFYUI_URL_VIDEO', '').strip() or 
     os.environ.get('COMFYUI_URL', '').strip() or 
     get_default('comfyui.endpoints.video', ''),
     default_port=8190
 )
 
+# First backend of each pool (used when no backend is pinned for the request)
+COMFYUI_URL_GENERATE = COMFYUI_URLS_GENERATE[0]
+COMFYUI_URL_EDIT = COMFYUI_URLS_EDIT[0]
+COMFYUI_URL_VIDEO = COMFYUI_URLS_VIDEO[0]
+
 # Mantener COMFYUI_URL para compatibilidad hacia atrás (usa el endpoint de Generate)
 COMFYUI_URL = COMFYUI_URL_GENERATE
 
@@ -92,19 +113,79 @@ def build_comfy_headers(extra_headers=None):
         headers.update(extra_headers)
     return headers
 
-def get_comfy_url(mode='generate'):
-    """Obtener la URL de ComfyUI según el modo de operación."""
-    mode_lower = mode.lower()
+def normalize_mode(mode='generate'):
+    """Normalize a mode alias to one of 'generate', 'edit' or 'video'."""
+    mode_lower = (mode or 'generate').lower()
     if mode_lower in ['edit', 'editing']:
-        return COMFYUI_URL_EDIT
+        return 'edit'
     elif mode_lower in ['video', 'videos']:
-        return COMFYUI_URL_VIDEO
+        return 'video'
     else:  # 'generate', 'generation', default
+        return 'generate'
+
+# Backend pinned per thread and mode: while a generation is in progress, all of its
+# calls (uploads, /prompt, WebSocket, /history, /view) go to the same backend
+_pinned_backends = threading.local()
+
+# Hook of the backend pool that picks a backend on demand (see utils/comfy_pool.py)
+_backend_resolver = None
+
+def set_backend_resolver(resolver):
+    """Register resolver(mode) -> URL or None, consulted when no backend is pinned."""
+    global _backend_resolver
+    _backend_resolver = resolver
+
+def get_pinned_backend(mode='generate'):
+    """Backend pinned for the mode on the current thread, or None."""
+    pins = getattr(_pinned_backends, 'pins', None)
+    return pins.get(normalize_mode(mode)) if pins else None
+
+def set_pinned_backend(mode, url):
+    """Pin (or release with None) the backend of the mode on the current thread."""
+    pins = getattr(_pinned_backends, 'pins', None)
+    if pins is None:
+        pins = _pinned_backends.pins = {}
+    mode_key = normalize_mode(mode)
+    if url:
+        pins[mode_key] = url.rstrip('/')
+    else:
+        pins.pop(mode_key, None)
+
+def get_comfy_urls(mode='generate'):
+    """All backends configured for a mode."""
+    mode_key = normalize_mode(mode)
+    if mode_key == 'edit':
+        return list(COMFYUI_URLS_EDIT)
+    elif mode_key == 'video':
+        return list(COMFYUI_URLS_VIDEO)
+    else:
+        return list(COMFYUI_URLS_GENERATE)
+
+def get_comfy_url(mode='generate'):
+    """ComfyUI URL of an operation mode.
+
+    Returns the backend pinned for the current thread if there is one, then the
+    pool's choice, and otherwise the first backend of the mode.
+    """
+    pinned = get_pinned_backend(mode)
+    if pinned:
+        return pinned
+    if _backend_resolver is not None:
+        resolved = _backend_resolver(mode)
+        if resolved:
+            return resolved
+    mode_key = normalize_mode(mode)
+    if mode_key == 'edit':
+        return COMFYUI_URL_EDIT
+    elif mode_key == 'video':
+        return COMFYUI_URL_VIDEO
+    else:
         return COMFYUI_URL_GENERATE
 
 def update_comfy_endpoint(endpoint_type, url):
     """Actualizar un endpoint de ComfyUI dinámicamente. Acepta cualquier valor tal cual viene, sin validar."""
     global COMFYUI_URL_GENERATE, COMFYUI_URL_EDIT, COMFYUI_URL_VIDEO, COMFYUI_URL
+    global COMFYUI_URLS_GENERATE, COMFYUI_URLS_EDIT, COMFYUI_URLS_VIDEO
     global COMFYUI_HOST, COMFYUI_PORT, WS_PROTOCOL
     
     # Aceptar el valor tal cual viene, sin validar ni normalizar
@@ -114,15 +195,20 @@ def update_comfy_endpoint(endpoint_type, url):
     else:
         sanitized = str(url) if url else ""
     
+    # Several comma-separated URLs form a pool of backends
+    pool = [item.strip() for item in sanitized.split(',') if item.strip()] or [sanitized]
+    sanitized = ", ".join(pool)
+    
     # Actualizar el endpoint correspondiente
     endpoint_type_lower = endpoint_type.lower()
     if endpoint_type_lower in ['generate', 'generation']:
-        COMFYUI_URL_GENERATE = sanitized
-        COMFYUI_URL = sanitized  # Mantener compatibilidad
+        COMFYUI_URLS_GENERATE = pool
+        COMFYUI_URL_GENERATE = pool[0]
+        COMFYUI_URL = pool[0]  # Mantener compatibilidad
         # Intentar actualizar variables de WebSocket si parece una URL válida
-        if sanitized and '://' in sanitized:
+        if pool[0] and '://' in pool[0]:
             try:
-                parsed = urlparse(sanitized)
+                parsed = urlparse(pool[0])
                 if parsed.hostname:
                     COMFYUI_HOST = parsed.hostname
                     COMFYUI_PORT = parsed.port or (443 if parsed.scheme == 'https' else 8188)
@@ -130,13 +216,15 @@ def update_comfy_endpoint(endpoint_type, url):
             except Exception:
                 # Si hay error, mantener valores por defecto
                 pass
-        print(f"[Settings] ComfyUI Generate endpoint updated to: {COMFYUI_URL_GENERATE}")
+        print(f"[Settings] ComfyUI Generate endpoint updated to: {sanitized}")
     elif endpoint_type_lower in ['edit', 'editing']:
-        COMFYUI_URL_EDIT = sanitized
-        print(f"[Settings] ComfyUI Edit endpoint updated to: {COMFYUI_URL_EDIT}")
+        COMFYUI_URLS_EDIT = pool
+        COMFYUI_URL_EDIT = pool[0]
+        print(f"[Settings] ComfyUI Edit endpoint updated to: {sanitized}")
     elif endpoint_type_lower in ['video', 'videos']:
-        COMFYUI_URL_VIDEO = sanitized
-        print(f"[Settings] ComfyUI Video endpoint updated to: {COMFYUI_URL_VIDEO}")
+        COMFYUI_URLS_VIDEO = pool
+        COMFYUI_URL_VIDEO = pool[0]
+        print(f"[Settings] ComfyUI Video endpoint updated to: {sanitized}")
     else:
         raise ValueError(f"Unknown endpoint type: {endpoint_type}")
     
@@ -145,13 +233,13 @@ def update_comfy_endpoint(endpoint_type, url):
 def get_all_endpoints():
     """Obtener todos los endpoints actuales."""
     return {
-        "generate": COMFYUI_URL_GENERATE,
-        "edit": COMFYUI_URL_EDIT,
-        "video": COMFYUI_URL_VIDEO,
+        "generate": ", ".join(COMFYUI_URLS_GENERATE),
+        "edit": ", ".join(COMFYUI_URLS_EDIT),
+        "video": ", ".join(COMFYUI_URLS_VIDEO),
         "url": COMFYUI_URL  # Para compatibilidad hacia atrás
     }
 
-print(f"[Config] ComfyUI Generate endpoint: {COMFYUI_URL_GENERATE}")
-print(f"[Config] ComfyUI Edit endpoint: {COMFYUI_URL_EDIT}")
-print(f"[Config] ComfyUI Video endpoint: {COMFYUI_URL_VIDEO}")
+print(f"[Config] ComfyUI Generate endpoint: {', '.join(COMFYUI_URLS_GENERATE)}")
+print(f"[Config] ComfyUI Edit endpoint: {', '.join(COMFYUI_URLS_EDIT)}")
+print(f"[Config] ComfyUI Video endpoint: {', '.join(COMFYUI_URLS_VIDEO)}")
 
@@ -0,0 +1,175 @@
+"""
+Backend health and circuit breakers
+Tracks every ComfyUI backend from live request outcomes and periodic
+/system_stats probes. After a run of consecutive failures the backend's circuit
+opens and requests to it fail at once with BackendUnavailableError instead of
+waiting on a dead host; once the reset timeout has passed a single trial
+request (or a probe) is let through and closes the circuit again if it succeeds
+"""
+import math
+import time
+import threading
+from config import COMFY_BREAKER_FAILURE_THRESHOLD, COMFY_BREAKER_RESET_TIMEOUT
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+# Called as observer(base_url) when a backend's circuit closes again (see utils.warmup)
+_recovery_observer = None
+
+
+def set_recovery_observer(observer):
+    """Register the callable told about every backend that recovers."""
+    global _recovery_observer
+    _recovery_observer = observer
+
+
+class BackendUnavailableError(Exception):
+    """Raised instead of sending a request to a backend whose circuit is open."""
+
+    def __init__(self, backend_url=None, retry_after=None, reason=None, mode=None):
+        self.backend_url = backend_url
+        self.retry_after = retry_after
+        self.reason = reason
+        self.mode = mode
+        if backend_url:
+            message = f"ComfyUI backend {backend_url} is unavailable"
+        else:
+            message = f"All ComfyUI backends for '{mode}' are unavailable"
+        if reason:
+            message += f" ({reason})"
+        if retry_after is not None:
+            message += f"; retry in {self.retry_after_seconds()}s"
+        super().__init__(message)
+
+    def retry_after_seconds(self):
+        """Whole seconds for a Retry-After header (at least 1)."""
+        return max(1, int(math.ceil(self.retry_after or 0)))
+
+    def to_dict(self):
+        return {
+            "status": "backend_unavailable",
+            "backend_url": self.backend_url,
+            "mode": self.mode,
+            "retry_after": self.retry_after_seconds(),
+            "reason": self.reason,
+        }
+
+
+class CircuitBreaker:
+    """Closed / open / half-open state of one backend."""
+
+    def __init__(self, url, failure_threshold=COMFY_BREAKER_FAILURE_THRESHOLD, reset_timeout=COMFY_BREAKER_RESET_TIMEOUT):
+        self.url = url
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.trial_started = 0.0
+        self.last_failure = None
+        self.last_success = None
+        self.last_error = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.failure_threshold > 0
+
+    def _trial_due(self, now):
+        if self.state == OPEN:
+            return now - self.opened_at >= self.reset_timeout
+        # A trial that never reported back (e.g. a non-network error) is retried
+        return now - self.trial_started >= self.reset_timeout
+
+    def available(self):
+        """Whether a new request could be sent now (does not claim the trial)."""
+        with self._lock:
+            return self.state == CLOSED or not self.enabled or self._trial_due(time.time())
+
+    def allow_request(self):
+        """Claim permission to send a request; in half-open only one trial at a time passes."""
+        with self._lock:
+            if self.state == CLOSED or not self.enabled:
+                return True
+            now = time.time()
+            if not self._trial_due(now):
+                return False
+            if self.state == OPEN:
+                print(f"[HEALTH] Circuit of {self.url} half-open, sending a trial request")
+            self.state = HALF_OPEN
+            self.trial_started = now
+            return True
+
+    def retry_after(self):
+        """Seconds until a trial request will be let through (0 when closed)."""
+        with self._lock:
+            if self.state == CLOSED:
+                return 0.0
+            since = self.opened_at if self.state == OPEN else self.trial_started
+            return max(0.0, self.reset_timeout - (time.time() - since))
+
+    def record_success(self):
+        with self._lock:
+            recovered = self.state != CLOSED
+            if recovered:
+                print(f"[HEALTH] Circuit of {self.url} closed, backend recovered")
+            self.state = CLOSED
+            self.consecutive_failures = 0
+            self.last_success = time.time()
+            self.last_error = None
+        if recovered and _recovery_observer is not None:
+            _recovery_observer(self.url)
+
+    def record_failure(self, error=None):
+        with self._lock:
+            now = time.time()
+            self.consecutive_failures += 1
+            self.last_failure = now
+            self.last_error = str(error) if error is not None else None
+            if not self.enabled:
+                return
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.consecutive_failures >= self.failure_threshold):
+                self.state = OPEN
+                self.opened_at = now
+                print(f"[HEALTH] Circuit of {self.url} open after {self.consecutive_failures} consecutive "
+                      f"failure(s): {self.last_error}")
+            elif self.state == OPEN:
+                # A failed probe keeps the circuit open for another reset period
+                self.opened_at = now
+
+    def unavailable_error(self, mode=None):
+        return BackendUnavailableError(self.url, retry_after=self.retry_after(), reason=self.describe(), mode=mode)
+
+    def describe(self):
+        if self.state == CLOSED:
+            return None
+        detail = f": {self.last_error}" if self.last_error else ""
+        return f"circuit {self.state} after {self.consecutive_failures} failure(s){detail}"
+
+    def to_dict(self):
+        with self._lock:
+            state = self.state
+            if state == OPEN and self._trial_due(time.time()):
+                state = HALF_OPEN
+        return {
+            "state": state,
+            "consecutive_failures": self.consecutive_failures,
+            "retry_after": round(self.retry_after(), 1) or None,
+            "last_error": self.last_error,
+            "last_failure": self.last_failure,
+            "last_success": self.last_success,
+        }
+
+
+def get_breaker(base_url):
+    """Circuit breaker of a backend URL, created on first use."""
+    key = (base_url or '').rstrip('/')
+    breaker = _breakers.get(key)
+    if breaker is not None:
+        return breaker
+    with _breakers_lock:
+        return _breakers.setdefault(key, CircuitBreaker(key))
@@ -0,0 +1,160 @@
+"""
+Pooled HTTP sessions for ComfyUI endpoints
+Keeps one keep-alive connection pool per backend URL. Every request goes
+through the backend's circuit breaker and reports its outcome to it, and its
+timeout is clamped to the remaining budget of the current request deadline
+"""
+import time
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from config import (
+    COMFY_HTTP_POOL_SIZE,
+    COMFY_HTTP_CONNECT_TIMEOUT,
+    COMFY_HTTP_READ_TIMEOUT,
+    COMFY_HTTP_MAX_RETRIES,
+    COMFY_HTTP_BACKOFF_FACTOR,
+)
+from utils.comfy_config import get_comfy_url, build_comfy_headers
+from utils.comfy_health import get_breaker
+from utils.deadlines import bound_timeout, deadline_error
+
+DEFAULT_TIMEOUT = (COMFY_HTTP_CONNECT_TIMEOUT, COMFY_HTTP_READ_TIMEOUT)
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+# Called as observer(base_url, elapsed_seconds) after every response (see utils.keep_warm)
+_response_observer = None
+
+
+def set_response_observer(observer):
+    """Register the callable told about every answered request to a backend."""
+    global _response_observer
+    _response_observer = observer
+
+
+def _build_retry():
+    """Retry policy for transient errors.
+
+    Connection errors are retried for every method because the request never
+    reached the server. Read errors and 5xx responses are only retried for
+    idempotent methods so a POST /prompt is never queued twice.
+    """
+    return Retry(
+        total=COMFY_HTTP_MAX_RETRIES,
+        connect=COMFY_HTTP_MAX_RETRIES,
+        read=COMFY_HTTP_MAX_RETRIES,
+        status=COMFY_HTTP_MAX_RETRIES,
+        backoff_factor=COMFY_HTTP_BACKOFF_FACTOR,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+        raise_on_status=False,
+    )
+
+
+def _create_session():
+    """Create a session with a keep-alive pool and retry policy."""
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=COMFY_HTTP_POOL_SIZE,
+        max_retries=_build_retry(),
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_comfy_session(mode='generate', base_url=None):
+    """Get the shared pooled session of a backend, creating it on first use.
+
+    Args:
+        mode: Mode whose current backend is used when base_url is not given
+        base_url: Explicit backend URL
+    """
+    key = (base_url or get_comfy_url(mode)).rstrip('/')
+    session = _sessions.get(key)
+    if session is not None:
+        return session
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            session = _create_session()
+            _sessions[key] = session
+        return session
+
+
+def _is_backend_failure(response):
+    """5xx answers (including a proxy's 502/503/504 for a cold or dead worker) count against the backend."""
+    return response.status_code >= 500
+
+
+def comfy_request(method, path, mode='generate', headers=None, timeout=None, base_url=None, health_check=False, **kwargs):
+    """Send a request to the ComfyUI endpoint of a mode through its pooled session.
+
+    Args:
+        method: HTTP method ('GET', 'POST', ...)
+        path: Path relative to the endpoint, e.g. '/history/<id>'
+        mode: 'generate', 'edit' or 'video'; resolves to the backend pinned for
+            the current thread, or the first backend of the mode's pool
+        headers: Extra headers merged over the Modal headers
+        timeout: (connect, read) tuple or seconds; defaults to the configured
+            timeouts, and never exceeds the remaining deadline of the thread
+        base_url: Explicit backend URL, overriding the mode's backend
+        health_check: Send even while the backend's circuit is open (health probes)
+        **kwargs: Passed through to requests (params, data, files, stream, ...)
+
+    Raises:
+        BackendUnavailableError: If the backend's circuit is open
+        DeadlineExceeded: If the request deadline runs out before or during the call
+    """
+    stage = f"{method} {path.split('?')[0]}"
+    timeout, clamped = bound_timeout(timeout if timeout is not None else DEFAULT_TIMEOUT, stage)
+    base = (base_url or get_comfy_url(mode)).rstrip('/')
+    breaker = get_breaker(base)
+    if not health_check and not breaker.allow_request():
+        raise breaker.unavailable_error(mode)
+    started = time.time()
+    try:
+        response = get_comfy_session(base_url=base).request(
+            method,
+            f"{base}{path}",
+            headers=build_comfy_headers(headers),
+            timeout=timeout,
+            **kwargs
+        )
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+        if clamped and isinstance(e, requests.exceptions.Timeout):
+            # Our budget ran out, which says nothing about the backend's health
+            raise deadline_error(stage) from e
+        breaker.record_failure(f"{type(e).__name__} on {stage}")
+        raise
+    if _is_backend_failure(response):
+        breaker.record_failure(f"HTTP {response.status_code} on {stage}")
+    else:
+        breaker.record_success()
+        if _response_observer is not None:
+            _response_observer(base, time.time() - started)
+    return response
+
+
+def comfy_get(path, mode='generate', **kwargs):
+    """GET shortcut for comfy_request."""
+    return comfy_request('GET', path, mode=mode, **kwargs)
+
+
+def comfy_post(path, mode='generate', **kwargs):
+    """POST shortcut for comfy_request."""
+    return comfy_request('POST', path, mode=mode, **kwargs)
+
+
+def close_comfy_sessions():
+    """Close every pooled session (used on shutdown or after endpoint changes)."""
+    with _sessions_lock:
+        for session in _sessions.values():
+            try:
+                session.close()
+            except Exception:
+                pass
+        _sessions.clear()
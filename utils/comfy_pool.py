@@ -0,0 +1,668 @@
+"""
+ComfyUI backend pools
+Each mode (generate, edit, video) may be served by several backends. The pool
+polls /queue and /system_stats on every backend and routes each new prompt to
+the backend with the shortest effective queue, preferring, within a fairness
+bound, a backend that already has the prompt's checkpoints loaded. Backends
+whose node/model list lacks something the workflow needs, or whose circuit
+breaker is open, are skipped; single backends get a periodic /system_stats
+health probe so their circuit recovers without user traffic. The chosen
+backend is pinned to the calling thread so uploads, /prompt, waiting and /view
+stay on it
+"""
+import time
+import threading
+from functools import wraps
+from contextlib import contextmanager
+from config import COMFY_POOL_POLL_INTERVAL, COMFY_POOL_PROBE_TIMEOUT, COMFY_MODEL_AFFINITY_SLACK, COMFY_HEALTH_PROBE_INTERVAL
+from utils.comfy_config import (
+    get_comfy_url,
+    get_comfy_urls,
+    get_pinned_backend,
+    set_pinned_backend,
+    set_backend_resolver,
+    normalize_mode,
+)
+from utils.comfy_http import comfy_get
+from utils.comfy_health import get_breaker, BackendUnavailableError, CLOSED
+from utils.deadlines import DeadlineExceeded
+from utils.comfy_schema import get_object_info, backend_supports
+from utils.keep_warm import backend_contact_allowed
+from utils.workflow import get_workflow_models
+
+MODES = ('generate', 'edit', 'video')
+
+# Called as observer(base_url) when /system_stats shows a backend restarted (see utils.warmup)
+_restart_observer = None
+
+
+def set_restart_observer(observer):
+    """Register the callable told about every backend that restarted."""
+    global _restart_observer
+    _restart_observer = observer
+
+
+class BackendState:
+    """Last known load of one ComfyUI backend."""
+
+    def __init__(self, url, mode, name):
+        self.url = url
+        self.mode = mode
+        self.name = name
+        self.queue_running = 0
+        self.queue_pending = 0
+        self.remote_prompt_ids = set()
+        # Models of the last prompt in the remote queue (None when the queue is empty)
+        self.remote_tail_models = None
+        # Models of the last prompt known to run here; they stay loaded once it finishes
+        self.last_models = None
+        # Generations of this process pinned to the backend
+        self.reservations = {}
+        self.reachable = None  # None until the first poll
+        self.last_polled = 0.0
+        self.poll_started = 0.0
+        self.last_probed = 0.0
+        self.last_error = None
+        self.devices = []
+        # (setup, models_loaded) of the last /system_stats, see _stats_marker
+        self.stats_marker = None
+        self.restarts = 0
+        self.metrics = {
+            "jobs": 0,
+            "total_latency": 0.0,
+            "model_switches": 0,
+            "switch_latency": 0.0,
+            "same_model_jobs": 0,
+            "same_model_latency": 0.0,
+        }
+
+    @property
+    def inflight(self):
+        return len(self.reservations)
+
+    def _is_unseen(self, reservation):
+        prompt_id = reservation["prompt_id"]
+        if prompt_id is None:
+            return True
+        return prompt_id not in self.remote_prompt_ids and reservation["queued_at"] >= self.poll_started
+
+    def effective_queue(self):
+        """Remote queue plus our own prompts the last poll could not see yet.
+
+        A reservation counts until its prompt shows up in /queue: while it is
+        uploading inputs, or when it was queued after the last poll started.
+        """
+        unseen = sum(1 for reservation in self.reservations.values() if self._is_unseen(reservation))
+        return self.queue_running + self.queue_pending + unseen
+
+    def expected_models(self):
+        """Models that will be loaded when a prompt routed here now starts running."""
+        unseen = [
+            reservation for reservation in self.reservations.values()
+            if reservation["models"] and self._is_unseen(reservation)
+        ]
+        if unseen:
+            return max(unseen, key=lambda reservation: reservation["selected_at"])["models"]
+        if self.remote_tail_models:
+            return self.remote_tail_models
+        return self.last_models
+
+    def to_dict(self):
+        metrics = self.metrics
+        return {
+            "name": self.name,
+            "url": self.url,
+            "mode": self.mode,
+            "reachable": self.reachable,
+            "queue_running": self.queue_running,
+            "queue_pending": self.queue_pending,
+            "effective_queue": self.effective_queue(),
+            "inflight": self.inflight,
+            "loaded_models": list(self.expected_models() or []),
+            "last_polled": self.last_polled or None,
+            "last_error": self.last_error,
+            "circuit": get_breaker(self.url).to_dict(),
+            "devices": self.devices,
+            "restarts": self.restarts,
+            "metrics": {
+                "jobs": metrics["jobs"],
+                "avg_latency": _average(metrics["total_latency"], metrics["jobs"]),
+                "model_switches": metrics["model_switches"],
+                "avg_latency_with_switch": _average(metrics["switch_latency"], metrics["model_switches"]),
+                "avg_latency_same_model": _average(metrics["same_model_latency"], metrics["same_model_jobs"]),
+            },
+        }
+
+
+def _average(total, count):
+    return round(total / count, 3) if count else None
+
+
+def _stats_marker(stats):
+    """(setup, models_loaded) of a /system_stats answer.
+
+    ComfyUI reports no process id or uptime, so a restart shows up as a
+    different setup (version, arguments, devices) or as the torch allocator
+    going back to zero after it held models.
+    """
+    system = stats.get("system") or {}
+    devices = stats.get("devices") or []
+    setup = (
+        system.get("comfyui_version"),
+        system.get("pytorch_version"),
+        tuple(system.get("argv") or ()),
+        system.get("ram_total"),
+        tuple((device.get("name"), device.get("vram_total")) for device in devices),
+    )
+    loaded = any((device.get("torch_vram_total") or 0) > 0 for device in devices)
+    return setup, loaded
+
+
+def _queue_item_models(item):
+    # Queue items are [number, prompt_id, prompt, extra_data, outputs]
+    if isinstance(item, (list, tuple)) and len(item) > 2 and isinstance(item[2], dict):
+        return get_workflow_models(item[2]) or None
+    return None
+
+
+class BackendPool:
+    """Load-aware selection among the backends configured for each mode."""
+
+    def __init__(self, poll_interval=COMFY_POOL_POLL_INTERVAL, probe_timeout=COMFY_POOL_PROBE_TIMEOUT,
+                 affinity_slack=COMFY_MODEL_AFFINITY_SLACK, health_probe_interval=COMFY_HEALTH_PROBE_INTERVAL):
+        self.poll_interval = poll_interval
+        self.health_probe_interval = health_probe_interval
+        self.probe_timeout = probe_timeout
+        self.affinity_slack = affinity_slack
+        self._states = {}  # (mode, url) -> BackendState
+        self._cursor = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def backends(self, mode='generate'):
+        """Current backends of a mode, following runtime endpoint changes."""
+        mode_key = normalize_mode(mode)
+        urls = [url.rstrip('/') for url in get_comfy_urls(mode_key) if url]
+        with self._lock:
+            states = []
+            for index, url in enumerate(urls):
+                state = self._states.get((mode_key, url))
+                if state is None:
+                    state = BackendState(url, mode_key, f"{mode_key}-{index}")
+                    self._states[(mode_key, url)] = state
+                state.name = f"{mode_key}-{index}"
+                states.append(state)
+            # Drop backends removed from the configuration
+            for key in [key for key in self._states if key[0] == mode_key and key[1] not in urls]:
+                del self._states[key]
+            return states
+
+    def poll(self, state):
+        """Refresh queue depth, queued models and device stats of one backend."""
+        timeout = (min(self.probe_timeout, 2.0), self.probe_timeout)
+        started = time.time()
+        try:
+            queue_response = comfy_get("/queue", base_url=state.url, timeout=timeout)
+            queue_response.raise_for_status()
+            queue = queue_response.json()
+            stats_response = comfy_get("/system_stats", base_url=state.url, timeout=timeout)
+            stats = stats_response.json() if stats_response.status_code == 200 else {}
+        except DeadlineExceeded:
+            # The caller's budget ran out; the backend itself may be fine
+            raise
+        except Exception as e:
+            with self._lock:
+                state.reachable = False
+                state.last_error = str(e)
+                state.last_polled = time.time()
+            return False
+
+        running = queue.get("queue_running") or []
+        pending = queue.get("queue_pending") or []
+        # The last prompt to run is the queued one with the highest number
+        items = sorted(
+            (item for item in running + pending if isinstance(item, (list, tuple)) and item),
+            key=lambda item: item[0] if isinstance(item[0], (int, float)) else 0
+        )
+        tail_models = _queue_item_models(items[-1]) if items else None
+
+        with self._lock:
+            state.queue_running = len(running)
+            state.queue_pending = len(pending)
+            state.remote_prompt_ids = {
+                item[1] for item in running + pending
+                if isinstance(item, (list, tuple)) and len(item) > 1
+            }
+            state.remote_tail_models = tail_models
+            if tail_models:
+                state.last_models = tail_models
+            state.poll_started = started
+            restarted = self._apply_stats_locked(state, stats)
+            state.reachable = True
+            state.last_error = None
+            state.last_polled = time.time()
+        if restarted:
+            self._notify_restart(state)
+        # Keep the node/model list used for capability routing warm (cached for its TTL)
+        get_object_info(base_url=state.url)
+        return True
+
+    def probe(self, state):
+        """Health probe of one backend (/system_stats), sent even while its circuit is open."""
+        timeout = (min(self.probe_timeout, 2.0), self.probe_timeout)
+        try:
+            response = comfy_get("/system_stats", base_url=state.url, timeout=timeout, health_check=True)
+            response.raise_for_status()
+            stats = response.json()
+        except Exception as e:
+            with self._lock:
+                state.reachable = False
+                state.last_error = str(e)
+                state.last_probed = time.time()
+            return False
+
+        with self._lock:
+            restarted = self._apply_stats_locked(state, stats)
+            state.reachable = True
+            state.last_error = None
+            state.last_probed = time.time()
+        if restarted:
+            self._notify_restart(state)
+        return True
+
+    def _apply_stats_locked(self, state, stats):
+        """Store the device stats of a backend; True when they show it restarted."""
+        if not stats:
+            return False
+        state.devices = [
+            {
+                "name": device.get("name"),
+                "vram_total": device.get("vram_total"),
+                "vram_free": device.get("vram_free"),
+            }
+            for device in (stats.get("devices") or [])
+        ]
+        previous, state.stats_marker = state.stats_marker, _stats_marker(stats)
+        if previous is None:
+            return False
+        setup, loaded = state.stats_marker
+        restarted = setup != previous[0] or (previous[1] and not loaded)
+        if restarted:
+            state.restarts += 1
+            # It lost whatever models it had loaded
+            state.last_models = None
+        return restarted
+
+    def _notify_restart(self, state):
+        print(f"[POOL] {state.name} ({state.url}) restarted")
+        if _restart_observer is not None:
+            try:
+                _restart_observer(state.url)
+            except Exception as e:
+                print(f"[POOL] Restart observer error for {state.url}: {e}")
+
+    def poll_all(self):
+        now = time.time()
+        for mode in MODES:
+            states = self.backends(mode)
+            for state in states:
+                # An idle serverless backend is left alone so its container can scale down
+                if not backend_contact_allowed(state.url):
+                    continue
+                # A single backend has nothing to balance against, and a backend
+                # with an open circuit only gets the health probe until it recovers
+                if len(states) > 1 and get_breaker(state.url).state == CLOSED:
+                    self.poll(state)
+                elif self.health_probe_interval > 0 and now - state.last_probed >= self.health_probe_interval:
+                    self.probe(state)
+
+    def _healthy(self, mode, states):
+        """Backends whose circuit lets a request through; fails fast when there is none."""
+        healthy = [state for state in states if get_breaker(state.url).available()]
+        if healthy:
+            return healthy
+        breaker = min((get_breaker(state.url) for state in states), key=lambda breaker: breaker.retry_after())
+        if len(states) == 1:
+            raise breaker.unavailable_error(normalize_mode(mode))
+        raise BackendUnavailableError(
+            retry_after=breaker.retry_after(),
+            reason=f"{len(states)} circuits open",
+            mode=normalize_mode(mode)
+        )
+
+    def select(self, mode='generate', models=None, workflow=None):
+        """Pick a backend for a new prompt and reserve a slot on it.
+
+        The backend with the shortest effective queue wins, unless a backend
+        whose loaded models match the prompt's models is at most
+        affinity_slack prompts behind it: skipping a checkpoint reload is
+        usually worth more than one queue position. When the workflow is
+        known, backends missing one of its nodes or models are left out.
+
+        Returns (state, token); the token is released with release().
+
+        Raises:
+            BackendUnavailableError: If every backend of the mode has an open circuit
+        """
+        states = self.backends(mode)
+        if not states:
+            raise ValueError(f"No ComfyUI backend configured for mode '{mode}'")
+        if len(states) > 1:
+            # Endpoints may become a pool at runtime through the settings API
+            self.start()
+            stale_after = self.poll_interval * 3
+            for state in states:
+                if time.time() - state.last_polled > stale_after and get_breaker(state.url).state == CLOSED:
+                    self.poll(state)
+        states = self._healthy(mode, states)
+        if len(states) > 1 and workflow is not None:
+            capable = [state for state in states if backend_supports(workflow, state.url) is not False]
+            # With no capable backend, let validation report exactly what is missing
+            if capable:
+                states = capable
+
+        mode_key = normalize_mode(mode)
+        models = tuple(models) if models else None
+        with self._lock:
+            # Rotate the starting point so equally loaded backends share the traffic
+            cursor = self._cursor.get(mode_key, 0)
+            self._cursor[mode_key] = cursor + 1
+            ordered = states[cursor % len(states):] + states[:cursor % len(states)]
+            loads = {id(state): state.effective_queue() for state in ordered}
+
+            def affinity_rank(state):
+                expected = state.expected_models()
+                if not models or not expected:
+                    return 1
+                return 0 if expected == models else 2
+
+            chosen = min(
+                ordered,
+                key=lambda state: (state.reachable is False, loads[id(state)], affinity_rank(state))
+            )
+            if models and self.affinity_slack > 0 and affinity_rank(chosen) != 0:
+                affine = [
+                    state for state in ordered
+                    if state.reachable is not False
+                    and affinity_rank(state) == 0
+                    and loads[id(state)] <= loads[id(chosen)] + self.affinity_slack
+                ]
+                if affine:
+                    chosen = min(affine, key=lambda state: loads[id(state)])
+
+            expected = chosen.expected_models()
+            switch = None if not models or not expected else expected != models
+            token = object()
+            chosen.reservations[token] = {
+                "prompt_id": None,
+                "queued_at": 0.0,
+                "selected_at": time.time(),
+                "models": models,
+                "switch": switch,
+            }
+            load = loads[id(chosen)]
+        if len(states) > 1:
+            print(f"[POOL] Routing {mode_key} prompt to {chosen.name} ({chosen.url}), effective queue {load}"
+                  f"{', model switch' if switch else ''}")
+        return chosen, token
+
+    def reserve(self, mode, url, prompt_id=None):
+        """Reserve a slot on a known backend (used when resuming a prompt)."""
+        url = url.rstrip('/')
+        for state in self.backends(mode):
+            if state.url == url:
+                token = object()
+                with self._lock:
+                    state.reservations[token] = {
+                        "prompt_id": prompt_id,
+                        "queued_at": 0.0,
+                        "selected_at": time.time(),
+                        "models": None,
+                        "switch": None,
+                    }
+                return state, token
+        return None, None
+
+    def attach_prompt(self, state, token, prompt_id):
+        """Record the prompt_id queued under a reservation."""
+        with self._lock:
+            reservation = state.reservations.get(token)
+            if reservation is not None:
+                reservation["prompt_id"] = prompt_id
+                reservation["queued_at"] = time.time()
+                if reservation["models"]:
+                    state.last_models = reservation["models"]
+
+    def release(self, state, token, record=True):
+        """Free a reservation and record the job latency on the backend."""
+        with self._lock:
+            reservation = state.reservations.pop(token, None)
+            if not record or reservation is None or reservation["prompt_id"] is None:
+                return
+            latency = time.time() - reservation["selected_at"]
+            metrics = state.metrics
+            metrics["jobs"] += 1
+            metrics["total_latency"] += latency
+            if reservation["switch"] is True:
+                metrics["model_switches"] += 1
+                metrics["switch_latency"] += latency
+            elif reservation["switch"] is False:
+                metrics["same_model_jobs"] += 1
+                metrics["same_model_latency"] += latency
+
+    def resolve_name(self, name):
+        """URL of a backend by its public name (e.g. 'generate-1'), or None."""
+        for mode in MODES:
+            for state in self.backends(mode):
+                if state.name == name:
+                    return state.url
+        return None
+
+    def name_of(self, mode, url):
+        url = (url or '').rstrip('/')
+        for state in self.backends(mode):
+            if state.url == url:
+                return state.name
+        return None
+
+    def status(self):
+        return {mode: [state.to_dict() for state in self.backends(mode)] for mode in MODES}
+
+    def start(self):
+        """Start the background poller thread."""
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name='comfy-pool-poller', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self.poll_all()
+            except Exception as e:
+                print(f"[POOL] Poller error: {e}")
+            self._stopped.wait(self.poll_interval)
+
+
+backend_pool = BackendPool()
+
+
+class _BackendScope:
+    """Backend reservation of one generation; selected on its first ComfyUI call."""
+
+    def __init__(self, mode):
+        self.mode = mode
+        self.models = None
+        self.workflow = None
+        self.state = None
+        self.token = None
+        self.url = None
+        # Dispatch ticket of the prompt queued in this scope (utils.comfy_scheduler)
+        self.dispatch = None
+        # Workflow and size of the generation, for the cost model (utils.cost_model)
+        self.profile = None
+
+
+# Open scopes of the current thread: mode -> _BackendScope
+_scope = threading.local()
+
+
+def _open_scopes():
+    scopes = getattr(_scope, 'scopes', None)
+    if scopes is None:
+        scopes = _scope.scopes = {}
+    return scopes
+
+
+def _resolve_scope_backend(mode):
+    """Select the backend of an open scope the first time its URL is needed."""
+    scope = _open_scopes().get(normalize_mode(mode))
+    if scope is None:
+        return None
+    if scope.url is None:
+        scope.state, scope.token = backend_pool.select(scope.mode, models=scope.models, workflow=scope.workflow)
+        scope.url = scope.state.url
+        set_pinned_backend(scope.mode, scope.url)
+    return scope.url
+
+
+set_backend_resolver(_resolve_scope_backend)
+
+
+@contextmanager
+def backend_scope(mode='generate', backend_url=None, prompt_id=None):
+    """Pin one backend of a mode to the current thread for the duration of a generation.
+
+    The backend is chosen lazily, on the first call that needs its URL, so the
+    domain code can declare the workflow's models first (set_backend_affinity).
+    Nested scopes of the same mode reuse the outer backend. When backend_url is
+    given (e.g. a job resumed after a restart) that backend is used instead of
+    selecting one.
+    """
+    mode_key = normalize_mode(mode)
+    scopes = _open_scopes()
+    if mode_key in scopes or get_pinned_backend(mode_key):
+        yield scopes.get(mode_key)
+        return
+
+    scope = _BackendScope(mode_key)
+    if backend_url:
+        scope.state, scope.token = backend_pool.reserve(mode_key, backend_url, prompt_id)
+        scope.url = backend_url.rstrip('/')
+        set_pinned_backend(mode_key, scope.url)
+    scopes[mode_key] = scope
+    try:
+        yield scope
+    finally:
+        scopes.pop(mode_key, None)
+        if scope.dispatch is not None:
+            scope.dispatch.release()
+        if scope.url:
+            set_pinned_backend(mode_key, None)
+        if scope.state is not None:
+            # Resumed prompts skipped selection, so they stay out of the latency metrics
+            backend_pool.release(scope.state, scope.token, record=not backend_url)
+
+
+def set_backend_affinity(mode, workflow):
+    """Declare the workflow about to run so backend selection can favour loaded
+    models and skip backends that cannot run it."""
+    scope = _open_scopes().get(normalize_mode(mode))
+    if scope is not None and scope.url is None:
+        scope.models = get_workflow_models(workflow) or None
+        scope.workflow = workflow
+
+
+def set_generation_profile(mode, profile):
+    """Attach the generation profile (workflow, size, steps, ...) to the current thread's scope."""
+    scope = _open_scopes().get(normalize_mode(mode))
+    if scope is not None:
+        scope.profile = profile
+
+
+def get_generation_profile(mode):
+    """Generation profile declared in the current thread's scope, or None."""
+    scope = _open_scopes().get(normalize_mode(mode))
+    return scope.profile if scope is not None else None
+
+
+def note_prompt_queued(mode, prompt_id):
+    """Tell the pool which prompt the current thread queued on its pinned backend."""
+    scope = _open_scopes().get(normalize_mode(mode))
+    if scope is not None and scope.state is not None:
+        backend_pool.attach_prompt(scope.state, scope.token, prompt_id)
+
+
+def hold_dispatch_slot(mode, ticket):
+    """Keep a dispatch ticket until the prompt finishes or the scope closes; False outside a scope."""
+    scope = _open_scopes().get(normalize_mode(mode))
+    if scope is None:
+        return False
+    if scope.dispatch is not None:
+        scope.dispatch.release()
+    scope.dispatch = ticket
+    return True
+
+
+def release_dispatch_slot(mode):
+    """Free the dispatch ticket of the current thread's scope (its prompt is done)."""
+    scope = _open_scopes().get(normalize_mode(mode))
+    if scope is not None and scope.dispatch is not None:
+        scope.dispatch.release()
+        scope.dispatch = None
+
+
+def pinned_backend(mode):
+    """Decorator running a domain function inside backend_scope(mode)."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with backend_scope(mode):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def resolve_backend_name(name):
+    """URL of a configured backend from its public name; None if unknown.
+
+    Clients only ever see backend names, so a name coming from a request can
+    never point the server at an arbitrary URL.
+    """
+    if not name:
+        return None
+    return backend_pool.resolve_name(name)
+
+
+def get_backend_name(mode='generate', url=None):
+    """Public name of the backend currently used by a mode (or of url)."""
+    return backend_pool.name_of(mode, url or get_comfy_url(mode))
+
+
+def get_average_latency(mode='generate', url=None):
+    """Average seconds a prompt held a backend (of url, or of the whole mode), or None if nothing finished yet."""
+    url = (url or '').rstrip('/')
+    total, jobs = 0.0, 0
+    for state in backend_pool.backends(mode):
+        if not url or state.url == url:
+            total += state.metrics["total_latency"]
+            jobs += state.metrics["jobs"]
+    return total / jobs if jobs else None
+
+
+def get_pool_status():
+    """Load, loaded models, reachability, circuit state and latency metrics of every backend, by mode."""
+    return backend_pool.status()
+
+
+def start_backend_poller():
+    """Start polling backend queues when any mode has more than one backend,
+    or health probing when it is enabled."""
+    if COMFY_HEALTH_PROBE_INTERVAL > 0 or any(len(get_comfy_urls(mode)) > 1 for mode in MODES):
+        backend_pool.start()
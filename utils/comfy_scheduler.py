@@ -0,0 +1,256 @@
+"""
+Fair-share prompt dispatch
+ComfyUI runs its queue in FIFO order, so one user queuing a batch of video
+extensions used to push everyone else's image to the back. Prompts are now
+held locally and each backend is only fed a small window of them; whenever a
+slot of the window frees up, the waiting prompt with the smallest weighted
+fair queuing finish tag is sent. Flows are (user, priority class) and
+interactive work weighs more than batch work, so a single interactive image
+overtakes a long batch while the batch still gets its share of the backend.
+The bulkhead worker pools order their waiting jobs with the same tags.
+With the 'sejf' policy the window is instead given to the prompt with the
+shortest expected runtime (utils.cost_model), aged by the time it has waited
+"""
+import time
+import threading
+from contextlib import contextmanager
+from config import COMFY_SCHEDULER_WINDOW, COMFY_SCHEDULER_WEIGHTS, COMFY_SCHEDULER_POLICY, COMFY_SCHEDULER_AGING
+from utils.deadlines import get_current_deadline, deadline_error
+
+PRIORITY_INTERACTIVE = 'interactive'
+PRIORITY_BATCH = 'batch'
+PRIORITY_CLASSES = (PRIORITY_INTERACTIVE, PRIORITY_BATCH)
+
+POLICY_FAIR = 'fair'
+POLICY_SEJF = 'sejf'
+
+# How often a waiting prompt rechecks its deadline and cancellation
+_WAIT_SLICE = 1.0
+
+_dispatch_context = threading.local()
+
+
+def resolve_priority(value=None, mode='generate'):
+    """Priority class of a request: the client's choice, else batch for video and interactive otherwise."""
+    if isinstance(value, str) and value.strip().lower() in PRIORITY_CLASSES:
+        return value.strip().lower()
+    return PRIORITY_BATCH if mode == 'video' else PRIORITY_INTERACTIVE
+
+
+def get_dispatch_context():
+    """(user, priority) of the generation running on the current thread, or None."""
+    return getattr(_dispatch_context, 'context', None)
+
+
+@contextmanager
+def dispatch_scope(user=None, priority=PRIORITY_INTERACTIVE):
+    """Bind the user and priority class used to schedule this thread's prompts."""
+    outer = get_dispatch_context()
+    _dispatch_context.context = (user, priority)
+    try:
+        yield
+    finally:
+        _dispatch_context.context = outer
+
+
+class FairQueue:
+    """Start-time fair queuing tags for flows of (user, priority class).
+
+    Each item gets a start tag (the later of the queue's virtual time and the
+    end of its flow's previous item) and a finish tag start + cost / weight;
+    serving items by smallest finish tag gives every flow a share of the
+    service proportional to its weight. Not thread-safe: callers hold their
+    own lock.
+    """
+
+    def __init__(self, weights=None):
+        self.weights = weights or COMFY_SCHEDULER_WEIGHTS
+        self.virtual_time = 0.0
+        self._flows = {}
+
+    def tag(self, user=None, priority=PRIORITY_INTERACTIVE, cost=1.0):
+        """(start, finish) tags of a new item of a flow."""
+        weight = max(self.weights.get(priority, 1.0), 0.01)
+        flow = (user or '', priority)
+        start = max(self.virtual_time, self._flows.get(flow, 0.0))
+        finish = start + cost / weight
+        self._flows[flow] = finish
+        return start, finish
+
+    def served(self, start):
+        """Advance the virtual time to the start tag of the item being served."""
+        self.virtual_time = max(self.virtual_time, start)
+
+    def idle(self):
+        """Forget flows that are caught up, so idle users keep no credit (or debt)."""
+        self._flows = {flow: finish for flow, finish in self._flows.items() if finish > self.virtual_time}
+
+
+class DispatchTicket:
+    """Place of one prompt in a backend's window; release() frees it for the next prompt."""
+
+    def __init__(self, scheduler, user, priority, start, finish, expected=None):
+        self.scheduler = scheduler
+        self.user = user
+        self.priority = priority
+        self.start = start
+        self.finish = finish
+        # Expected execution seconds, used by the 'sejf' policy
+        self.expected = expected
+        self.enqueued_at = time.time()
+        self.granted = False
+        self.released = False
+
+    def release(self):
+        if self.scheduler is not None:
+            self.scheduler._release(self)
+
+
+class BackendScheduler:
+    """Window and weighted fair queue of one backend."""
+
+    def __init__(self, url, window=COMFY_SCHEDULER_WINDOW, weights=None, policy=COMFY_SCHEDULER_POLICY,
+                 aging=COMFY_SCHEDULER_AGING):
+        self.url = url
+        self.window = window
+        self.policy = policy if policy in (POLICY_FAIR, POLICY_SEJF) else POLICY_FAIR
+        self.aging = aging
+        self.inflight = 0
+        self.waiting = []
+        self.dispatched = {priority: 0 for priority in PRIORITY_CLASSES}
+        self.total_wait = {priority: 0.0 for priority in PRIORITY_CLASSES}
+        self._fair = FairQueue(weights)
+        self._cond = threading.Condition()
+
+    @property
+    def enabled(self):
+        return self.window > 0
+
+    def _next_locked(self):
+        """Waiting ticket to dispatch next under the scheduler's policy."""
+        if self.policy == POLICY_SEJF:
+            known = [ticket.expected for ticket in self.waiting if ticket.expected is not None]
+            if known:
+                # Prompts without an estimate count as the average of those that have one
+                typical = sum(known) / len(known)
+                now = time.time()
+
+                def rank(ticket):
+                    expected = ticket.expected if ticket.expected is not None else typical
+                    weight = max(self._fair.weights.get(ticket.priority, 1.0), 0.01)
+                    return expected / weight - self.aging * (now - ticket.enqueued_at), ticket.enqueued_at
+
+                return min(self.waiting, key=rank)
+        return min(self.waiting, key=lambda candidate: (candidate.finish, candidate.enqueued_at))
+
+    def _dispatch_locked(self):
+        while self.waiting and self.inflight < self.window:
+            ticket = self._next_locked()
+            self.waiting.remove(ticket)
+            ticket.granted = True
+            self.inflight += 1
+            self._fair.served(ticket.start)
+            self.dispatched[ticket.priority] += 1
+            self.total_wait[ticket.priority] += time.time() - ticket.enqueued_at
+        if not self.waiting:
+            self._fair.idle()
+        self._cond.notify_all()
+
+    def acquire(self, user=None, priority=PRIORITY_INTERACTIVE, cost=1.0, cancel_event=None, expected=None):
+        """Wait until the prompt may be sent to the backend.
+
+        expected is the prompt's expected execution time in seconds (None if
+        unknown); only the 'sejf' policy uses it.
+
+        A cancelled job gives its place up and returns an ungranted ticket;
+        the caller sees the cancellation at its own next check.
+
+        Raises:
+            DeadlineExceeded: If the current deadline runs out while waiting
+        """
+        if not self.enabled:
+            return DispatchTicket(None, user, priority, 0.0, 0.0, expected)
+        deadline = get_current_deadline()
+        with self._cond:
+            start, finish = self._fair.tag(user, priority, cost)
+            ticket = DispatchTicket(self, user, priority, start, finish, expected)
+            self.waiting.append(ticket)
+            self._dispatch_locked()
+            if not ticket.granted:
+                print(f"[SCHED] Holding {priority} prompt of {user or 'anonymous'} for {self.url} "
+                      f"({self.inflight} in flight, {len(self.waiting)} waiting)")
+            while not ticket.granted:
+                if cancel_event is not None and cancel_event.is_set():
+                    self._abandon_locked(ticket)
+                    return ticket
+                timeout = _WAIT_SLICE
+                if deadline is not None:
+                    if deadline.expired:
+                        self._abandon_locked(ticket)
+                        raise deadline_error("waiting for a dispatch slot")
+                    timeout = min(timeout, deadline.remaining())
+                self._cond.wait(timeout)
+        return ticket
+
+    def _abandon_locked(self, ticket):
+        if ticket in self.waiting:
+            self.waiting.remove(ticket)
+        ticket.released = True
+        self._dispatch_locked()
+
+    def _release(self, ticket):
+        with self._cond:
+            if ticket.released:
+                return
+            ticket.released = True
+            if ticket.granted:
+                self.inflight -= 1
+            elif ticket in self.waiting:
+                self.waiting.remove(ticket)
+            self._dispatch_locked()
+
+    def to_dict(self):
+        with self._cond:
+            waiting_by_user = {}
+            for ticket in self.waiting:
+                key = f"{ticket.user or 'anonymous'}/{ticket.priority}"
+                waiting_by_user[key] = waiting_by_user.get(key, 0) + 1
+            return {
+                "window": self.window,
+                "policy": self.policy,
+                "inflight": self.inflight,
+                "waiting": len(self.waiting),
+                "waiting_by_flow": waiting_by_user,
+                "dispatched": dict(self.dispatched),
+                "avg_wait": {
+                    priority: round(self.total_wait[priority] / count, 3) if count else None
+                    for priority, count in self.dispatched.items()
+                },
+            }
+
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+
+def get_scheduler(base_url):
+    """Scheduler of a backend URL, created on first use."""
+    key = (base_url or '').rstrip('/')
+    with _schedulers_lock:
+        scheduler = _schedulers.get(key)
+        if scheduler is None:
+            scheduler = _schedulers[key] = BackendScheduler(key)
+        return scheduler
+
+
+def acquire_dispatch_slot(base_url, cancel_event=None, cost=1.0, expected=None):
+    """Wait for a slot in a backend's window for a prompt of the current thread's user and priority."""
+    user, priority = get_dispatch_context() or (None, PRIORITY_INTERACTIVE)
+    return get_scheduler(base_url).acquire(user, priority, cost=cost, cancel_event=cancel_event, expected=expected)
+
+
+def get_scheduler_status():
+    """Window occupancy, waiting prompts per flow and average waits of every backend."""
+    with _schedulers_lock:
+        schedulers = list(_schedulers.values())
+    return {scheduler.url: scheduler.to_dict() for scheduler in schedulers}
@@ -0,0 +1,234 @@
+"""
+ComfyUI node schema cache and workflow validation
+Fetches each backend's /object_info once per TTL and checks patched workflows
+against it (node classes, required inputs, enum and numeric ranges) so a bad
+prompt is rejected locally instead of taking a queue slot on the GPU backend
+"""
+import time
+import threading
+import requests
+from config import COMFY_VALIDATE_WORKFLOWS, COMFY_OBJECT_INFO_TTL, COMFY_HTTP_CONNECT_TIMEOUT, COMFY_HTTP_READ_TIMEOUT
+from utils.comfy_config import get_comfy_url
+from utils.comfy_http import comfy_get
+from utils.comfy_health import BackendUnavailableError
+
+# A failed validation refetches /object_info (new models or nodes) at most this often
+_REFRESH_ON_ERROR_MIN_AGE = 30.0
+# After a failed fetch the backend is not asked again for this long
+_FETCH_RETRY_DELAY = 30.0
+# Errors meaning the backend lacks a node or model, rather than a bad request value
+CAPABILITY_ERROR_TYPES = ('missing_node_type', 'value_not_in_list')
+
+# base_url -> (fetched_at, object_info)
+_object_info_cache = {}
+_cache_lock = threading.Lock()
+_fetch_locks = {}
+_fetch_failed_at = {}
+
+
+class WorkflowValidationError(ValueError):
+    """Raised when a workflow does not match the node schema of its backend."""
+
+    def __init__(self, errors, backend_url=None):
+        self.errors = errors
+        self.backend_url = backend_url
+        summary = "; ".join(error["message"] for error in errors[:3])
+        if len(errors) > 3:
+            summary += f" (+{len(errors) - 3} more)"
+        super().__init__(f"Workflow rejected before queueing: {summary}")
+
+    def to_dict(self):
+        return {
+            "status": "invalid_workflow",
+            "backend_url": self.backend_url,
+            "errors": self.errors,
+        }
+
+
+def _fetch_lock(base_url):
+    with _cache_lock:
+        return _fetch_locks.setdefault(base_url, threading.Lock())
+
+
+def get_object_info(mode='generate', base_url=None, max_age=None):
+    """Cached /object_info of a backend, or None if it cannot be fetched.
+
+    Args:
+        mode: Mode whose backend is used when base_url is not given
+        base_url: Explicit backend URL
+        max_age: Refetch when the cached copy is older than this (default: COMFY_OBJECT_INFO_TTL)
+    """
+    base_url = (base_url or get_comfy_url(mode)).rstrip('/')
+    max_age = COMFY_OBJECT_INFO_TTL if max_age is None else max_age
+    cached = _object_info_cache.get(base_url)
+    if cached and time.time() - cached[0] < max_age:
+        return cached[1]
+
+    with _fetch_lock(base_url):
+        cached = _object_info_cache.get(base_url)
+        if cached and time.time() - cached[0] < max_age:
+            return cached[1]
+        if max_age > 0 and time.time() - _fetch_failed_at.get(base_url, 0) < _FETCH_RETRY_DELAY:
+            return cached[1] if cached else None
+        try:
+            response = comfy_get(
+                "/object_info",
+                mode=mode,
+                base_url=base_url,
+                timeout=(COMFY_HTTP_CONNECT_TIMEOUT, COMFY_HTTP_READ_TIMEOUT)
+            )
+            response.raise_for_status()
+            object_info = response.json()
+        except (requests.exceptions.RequestException, BackendUnavailableError, ValueError) as e:
+            print(f"[SCHEMA] Could not fetch /object_info from {base_url}: {e}")
+            _fetch_failed_at[base_url] = time.time()
+            # Keep validating against the stale copy rather than not at all
+            return cached[1] if cached else None
+        if not isinstance(object_info, dict) or not object_info:
+            return cached[1] if cached else None
+        _object_info_cache[base_url] = (time.time(), object_info)
+        _fetch_failed_at.pop(base_url, None)
+        print(f"[SCHEMA] Cached {len(object_info)} node classes from {base_url}")
+        return object_info
+
+
+def object_info_age(base_url):
+    """Seconds since the backend's /object_info was fetched, or None."""
+    cached = _object_info_cache.get((base_url or '').rstrip('/'))
+    return time.time() - cached[0] if cached else None
+
+
+def invalidate_object_info(base_url=None):
+    """Drop the cached /object_info of one backend (or of all of them)."""
+    with _cache_lock:
+        if base_url is None:
+            _object_info_cache.clear()
+        else:
+            _object_info_cache.pop(base_url.rstrip('/'), None)
+
+
+def _is_link(value):
+    """Inputs wired to another node are [node_id, output_index]."""
+    return isinstance(value, list) and len(value) == 2 and isinstance(value[1], int)
+
+
+def _enum_options(spec):
+    """Allowed values of a combo input, or None if the input is not a closed enum."""
+    if not isinstance(spec, (list, tuple)) or not spec:
+        return None
+    input_type = spec[0]
+    options = spec[1] if len(spec) > 1 and isinstance(spec[1], dict) else {}
+    # Upload widgets accept files that were uploaded after the schema was cached
+    if any(key.endswith('_upload') for key in options):
+        return None
+    if isinstance(input_type, list):
+        return input_type or None
+    if input_type == "COMBO" and isinstance(options.get("options"), list):
+        return options["options"] or None
+    return None
+
+
+def _check_input(node_id, class_type, name, value, spec, errors):
+    if _is_link(value):
+        return
+    choices = _enum_options(spec)
+    if choices is not None:
+        if value not in choices:
+            errors.append({
+                "node_id": node_id,
+                "class_type": class_type,
+                "input": name,
+                "value": value,
+                "type": "value_not_in_list",
+                "message": f"node {node_id} ({class_type}): {name} '{value}' is not available",
+            })
+        return
+    if not isinstance(spec, (list, tuple)) or spec[0] not in ("INT", "FLOAT"):
+        return
+    options = spec[1] if len(spec) > 1 and isinstance(spec[1], dict) else {}
+    if not isinstance(value, (int, float)) or isinstance(value, bool):
+        return
+    low, high = options.get("min"), options.get("max")
+    if (low is not None and value < low) or (high is not None and value > high):
+        errors.append({
+            "node_id": node_id,
+            "class_type": class_type,
+            "input": name,
+            "type": "value_out_of_range",
+            "message": f"node {node_id} ({class_type}): {name}={value} is outside [{low}, {high}]",
+        })
+
+
+def validate_workflow(workflow, object_info):
+    """Check a workflow against /object_info and return a list of error dicts."""
+    errors = []
+    for node_id, node in workflow.items():
+        if not isinstance(node, dict):
+            continue
+        class_type = node.get("class_type")
+        schema = object_info.get(class_type)
+        if schema is None:
+            errors.append({
+                "node_id": node_id,
+                "class_type": class_type,
+                "type": "missing_node_type",
+                "message": f"node {node_id}: class '{class_type}' is not installed on the backend",
+            })
+            continue
+        inputs = node.get("inputs") or {}
+        declared = schema.get("input") or {}
+        required = declared.get("required") or {}
+        optional = declared.get("optional") or {}
+        for name, spec in required.items():
+            if name not in inputs:
+                errors.append({
+                    "node_id": node_id,
+                    "class_type": class_type,
+                    "input": name,
+                    "type": "required_input_missing",
+                    "message": f"node {node_id} ({class_type}): required input '{name}' is missing",
+                })
+                continue
+            _check_input(node_id, class_type, name, inputs[name], spec, errors)
+        for name, spec in optional.items():
+            if name in inputs:
+                _check_input(node_id, class_type, name, inputs[name], spec, errors)
+    return errors
+
+
+def missing_capabilities(workflow, object_info):
+    """Node classes and models the workflow needs that the schema does not offer."""
+    return [error for error in validate_workflow(workflow, object_info) if error["type"] in CAPABILITY_ERROR_TYPES]
+
+
+def backend_supports(workflow, base_url):
+    """Whether a backend has every node and model of a workflow (None if unknown)."""
+    object_info = get_object_info(base_url=base_url)
+    if not object_info:
+        return None
+    return not missing_capabilities(workflow, object_info)
+
+
+def validate_prompt(workflow, mode='generate'):
+    """Validate a workflow against the backend it will be queued on.
+
+    Validation is skipped when it is disabled or the backend's schema is not
+    available. Before rejecting, a schema older than a few seconds is
+    refetched once in case a model or custom node was just installed.
+
+    Raises:
+        WorkflowValidationError: If the workflow cannot run on the backend
+    """
+    if not COMFY_VALIDATE_WORKFLOWS:
+        return
+    base_url = get_comfy_url(mode).rstrip('/')
+    object_info = get_object_info(mode, base_url=base_url)
+    if not object_info:
+        return
+    errors = validate_workflow(workflow, object_info)
+    if errors and (object_info_age(base_url) or 0) > _REFRESH_ON_ERROR_MIN_AGE:
+        object_info = get_object_info(mode, base_url=base_url, max_age=0)
+        errors = validate_workflow(workflow, object_info) if object_info else []
+    if errors:
+        print(f"[SCHEMA] Rejected workflow for {base_url}: {len(errors)} error(s)")
+        raise WorkflowValidationError(errors, backend_url=base_url)
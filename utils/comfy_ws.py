@@ -0,0 +1,350 @@
+"""
+ComfyUI WebSocket listener
+One persistent, auto-reconnecting socket per backend that routes execution
+events to waiters keyed by prompt_id
+"""
+import json
+import time
+import threading
+from collections import OrderedDict
+from urllib.parse import urlparse
+import websocket
+from config import COMFY_CLIENT_ID, COMFY_WS_PING_INTERVAL, COMFY_WS_RECONNECT_MAX_DELAY
+from utils.comfy_config import get_comfy_url, get_comfy_urls, build_comfy_headers
+
+# Waiters kept around after they finished so late registrations still see the result
+MAX_TRACKED_PROMPTS = 512
+
+# Called as observer(base_url, is_open, elapsed_seconds) when a socket opens or closes (see utils.keep_warm)
+_socket_observer = None
+
+
+def set_socket_observer(observer):
+    """Register the callable told when a backend socket opens (with its connect time) or closes."""
+    global _socket_observer
+    _socket_observer = observer
+
+
+def _notify_socket(base_url, is_open, elapsed=0.0):
+    if _socket_observer is not None:
+        try:
+            _socket_observer(base_url, is_open, elapsed)
+        except Exception as e:
+            print(f"[WS] Socket observer error for {base_url}: {e}")
+
+
+def get_comfy_client_id():
+    """Get the app-level client_id used for every prompt and WebSocket."""
+    return COMFY_CLIENT_ID
+
+
+def build_ws_url(base_url, client_id=None):
+    """Build the /ws URL of a backend from its HTTP base URL."""
+    parsed = urlparse(base_url)
+    scheme = "wss" if parsed.scheme == "https" else "ws"
+    path = parsed.path.rstrip('/')
+    return f"{scheme}://{parsed.netloc}{path}/ws?clientId={client_id or COMFY_CLIENT_ID}"
+
+
+class PromptWaiter:
+    """Execution state of a single prompt as reported by the WebSocket."""
+
+    def __init__(self, prompt_id):
+        self.prompt_id = prompt_id
+        self.done = threading.Event()
+        self.status = None  # None while pending, then 'success', 'error', 'interrupted' or 'cancelled'
+        self.started = False
+        # When the backend began executing the prompt (first execution event)
+        self.started_at = None
+        self.current_node = None
+        self.progress = None
+        self.executed_nodes = {}
+        self.cached_nodes = []
+        self.error = None
+        self.updated_at = time.time()
+        self._callbacks = []
+
+    def add_callback(self, callback):
+        """Register a callable invoked as callback(waiter, event_type) on each event."""
+        self._callbacks.append(callback)
+
+    def remove_callback(self, callback):
+        try:
+            self._callbacks.remove(callback)
+        except ValueError:
+            pass
+
+    def wait(self, timeout=None):
+        """Block until the prompt reaches a terminal state or timeout; return True if done."""
+        return self.done.wait(timeout)
+
+    def cancel(self):
+        """Release whoever waits on this prompt because it was cancelled locally."""
+        self._finish("cancelled")
+
+    def _finish(self, status, error=None):
+        if self.done.is_set():
+            return
+        self.status = status
+        self.error = error
+        self.done.set()
+
+    def _handle(self, event_type, data):
+        self.updated_at = time.time()
+        if self.started_at is None and event_type in ("execution_start", "execution_cached", "executing", "progress"):
+            self.started_at = self.updated_at
+        if event_type == "execution_start":
+            self.started = True
+        elif event_type == "execution_cached":
+            self.started = True
+            self.cached_nodes.extend(data.get("nodes") or [])
+        elif event_type == "executing":
+            node = data.get("node")
+            if node is None:
+                # Legacy end-of-prompt signal
+                self.current_node = None
+                self._finish("success")
+            else:
+                self.started = True
+                self.current_node = node
+        elif event_type == "progress":
+            self.progress = {
+                "value": data.get("value"),
+                "max": data.get("max"),
+                "node": data.get("node"),
+            }
+        elif event_type == "executed":
+            node = data.get("node")
+            if node is not None:
+                self.executed_nodes[str(node)] = data.get("output") or {}
+        elif event_type == "execution_success":
+            self._finish("success")
+        elif event_type == "execution_error":
+            self._finish("error", {
+                "node_id": data.get("node_id"),
+                "node_type": data.get("node_type"),
+                "exception_type": data.get("exception_type"),
+                "exception_message": data.get("exception_message"),
+            })
+        elif event_type == "execution_interrupted":
+            self._finish("interrupted", {
+                "node_id": data.get("node_id"),
+                "node_type": data.get("node_type"),
+                "exception_message": "Execution interrupted",
+            })
+
+        for callback in list(self._callbacks):
+            try:
+                callback(self, event_type)
+            except Exception as e:
+                print(f"[WS] Waiter callback error for {self.prompt_id}: {e}")
+
+
+class ComfyWebSocketListener:
+    """Persistent WebSocket connection to one ComfyUI backend."""
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.ws_url = build_ws_url(base_url)
+        self.connected = threading.Event()
+        self._waiters = OrderedDict()
+        self._watched = set()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        # Cleared while the listener is suspended (the socket stays closed until the next start)
+        self._awake = threading.Event()
+        self._awake.set()
+        self._attempt_started = None
+        self._ws = None
+        self._thread = None
+
+    @property
+    def suspended(self):
+        return not self._awake.is_set()
+
+    def start(self):
+        """Start the background connection thread if it is not running, or resume a suspended one."""
+        with self._lock:
+            self._awake.set()
+            if self._thread and self._thread.is_alive():
+                return
+            self._stopped.clear()
+            self._thread = threading.Thread(
+                target=self._run,
+                name=f"comfy-ws-{urlparse(self.base_url).netloc}",
+                daemon=True
+            )
+            self._thread.start()
+
+    def suspend(self):
+        """Close the socket until the next start() so an idle serverless backend can scale down.
+
+        Refused (False) while a prompt on this backend is being waited on.
+        """
+        with self._lock:
+            if self._watched or not self._awake.is_set():
+                return False
+            self._awake.clear()
+        ws = self._ws
+        if ws:
+            try:
+                ws.close()
+            except Exception:
+                pass
+        return True
+
+    def stop(self):
+        """Stop the listener and close its socket."""
+        self._stopped.set()
+        self._awake.set()
+        ws = self._ws
+        if ws:
+            try:
+                ws.close()
+            except Exception:
+                pass
+
+    def _run(self):
+        delay = 1.0
+        while not self._stopped.is_set():
+            if not self._awake.is_set():
+                self._awake.wait()
+                delay = 1.0
+                continue
+            headers = build_comfy_headers()
+            ws_header = [f"{key}: {value}" for key, value in headers.items()] if headers else None
+            self._ws = websocket.WebSocketApp(
+                self.ws_url,
+                on_open=self._on_open,
+                on_message=self._on_message,
+                on_error=self._on_error,
+                on_close=self._on_close,
+                header=ws_header
+            )
+            started_at = self._attempt_started = time.time()
+            try:
+                self._ws.run_forever(ping_interval=COMFY_WS_PING_INTERVAL, ping_timeout=10)
+            except Exception as e:
+                print(f"[WS] Listener error for {self.base_url}: {e}")
+            if self.connected.is_set():
+                self.connected.clear()
+                _notify_socket(self.base_url, False)
+            if self._stopped.is_set():
+                break
+            if not self._awake.is_set():
+                continue
+            # Reset the backoff after a connection that stayed up for a while
+            if time.time() - started_at > 60:
+                delay = 1.0
+            self._stopped.wait(delay)
+            delay = min(delay * 2, COMFY_WS_RECONNECT_MAX_DELAY)
+
+    def _on_open(self, ws):
+        self.connected.set()
+        print(f"[WS] Connected to {self.base_url}")
+        _notify_socket(self.base_url, True, time.time() - (self._attempt_started or time.time()))
+
+    def _on_error(self, ws, error):
+        print(f"[WS] Error on {self.base_url}: {error}")
+
+    def _on_close(self, ws, close_status_code, close_msg):
+        pass
+
+    def _on_message(self, ws, message):
+        # Binary frames carry preview images; only JSON events are relevant
+        if not isinstance(message, str):
+            return
+        try:
+            payload = json.loads(message)
+        except ValueError:
+            return
+        data = payload.get("data") or {}
+        prompt_id = data.get("prompt_id")
+        if not prompt_id:
+            return
+        self._get_or_create(prompt_id)._handle(payload.get("type"), data)
+
+    def _get_or_create(self, prompt_id):
+        with self._lock:
+            waiter = self._waiters.get(prompt_id)
+            if waiter is None:
+                waiter = PromptWaiter(prompt_id)
+                self._waiters[prompt_id] = waiter
+                self._prune_locked()
+            return waiter
+
+    def _prune_locked(self):
+        excess = len(self._waiters) - MAX_TRACKED_PROMPTS
+        for prompt_id in list(self._waiters):
+            if excess <= 0:
+                break
+            if prompt_id in self._watched:
+                continue
+            del self._waiters[prompt_id]
+            excess -= 1
+
+    def register(self, prompt_id):
+        """Get the waiter for a prompt, including events received before registration."""
+        with self._lock:
+            self._watched.add(prompt_id)
+        self.start()
+        return self._get_or_create(prompt_id)
+
+    def cancel(self, prompt_id):
+        """Wake the thread waiting on a prompt that was cancelled; False if nobody waits on it."""
+        with self._lock:
+            waiter = self._waiters.get(prompt_id) if prompt_id in self._watched else None
+        if waiter is None:
+            return False
+        waiter.cancel()
+        return True
+
+    def release(self, prompt_id):
+        """Forget a prompt once its caller no longer needs its events."""
+        with self._lock:
+            self._watched.discard(prompt_id)
+            self._waiters.pop(prompt_id, None)
+
+
+_listeners = {}
+_listeners_lock = threading.Lock()
+
+
+def get_ws_listener(mode='generate', base_url=None):
+    """Get (and start) the listener for a backend URL or the current URL of a mode."""
+    url = (base_url or get_comfy_url(mode)).rstrip('/')
+    with _listeners_lock:
+        listener = _listeners.get(url)
+        if listener is None:
+            listener = ComfyWebSocketListener(url)
+            _listeners[url] = listener
+    listener.start()
+    return listener
+
+
+def start_ws_listeners(modes=('generate', 'edit', 'video'), allowed=None):
+    """Start the listeners of every configured backend of each mode.
+
+    allowed(url) can leave some backends without a socket until their first
+    prompt (idle serverless backends, see utils.keep_warm).
+    """
+    for mode in modes:
+        for url in get_comfy_urls(mode):
+            if url and (allowed is None or allowed(url)):
+                get_ws_listener(mode, base_url=url)
+
+
+def suspend_ws_listener(base_url):
+    """Close a backend's socket until it is needed again; False if it has none or a prompt is being waited on."""
+    with _listeners_lock:
+        listener = _listeners.get((base_url or '').rstrip('/'))
+    return listener.suspend() if listener is not None else False
+
+
+def stop_ws_listeners():
+    """Stop every listener."""
+    with _listeners_lock:
+        listeners = list(_listeners.values())
+        _listeners.clear()
+    for listener in listeners:
+        listener.stop()
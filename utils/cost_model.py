@@ -0,0 +1,321 @@
+"""
+Generation cost model
+Records how long every prompt waited in its backend's queue and how long it
+executed, together with its workflow, models, size, steps, length/fps and
+backend. From that history each (backend, workflow) pair gets a small linear
+model of execution time on the prompt's work (megapixels x steps x frames).
+Estimates drive the ETAs of /api/status, the adaptive execution timeout of
+wait_for_completion and the optional shortest-expected-job-first dispatch
+policy of utils.comfy_scheduler
+"""
+import time
+import threading
+from collections import deque
+from config import COST_MODEL_HISTORY, COST_MODEL_MIN_SAMPLES, COST_MODEL_TIMEOUT_FACTOR, COST_MODEL_TIMEOUT_MARGIN
+from utils.comfy_config import normalize_mode
+from utils.comfy_pool import set_generation_profile, get_generation_profile
+from utils.job_store import save_duration_sample, load_duration_samples
+from utils.jobs import get_current_job
+from utils.workflow import get_workflow_models
+
+# Samples of one exact profile used for its median
+_EXACT_WINDOW = 20
+# Weight of the newest sample in the average queue wait
+_QUEUE_SMOOTHING = 0.2
+
+
+def _number(value, cast=int):
+    try:
+        number = cast(value)
+    except (TypeError, ValueError):
+        return None
+    return number if number > 0 else None
+
+
+def _median(values):
+    ordered = sorted(values)
+    middle = len(ordered) // 2
+    if len(ordered) % 2:
+        return ordered[middle]
+    return (ordered[middle - 1] + ordered[middle]) / 2
+
+
+class GenerationProfile:
+    """Workflow and size of one generation: what its duration depends on."""
+
+    def __init__(self, mode='generate', workflow=None, models=None, width=None, height=None, steps=None,
+                 length=None, fps=None):
+        self.mode = normalize_mode(mode)
+        self.workflow = workflow
+        self.models = tuple(models) if models else None
+        self.width = _number(width)
+        self.height = _number(height)
+        self.steps = _number(steps)
+        self.length = _number(length)
+        self.fps = _number(fps, float)
+
+    @property
+    def work(self):
+        """Megapixels x steps x frames; factors that are unknown count as 1."""
+        megapixels = (self.width * self.height / 1e6) if self.width and self.height else 1.0
+        return megapixels * (self.steps or 1) * (self.length or 1)
+
+    def exact_key(self):
+        return (self.workflow, self.models, self.width, self.height, self.steps, self.length, self.fps)
+
+    @classmethod
+    def from_params(cls, mode, kind, params):
+        """Best-effort profile of a job that has not started yet, from its call arguments."""
+        kwargs = (params or {}).get("kwargs") or {}
+        mode = normalize_mode(mode)
+        if mode == 'video':
+            workflow = 'video_nsfw' if kwargs.get('nsfw') else 'video_no_sound' if kwargs.get('no_sound') else 'video'
+        elif mode == 'edit':
+            workflow = 'edit'
+        else:
+            workflow = kwargs.get('model') or 'lumina'
+        return cls(mode, workflow, width=kwargs.get('width'), height=kwargs.get('height'),
+                   steps=kwargs.get('steps'), length=kwargs.get('length'), fps=kwargs.get('fps'))
+
+    @classmethod
+    def from_record(cls, record):
+        return cls(record['mode'], record.get('workflow'), record.get('models'), record.get('width'),
+                   record.get('height'), record.get('steps'), record.get('length'), record.get('fps'))
+
+    def to_record(self):
+        return {
+            "mode": self.mode,
+            "workflow": self.workflow,
+            "models": list(self.models) if self.models else None,
+            "width": self.width,
+            "height": self.height,
+            "steps": self.steps,
+            "length": self.length,
+            "fps": self.fps,
+        }
+
+
+class _Sample:
+    __slots__ = ('key', 'work', 'queue_seconds', 'execution_seconds')
+
+    def __init__(self, key, work, queue_seconds, execution_seconds):
+        self.key = key
+        self.work = work
+        self.queue_seconds = queue_seconds
+        self.execution_seconds = execution_seconds
+
+
+def _fit(samples):
+    """(intercept, seconds per work unit) of execution time; proportional when work does not vary."""
+    count = len(samples)
+    mean_work = sum(sample.work for sample in samples) / count
+    mean_seconds = sum(sample.execution_seconds for sample in samples) / count
+    variance = sum((sample.work - mean_work) ** 2 for sample in samples)
+    if variance > 1e-9 * max(mean_work ** 2, 1e-9):
+        slope = sum((sample.work - mean_work) * (sample.execution_seconds - mean_seconds) for sample in samples) / variance
+        intercept = mean_seconds - slope * mean_work
+        if slope >= 0 and intercept >= 0:
+            return intercept, slope
+    return 0.0, mean_seconds / mean_work if mean_work else 0.0
+
+
+class CostModel:
+    """Duration history and estimates per backend and workflow."""
+
+    def __init__(self, history=COST_MODEL_HISTORY, min_samples=COST_MODEL_MIN_SAMPLES,
+                 timeout_factor=COST_MODEL_TIMEOUT_FACTOR, timeout_margin=COST_MODEL_TIMEOUT_MARGIN):
+        self.history = max(1, history)
+        self.min_samples = max(1, min_samples)
+        self.timeout_factor = timeout_factor
+        self.timeout_margin = timeout_margin
+        # (mode, backend_url, workflow) -> recent samples
+        self._samples = {}
+        # backend_url or mode -> average queue wait
+        self._queue_wait = {}
+        self._store_enabled = False
+        self._lock = threading.Lock()
+
+    def enable_store(self):
+        """Load the recorded history and start persisting new samples."""
+        records = load_duration_samples()
+        for record in records:
+            self.record(GenerationProfile.from_record(record), record.get('backend_url'),
+                        record.get('queue_seconds'), record['execution_seconds'], persist=False)
+        self._store_enabled = True
+        return len(records)
+
+    def record(self, profile, backend_url, queue_seconds, execution_seconds, persist=True):
+        """Add one measured generation."""
+        if execution_seconds is None or execution_seconds <= 0:
+            return
+        url = (backend_url or '').rstrip('/')
+        sample = _Sample(profile.exact_key(), profile.work, queue_seconds, execution_seconds)
+        with self._lock:
+            group = self._samples.get((profile.mode, url, profile.workflow))
+            if group is None:
+                group = self._samples[(profile.mode, url, profile.workflow)] = deque(maxlen=self.history)
+            group.append(sample)
+            if queue_seconds is not None and queue_seconds >= 0:
+                for key in (url, profile.mode):
+                    average = self._queue_wait.get(key)
+                    self._queue_wait[key] = queue_seconds if average is None else \
+                        average + _QUEUE_SMOOTHING * (queue_seconds - average)
+        if persist and self._store_enabled:
+            save_duration_sample({
+                **profile.to_record(),
+                "recorded_at": time.time(),
+                "backend_url": url,
+                "queue_seconds": queue_seconds,
+                "execution_seconds": execution_seconds,
+            })
+
+    def _group_locked(self, mode, url=None, workflow=None):
+        samples = []
+        for (group_mode, group_url, group_workflow), group in self._samples.items():
+            if group_mode == mode and (url is None or group_url == url) and (workflow is None or group_workflow == workflow):
+                samples.extend(group)
+        return samples
+
+    def estimate(self, profile, backend_url=None):
+        """Expected execution and queue seconds of a generation, or None without history.
+
+        The narrowest basis with enough samples wins: the same profile on the
+        same backend ('exact'), the workflow's fit on that backend ('backend'),
+        the workflow's fit on every backend ('workflow'), or the median of the
+        whole mode ('mode').
+        """
+        url = (backend_url or '').rstrip('/') or None
+        with self._lock:
+            execution, basis, count = None, None, 0
+            if url is not None:
+                samples = self._group_locked(profile.mode, url, profile.workflow)
+                exact = [sample for sample in samples if sample.key == profile.exact_key()][-_EXACT_WINDOW:]
+                if len(exact) >= self.min_samples:
+                    execution, basis, count = _median([sample.execution_seconds for sample in exact]), 'exact', len(exact)
+                elif len(samples) >= self.min_samples:
+                    intercept, slope = _fit(samples)
+                    execution, basis, count = intercept + slope * profile.work, 'backend', len(samples)
+            if execution is None:
+                samples = self._group_locked(profile.mode, workflow=profile.workflow)
+                if len(samples) >= self.min_samples:
+                    intercept, slope = _fit(samples)
+                    execution, basis, count = intercept + slope * profile.work, 'workflow', len(samples)
+            if execution is None:
+                samples = self._group_locked(profile.mode)
+                if not samples:
+                    return None
+                execution, basis, count = _median([sample.execution_seconds for sample in samples]), 'mode', len(samples)
+            queue = self._queue_wait.get(url) if url is not None else None
+            if queue is None:
+                queue = self._queue_wait.get(profile.mode, 0.0)
+        return {"execution": execution, "queue": queue, "basis": basis, "samples": count}
+
+    def execution_timeout(self, profile, backend_url=None):
+        """Seconds a prompt may execute before it is considered stuck, or None when the estimate is not trusted."""
+        if self.timeout_factor <= 0:
+            return None
+        estimate = self.estimate(profile, backend_url)
+        if estimate is None or estimate["basis"] == 'mode':
+            return None
+        return self.timeout_factor * estimate["execution"] + self.timeout_margin
+
+    def to_dict(self):
+        with self._lock:
+            groups = []
+            for (mode, url, workflow), samples in self._samples.items():
+                intercept, slope = _fit(list(samples))
+                groups.append({
+                    "mode": mode,
+                    "backend_url": url,
+                    "workflow": workflow,
+                    "samples": len(samples),
+                    "avg_execution": round(sum(sample.execution_seconds for sample in samples) / len(samples), 3),
+                    "fit": {"intercept": round(intercept, 3), "seconds_per_work_unit": round(slope, 4)},
+                })
+            queue_wait = {key: round(value, 3) for key, value in self._queue_wait.items()}
+        return {
+            "min_samples": self.min_samples,
+            "history": self.history,
+            "timeout_factor": self.timeout_factor,
+            "timeout_margin": self.timeout_margin,
+            "persisted": self._store_enabled,
+            "groups": groups,
+            "avg_queue_wait": queue_wait,
+        }
+
+
+cost_model = CostModel()
+
+
+def describe_generation(mode, workflow_name, workflow=None, **features):
+    """Declare the workflow and size of the generation about to run on the current thread.
+
+    features are width, height, steps, length and fps; the workflow's models
+    are read from the patched workflow. The profile is attached to the
+    thread's backend scope (for recording and timeouts) and to the current job
+    (for its ETA).
+    """
+    models = get_workflow_models(workflow) if workflow is not None else None
+    profile = GenerationProfile(mode, workflow_name, models, **features)
+    set_generation_profile(mode, profile)
+    job = get_current_job()
+    if job is not None:
+        job.profile = profile
+    return profile
+
+
+def record_generation(mode, backend_url, queue_seconds, execution_seconds):
+    """Record a finished prompt of the current thread; ignored when no profile was declared."""
+    profile = get_generation_profile(mode)
+    if profile is not None:
+        cost_model.record(profile, backend_url, queue_seconds, execution_seconds)
+
+
+def expected_prompt_seconds(mode, backend_url):
+    """Expected execution seconds of the current thread's prompt on a backend, or None."""
+    profile = get_generation_profile(mode)
+    estimate = cost_model.estimate(profile, backend_url) if profile is not None else None
+    return estimate["execution"] if estimate else None
+
+
+def prompt_execution_timeout(mode, backend_url):
+    """Adaptive execution timeout of the current thread's prompt (see CostModel.execution_timeout)."""
+    profile = get_generation_profile(mode)
+    return cost_model.execution_timeout(profile, backend_url) if profile is not None else None
+
+
+def estimate_job_eta(job):
+    """Expected finish time of an unfinished job, or None without history.
+
+    A job that is executing has its estimate scaled by the progress left; one
+    that has not started adds the recent average queue wait of its backend.
+    """
+    if job.is_finished:
+        return None
+    profile = getattr(job, 'profile', None) or GenerationProfile.from_params(job.mode, job.kind, job.params)
+    estimate = cost_model.estimate(profile, job.backend_url)
+    if estimate is None:
+        return None
+    if job.stage == 'executing':
+        remaining = estimate["execution"] * (1.0 - min(1.0, max(0.0, job.progress or 0.0)))
+    else:
+        remaining = estimate["queue"] + estimate["execution"]
+    return {
+        "eta": round(time.time() + remaining, 3),
+        "remaining_seconds": round(remaining, 1),
+        "expected_execution": round(estimate["execution"], 1),
+        "basis": estimate["basis"],
+        "samples": estimate["samples"],
+    }
+
+
+def init_cost_model():
+    """Load the recorded durations and persist new ones in the job store."""
+    count = cost_model.enable_store()
+    if count:
+        print(f"[COST] Loaded {count} measured generation(s)")
+
+
+def get_cost_model_status():
+    """Sample counts, fitted coefficients and average queue waits of every backend and workflow."""
+    return cost_model.to_dict()
@@ -0,0 +1,137 @@
+"""
+Request deadlines
+Every generation runs under a deadline derived from its mode (image or video)
+and an optional client hint. The deadline is bound to the thread doing the
+work, so each downstream ComfyUI call uses the remaining budget as its timeout
+and running out raises DeadlineExceeded (HTTP 504) instead of pinning a worker
+"""
+import time
+import threading
+from contextlib import contextmanager
+from config import REQUEST_DEADLINE_IMAGE, REQUEST_DEADLINE_VIDEO, REQUEST_DEADLINE_MIN
+from utils.comfy_config import normalize_mode
+
+_deadline_context = threading.local()
+
+
+class DeadlineExceeded(Exception):
+    """Raised when a request runs out of its time budget."""
+
+    def __init__(self, budget=None, stage=None):
+        self.budget = budget
+        self.stage = stage
+        message = "Request deadline exceeded"
+        if budget is not None:
+            message += f" ({budget:g}s budget)"
+        if stage:
+            message += f" while {stage}"
+        super().__init__(message)
+
+    def to_dict(self):
+        return {
+            "status": "deadline_exceeded",
+            "budget": self.budget,
+            "stage": self.stage,
+        }
+
+
+class Deadline:
+    """Absolute point in time by which a request must finish."""
+
+    def __init__(self, budget, started_at=None):
+        self.budget = float(budget)
+        self.started_at = started_at if started_at is not None else time.time()
+        self.expires_at = self.started_at + self.budget
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.time())
+
+    @property
+    def expired(self):
+        return time.time() >= self.expires_at
+
+    def check(self, stage=None):
+        """Raise DeadlineExceeded if the budget is spent."""
+        if self.expired:
+            raise DeadlineExceeded(self.budget, stage)
+
+
+def resolve_deadline_budget(mode='generate', hint=None):
+    """Seconds a request of a mode may take.
+
+    A client hint can only shorten the mode's budget, and never below
+    REQUEST_DEADLINE_MIN.
+    """
+    budget = REQUEST_DEADLINE_VIDEO if normalize_mode(mode) == 'video' else REQUEST_DEADLINE_IMAGE
+    try:
+        hint = float(hint) if hint is not None else None
+    except (TypeError, ValueError):
+        hint = None
+    if hint and hint > 0:
+        budget = min(budget, max(hint, REQUEST_DEADLINE_MIN))
+    return budget
+
+
+def get_deadline_hint(data, args=None):
+    """Client time budget in seconds ("timeout" in the body or the query string), or None."""
+    value = (data or {}).get('timeout')
+    if value is None and args is not None:
+        value = args.get('timeout')
+    return value
+
+
+def get_current_deadline():
+    """Deadline bound to the current thread, or None."""
+    return getattr(_deadline_context, 'deadline', None)
+
+
+@contextmanager
+def deadline_scope(budget=None, deadline=None, detached=False):
+    """Bind a deadline to the current thread; a nested scope can only shorten it.
+
+    detached ignores the outer deadline, for work the thread only hands over
+    on behalf of someone else (e.g. a job scheduled when another frees a slot).
+    """
+    outer = get_current_deadline()
+    current = deadline if deadline is not None else Deadline(budget)
+    if not detached and outer is not None and outer.expires_at <= current.expires_at:
+        current = outer
+    _deadline_context.deadline = current
+    try:
+        yield current
+    finally:
+        _deadline_context.deadline = outer
+
+
+def deadline_error(stage=None):
+    """DeadlineExceeded for the current thread's deadline."""
+    deadline = get_current_deadline()
+    return DeadlineExceeded(deadline.budget if deadline is not None else None, stage)
+
+
+def check_deadline(stage=None):
+    """Raise DeadlineExceeded if the current thread's deadline has passed."""
+    deadline = get_current_deadline()
+    if deadline is not None:
+        deadline.check(stage)
+
+
+def bound_timeout(timeout, stage=None):
+    """Clamp a requests timeout (seconds or a (connect, read) tuple) to the remaining budget.
+
+    Returns (timeout, clamped); clamped is True when the deadline, not the
+    configured timeout, limits the call.
+
+    Raises:
+        DeadlineExceeded: If the budget is already spent
+    """
+    deadline = get_current_deadline()
+    if deadline is None or timeout is None:
+        return timeout, False
+    deadline.check(stage)
+    remaining = deadline.remaining()
+    if isinstance(timeout, tuple):
+        bounded = tuple(min(value, remaining) if value is not None else remaining for value in timeout)
+    else:
+        bounded = min(timeout, remaining)
+    return bounded, bounded != timeout
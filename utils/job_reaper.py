@@ -0,0 +1,139 @@
+"""
+Abandoned job reaper
+Async jobs submitted with "heartbeat": true are kept alive by their client
+(the web UI sends a heartbeat every few seconds while it waits). When the tab
+is closed or the client moves on, the heartbeats stop; once the grace period
+has passed the job is cancelled like an explicit stop, so its ComfyUI prompt
+is dequeued or interrupted instead of holding the GPU for nobody
+"""
+import time
+import threading
+from config import JOB_HEARTBEAT_GRACE, JOB_HEARTBEAT_INTERVAL
+from utils.comfy import cancel_generation
+from utils.comfy_pool import get_average_latency
+from utils.jobs import job_manager
+
+ABANDONED_REASON = "client stopped sending heartbeats"
+
+
+class JobReaper:
+    """Background thread cancelling jobs whose heartbeats lapsed."""
+
+    def __init__(self, grace=JOB_HEARTBEAT_GRACE, interval=JOB_HEARTBEAT_INTERVAL):
+        self.grace = grace
+        self.interval = interval
+        self.metrics = {
+            "reaped_jobs": 0,
+            "dequeued": 0,
+            "interrupted": 0,
+            "cancelled_before_queueing": 0,
+            # Estimated GPU seconds the reaped prompts would still have used
+            "gpu_seconds_reclaimed": 0.0,
+            # Estimated GPU seconds interrupted prompts had already used when they were stopped
+            "gpu_seconds_wasted": 0.0,
+            "last_reaped_at": None,
+        }
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def enabled(self):
+        return self.grace > 0
+
+    def _estimate(self, job, action):
+        """(reclaimed, wasted) GPU seconds of a reaped job.
+
+        A prompt is assumed to cost its backend's average latency; an
+        interrupted one had already used the share given by its progress.
+        """
+        average = get_average_latency(job.mode, job.backend_url) or get_average_latency(job.mode)
+        if average is None:
+            return 0.0, 0.0
+        if action == 'interrupted':
+            done = min(1.0, max(0.0, job.progress or 0.0))
+            return average * (1.0 - done), average * done
+        if action in ('dequeued', 'cancelled'):
+            return average, 0.0
+        return 0.0, 0.0
+
+    def reap(self, job):
+        """Cancel one abandoned job and account for it; returns the cancel result."""
+        now = time.time()
+        silent_for = now - (job.heartbeat_at or now)
+        result = cancel_generation(job.id, mode=job.mode, reason=ABANDONED_REASON)
+        action = (result or {}).get("action")
+        if action in (None, 'finished'):
+            return result
+        reclaimed, wasted = self._estimate(job, action)
+        with self._lock:
+            metrics = self.metrics
+            metrics["reaped_jobs"] += 1
+            if action == 'cancelled':
+                metrics["cancelled_before_queueing"] += 1
+            elif action in metrics:
+                metrics[action] += 1
+            metrics["gpu_seconds_reclaimed"] += reclaimed
+            metrics["gpu_seconds_wasted"] += wasted
+            metrics["last_reaped_at"] = now
+        print(f"[REAPER] Job {job.id} ({job.kind}) abandoned after {silent_for:.0f}s without heartbeat: "
+              f"{action}, ~{reclaimed:.1f}s of GPU time reclaimed")
+        return result
+
+    def reap_abandoned(self):
+        """Cancel every job whose heartbeats lapsed; returns how many were reaped."""
+        reaped = 0
+        for job in job_manager.abandoned_jobs(self.grace):
+            try:
+                if self.reap(job):
+                    reaped += 1
+            except Exception as e:
+                print(f"[REAPER] Could not cancel abandoned job {job.id}: {e}")
+        return reaped
+
+    def to_dict(self):
+        with self._lock:
+            metrics = dict(self.metrics)
+        metrics["gpu_seconds_reclaimed"] = round(metrics["gpu_seconds_reclaimed"], 1)
+        metrics["gpu_seconds_wasted"] = round(metrics["gpu_seconds_wasted"], 1)
+        return {
+            "enabled": self.enabled,
+            "heartbeat_interval": self.interval,
+            "heartbeat_grace": self.grace,
+            "watched_jobs": sum(1 for job in job_manager.list_jobs() if job.heartbeat_at is not None and not job.is_finished),
+            **metrics,
+        }
+
+    def start(self):
+        """Start the background reaper thread."""
+        with self._lock:
+            if not self.enabled or (self._thread and self._thread.is_alive()):
+                return
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name='job-reaper', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        # Check often enough that a job is reaped at most one interval after its grace ends
+        period = max(1.0, min(self.interval, self.grace / 2))
+        while not self._stopped.wait(period):
+            try:
+                self.reap_abandoned()
+            except Exception as e:
+                print(f"[REAPER] Reaper error: {e}")
+
+
+job_reaper = JobReaper()
+
+
+def start_job_reaper():
+    """Start cancelling abandoned jobs (no-op when JOB_HEARTBEAT_GRACE is 0)."""
+    job_reaper.start()
+
+
+def get_reaper_status():
+    """Heartbeat settings and how many abandoned jobs (and GPU seconds) were reclaimed."""
+    return job_reaper.to_dict()
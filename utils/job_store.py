@@ -0,0 +1,212 @@
+"""
+Durable job store
+Persists background jobs in SQLite (WAL mode) next to the tags database so
+in-flight ComfyUI prompts survive an application restart, along with the
+measured durations the generation cost model is fitted on. Finished jobs are
+deleted once they are older than JOB_STORE_MAX_AGE_SECONDS
+"""
+import os
+import json
+import sqlite3
+import threading
+import time
+from config import DATA_DIR, JOB_STORE_MAX_AGE_SECONDS
+
+JOBS_DB_PATH = os.path.join(DATA_DIR, 'jobs.db')
+
+# Columns stored as JSON text
+_JSON_COLUMNS = ('params', 'target_nodes', 'result', 'error_details')
+_COLUMNS = (
+    'id', 'kind', 'mode', 'user', 'state', 'stage', 'params', 'prompt_id',
+    'backend_url', 'target_nodes', 'media_key', 'result', 'error',
+    'error_details', 'created_at', 'started_at', 'finished_at', 'updated_at', 'priority',
+)
+# States of jobs that may still be resumed; every other row is finished
+_UNFINISHED_STATES = ('queued', 'running')
+_DURATION_COLUMNS = (
+    'recorded_at', 'mode', 'backend_url', 'workflow', 'models', 'width', 'height',
+    'steps', 'length', 'fps', 'queue_seconds', 'execution_seconds',
+)
+
+_write_lock = threading.Lock()
+
+
+def get_job_db_connection():
+    """Create a connection to the jobs database."""
+    conn = sqlite3.connect(JOBS_DB_PATH, timeout=10)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def init_job_store():
+    """Create the jobs table and switch the database to WAL mode."""
+    conn = get_job_db_connection()
+    try:
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                mode TEXT NOT NULL,
+                user TEXT,
+                state TEXT NOT NULL,
+                stage TEXT,
+                params TEXT,
+                prompt_id TEXT,
+                backend_url TEXT,
+                target_nodes TEXT,
+                media_key TEXT,
+                result TEXT,
+                error TEXT,
+                error_details TEXT,
+                created_at REAL,
+                started_at REAL,
+                finished_at REAL,
+                updated_at REAL,
+                priority TEXT
+            )
+        ''')
+        # Databases created before the priority column was added
+        columns = {row['name'] for row in conn.execute('PRAGMA table_info(jobs)')}
+        if 'priority' not in columns:
+            conn.execute('ALTER TABLE jobs ADD COLUMN priority TEXT')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_state ON jobs(state)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_prompt_id ON jobs(prompt_id)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_finished_at ON jobs(finished_at)')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS generation_durations (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                recorded_at REAL NOT NULL,
+                mode TEXT NOT NULL,
+                backend_url TEXT,
+                workflow TEXT,
+                models TEXT,
+                width INTEGER,
+                height INTEGER,
+                steps INTEGER,
+                length INTEGER,
+                fps REAL,
+                queue_seconds REAL,
+                execution_seconds REAL NOT NULL
+            )
+        ''')
+        _prune_finished_jobs(conn)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _prune_finished_jobs(conn, now=None):
+    """Delete finished jobs older than JOB_STORE_MAX_AGE_SECONDS (caller commits)."""
+    cutoff = (now or time.time()) - JOB_STORE_MAX_AGE_SECONDS
+    conn.execute(
+        f"DELETE FROM jobs WHERE state NOT IN ({','.join('?' * len(_UNFINISHED_STATES))}) "
+        "AND COALESCE(finished_at, updated_at, created_at) < ?",
+        (*_UNFINISHED_STATES, cutoff)
+    )
+
+
+def _encode(column, value):
+    if column in _JSON_COLUMNS and value is not None:
+        return json.dumps(value, default=str)
+    return value
+
+
+def _decode_row(row):
+    record = dict(row)
+    for column in _JSON_COLUMNS:
+        if record.get(column):
+            try:
+                record[column] = json.loads(record[column])
+            except ValueError:
+                record[column] = None
+    return record
+
+
+def save_job_record(record):
+    """Insert or replace a job record (dict keyed by column name)."""
+    values = [_encode(column, record.get(column)) for column in _COLUMNS]
+    placeholders = ','.join(['?'] * len(_COLUMNS))
+    with _write_lock:
+        conn = get_job_db_connection()
+        try:
+            conn.execute(
+                f"INSERT OR REPLACE INTO jobs ({','.join(_COLUMNS)}) VALUES ({placeholders})",
+                values
+            )
+            if record.get('state') not in _UNFINISHED_STATES:
+                # Age-based eviction, checked whenever a job finishes
+                _prune_finished_jobs(conn)
+            conn.commit()
+        except sqlite3.Error as e:
+            print(f"[JOBS] Error saving job {record.get('id')}: {e}")
+        finally:
+            conn.close()
+
+
+def load_job_record(job_or_prompt_id):
+    """Load a job by id or prompt_id; None if unknown."""
+    conn = get_job_db_connection()
+    try:
+        row = conn.execute(
+            'SELECT * FROM jobs WHERE id = ? OR prompt_id = ? ORDER BY created_at DESC LIMIT 1',
+            (job_or_prompt_id, job_or_prompt_id)
+        ).fetchone()
+        return _decode_row(row) if row else None
+    finally:
+        conn.close()
+
+
+def load_unfinished_job_records():
+    """Load every job that was queued or running when the process stopped."""
+    conn = get_job_db_connection()
+    try:
+        rows = conn.execute(
+            f"SELECT * FROM jobs WHERE state IN ({','.join('?' * len(_UNFINISHED_STATES))}) ORDER BY created_at",
+            _UNFINISHED_STATES
+        ).fetchall()
+        return [_decode_row(row) for row in rows]
+    finally:
+        conn.close()
+
+
+def save_duration_sample(record):
+    """Append one measured generation (dict keyed by column name; models is a list)."""
+    values = [
+        json.dumps(record.get(column)) if column == 'models' and record.get(column) is not None else record.get(column)
+        for column in _DURATION_COLUMNS
+    ]
+    with _write_lock:
+        conn = get_job_db_connection()
+        try:
+            conn.execute(
+                f"INSERT INTO generation_durations ({','.join(_DURATION_COLUMNS)}) "
+                f"VALUES ({','.join(['?'] * len(_DURATION_COLUMNS))})",
+                values
+            )
+            conn.commit()
+        except sqlite3.Error as e:
+            print(f"[JOBS] Error saving generation duration: {e}")
+        finally:
+            conn.close()
+
+
+def load_duration_samples(limit=5000):
+    """Load the most recent measured generations, oldest first."""
+    conn = get_job_db_connection()
+    try:
+        rows = conn.execute(
+            'SELECT * FROM generation_durations ORDER BY id DESC LIMIT ?', (limit,)
+        ).fetchall()
+    finally:
+        conn.close()
+    samples = []
+    for row in reversed(rows):
+        record = dict(row)
+        try:
+            record['models'] = json.loads(record['models']) if record.get('models') else None
+        except ValueError:
+            record['models'] = None
+        samples.append(record)
+    return samples
@@ -0,0 +1,523 @@
+"""
+Background job subsystem
+Runs long ComfyUI generations on the bounded worker pool (bulkhead) of their
+mode and tracks their state, stage and progress so submit endpoints can return
+immediately. Jobs are mirrored to the SQLite job store so they can be resumed
+after a restart. Each job runs under a request deadline counted from its
+submission, and jobs whose client asked for heartbeats are reaped once those
+heartbeats stop
+"""
+import time
+import uuid
+import threading
+import traceback
+from config import JOB_RETENTION_SECONDS, JOB_HEARTBEAT_GRACE, JOB_HEARTBEAT_INTERVAL
+from utils.deadlines import Deadline, deadline_scope, check_deadline, resolve_deadline_budget
+from utils.admission import admit_request
+from utils.bulkheads import get_bulkhead
+from utils.comfy_scheduler import dispatch_scope, resolve_priority
+from utils.job_store import (
+    init_job_store,
+    save_job_record,
+    load_job_record,
+    load_unfinished_job_records,
+)
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_COMPLETED = 'completed'
+JOB_FAILED = 'failed'
+JOB_CANCELLED = 'cancelled'
+TERMINAL_STATES = (JOB_COMPLETED, JOB_FAILED, JOB_CANCELLED)
+
+# Updates that only move the progress bar are not written to the job store
+_TRANSIENT_FIELDS = {'progress'}
+
+_job_context = threading.local()
+
+
+class JobCancelled(Exception):
+    """Raised in the thread running a job (or a prompt) that was cancelled."""
+
+    def __init__(self, job_id=None, prompt_id=None, reason=None):
+        self.job_id = job_id
+        self.prompt_id = prompt_id
+        self.reason = reason
+        target = f"job {job_id}" if job_id else f"prompt {prompt_id}"
+        message = f"Generation cancelled ({target})"
+        if reason:
+            message += f": {reason}"
+        super().__init__(message)
+
+    def to_dict(self):
+        return {
+            "status": "cancelled",
+            "job_id": self.job_id,
+            "prompt_id": self.prompt_id,
+            "reason": self.reason,
+        }
+
+
+class Job:
+    """State of one background generation."""
+
+    def __init__(self, kind, mode='generate', user=None, params=None, priority=None):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.mode = mode
+        self.user = user
+        # Priority class used by the fair-share dispatcher (utils.comfy_scheduler)
+        self.priority = priority or resolve_priority(None, mode)
+        self.params = params or {}
+        self.state = JOB_QUEUED
+        self.stage = 'queued'
+        self.progress = None
+        self.prompt_id = None
+        self.backend_url = None
+        self.target_nodes = None
+        self.media_key = None
+        self.result = None
+        self.error = None
+        self.error_details = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.updated_at = self.created_at
+        # In-memory only: a job resumed after a restart gets a fresh budget
+        self.deadline = None
+        # Last client heartbeat; None when the client did not ask to be watched
+        self.heartbeat_at = None
+        # Admission ticket of the request that submitted the job (utils.admission)
+        self.admission = None
+        # Workflow and size declared when the generation starts (utils.cost_model)
+        self.profile = None
+        self.cancel_event = threading.Event()
+        self.cancel_reason = None
+        self._lock = threading.Lock()
+        self._on_update = None
+
+    @classmethod
+    def from_record(cls, record):
+        """Rebuild a job from a job store record."""
+        job = cls(record['kind'], mode=record['mode'], user=record.get('user'), params=record.get('params'),
+                  priority=record.get('priority'))
+        for key in (
+            'id', 'state', 'stage', 'prompt_id', 'backend_url', 'target_nodes', 'media_key',
+            'result', 'error', 'error_details', 'created_at', 'started_at', 'finished_at', 'updated_at',
+        ):
+            if record.get(key) is not None:
+                setattr(job, key, record[key])
+        return job
+
+    @property
+    def is_finished(self):
+        return self.state in TERMINAL_STATES
+
+    @property
+    def cancel_requested(self):
+        return self.cancel_event.is_set()
+
+    def check_cancelled(self):
+        """Raise JobCancelled if the job was cancelled."""
+        if self.cancel_event.is_set():
+            raise JobCancelled(self.id, self.prompt_id, self.cancel_reason)
+
+    def cancelled_details(self):
+        """error_details of a cancelled job."""
+        return JobCancelled(self.id, self.prompt_id, self.cancel_reason).to_dict()
+
+    def heartbeat(self):
+        """Record that the client is still waiting for the job."""
+        if self.heartbeat_at is not None:
+            self.heartbeat_at = time.time()
+
+    def heartbeat_lapsed(self, grace, now=None):
+        """Whether a watched job has gone longer than grace seconds without a heartbeat."""
+        if self.heartbeat_at is None or self.is_finished:
+            return False
+        return (now or time.time()) - self.heartbeat_at > grace
+
+    def update(self, **fields):
+        """Update public fields atomically (stage, progress, prompt_id, ...)."""
+        with self._lock:
+            for key, value in fields.items():
+                setattr(self, key, value)
+            self.updated_at = time.time()
+        on_update = self._on_update
+        if on_update is not None and not set(fields) <= _TRANSIENT_FIELDS:
+            on_update(self)
+
+    def to_record(self):
+        """Columns persisted in the job store."""
+        with self._lock:
+            return {
+                "id": self.id,
+                "kind": self.kind,
+                "mode": self.mode,
+                "user": self.user,
+                "state": self.state,
+                "stage": self.stage,
+                "params": self.params,
+                "prompt_id": self.prompt_id,
+                "backend_url": self.backend_url,
+                "target_nodes": self.target_nodes,
+                "media_key": self.media_key,
+                "result": self.result,
+                "error": self.error,
+                "error_details": self.error_details,
+                "created_at": self.created_at,
+                "started_at": self.started_at,
+                "finished_at": self.finished_at,
+                "updated_at": self.updated_at,
+                "priority": self.priority,
+            }
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "job_id": self.id,
+                "kind": self.kind,
+                "mode": self.mode,
+                "state": self.state,
+                "stage": self.stage,
+                "progress": self.progress,
+                "prompt_id": self.prompt_id,
+                "result": self.result,
+                "error": self.error,
+                "error_details": self.error_details,
+                "created_at": self.created_at,
+                "started_at": self.started_at,
+                "finished_at": self.finished_at,
+                "priority": self.priority,
+                "deadline_at": self.deadline.expires_at if self.deadline else None,
+                "heartbeat_at": self.heartbeat_at,
+            }
+
+
+class JobManager:
+    """In-memory index of jobs, each run on the worker pool of its mode."""
+
+    def __init__(self, retention_seconds=JOB_RETENTION_SECONDS):
+        self.retention_seconds = retention_seconds
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._store_enabled = False
+
+    def enable_store(self):
+        """Create the job store and start mirroring jobs into it."""
+        init_job_store()
+        self._store_enabled = True
+        with self._lock:
+            jobs = list(self._jobs.values())
+        for job in jobs:
+            self._track(job)
+            self._persist(job)
+
+    def _track(self, job):
+        if self._store_enabled:
+            job._on_update = self._persist
+
+    def _persist(self, job):
+        if self._store_enabled:
+            save_job_record(job.to_record())
+
+    def submit(self, kind, func, *args, mode='generate', user=None, params=None, deadline=None, heartbeat=False,
+               admission=None, priority=None, **kwargs):
+        """Queue func(*args, **kwargs) as a job and return it without waiting.
+
+        deadline is the job's time budget in seconds (default: the mode's);
+        time spent waiting for a slot and a worker counts against it. With
+        heartbeat the client promises to send heartbeats and the job is
+        cancelled when they stop (see utils.job_reaper). admission is the
+        request's admission ticket, which the job owns from here on: the job
+        only takes a worker once the ticket holds its slot, the same order as
+        a synchronous request, and frees it when it finishes. priority is the
+        job's dispatch class ('interactive' or 'batch'; default by mode).
+        """
+        try:
+            if params is None:
+                # Keep the call arguments so a job that never reached ComfyUI can be re-run
+                params = {"args": list(args), "kwargs": kwargs}
+            job = Job(kind, mode=mode, user=user, params=params, priority=priority)
+            job.deadline = Deadline(deadline or resolve_deadline_budget(mode), started_at=job.created_at)
+            if heartbeat:
+                job.heartbeat_at = job.created_at
+            job.admission = admission
+            self._add(job)
+            self._enqueue(job, func, args, kwargs)
+        except Exception:
+            # A job that could not be queued must not keep its place in the admission queue
+            if admission is not None:
+                admission.release()
+            raise
+        print(f"[JOBS] Job {job.id} ({kind}) queued")
+        return job
+
+    def _enqueue(self, job, func, args, kwargs):
+        """Schedule a job once its admission ticket holds a slot, without holding a thread meanwhile."""
+        if job.admission is None:
+            self._schedule(job, func, args, kwargs)
+            return
+
+        def on_slot():
+            try:
+                self._schedule(job, func, args, kwargs)
+            except Exception as e:
+                job.admission.release()
+                job.update(state=JOB_FAILED, stage='failed', error=str(e), finished_at=time.time())
+                print(f"[JOBS] Job {job.id} ({job.kind}) could not be scheduled: {e}")
+
+        job.admission.acquire_async(on_slot)
+
+    def _schedule(self, job, func, args, kwargs):
+        # on_slot may run on the thread of another job that freed the slot: bind this job's own
+        # deadline, and let the worker pool order waiting jobs (and their prompts) by user and priority
+        with deadline_scope(deadline=job.deadline, detached=True), dispatch_scope(job.user, job.priority):
+            get_bulkhead(job.mode).submit(self._run, job, func, args, kwargs)
+
+    def _add(self, job):
+        with self._lock:
+            self._prune_locked()
+            self._jobs[job.id] = job
+        self._track(job)
+        self._persist(job)
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def find(self, job_or_prompt_id):
+        """Look a job up by its id or by the ComfyUI prompt_id it is waiting on."""
+        with self._lock:
+            job = self._jobs.get(job_or_prompt_id)
+            if job:
+                return job
+            for candidate in self._jobs.values():
+                if candidate.prompt_id == job_or_prompt_id:
+                    return candidate
+        if self._store_enabled:
+            # Jobs pruned from memory or finished by a previous process
+            record = load_job_record(job_or_prompt_id)
+            if record:
+                return Job.from_record(record)
+        return None
+
+    def recover(self):
+        """Resume the jobs that were unfinished when the previous process stopped.
+
+        Jobs that already have a prompt_id reattach to that prompt through the
+        kind's resume handler; jobs that never reached ComfyUI run again from
+        their stored arguments. Returns the number of jobs picked up.
+        """
+        if not self._store_enabled:
+            return 0
+        recovered = 0
+        for record in load_unfinished_job_records():
+            job = Job.from_record(record)
+            job.deadline = Deadline(resolve_deadline_budget(job.mode))
+            # Already accepted once: resumed jobs take a slot even when the mode is full
+            job.admission = admit_request(job.mode, force=True)
+            handlers = _job_kinds.get(job.kind) or {}
+            args = (job.params or {}).get("args") or []
+            kwargs = (job.params or {}).get("kwargs") or {}
+            if job.prompt_id and handlers.get("resume"):
+                func, args, kwargs = handlers["resume"], [job], {}
+                job.stage = 'resuming'
+            elif handlers.get("run") and not job.prompt_id:
+                func = handlers["run"]
+                job.state, job.stage = JOB_QUEUED, 'queued'
+            else:
+                job.state, job.stage = JOB_FAILED, 'failed'
+                job.error = "Job was interrupted by a restart and cannot be resumed"
+                job.finished_at = time.time()
+                job.admission.release()
+                self._add(job)
+                print(f"[JOBS] Job {job.id} ({job.kind}) could not be resumed")
+                continue
+            self._add(job)
+            self._enqueue(job, func, tuple(args), kwargs)
+            recovered += 1
+            if job.prompt_id:
+                print(f"[JOBS] Job {job.id} ({job.kind}) reattached to prompt {job.prompt_id}")
+            else:
+                print(f"[JOBS] Job {job.id} ({job.kind}) queued again")
+        return recovered
+
+    def request_cancel(self, job, reason=None):
+        """Flag a job as cancelled.
+
+        A job still waiting for a worker is finished right away; a running job
+        sees the flag at its next check (before queueing its prompt or while
+        waiting for it) and ends as cancelled. Stopping the ComfyUI prompt
+        itself is up to the caller.
+        """
+        if job.is_finished:
+            return False
+        job.cancel_reason = job.cancel_reason or reason
+        job.cancel_event.set()
+        if job.state == JOB_QUEUED:
+            if job.admission is not None:
+                job.admission.release()
+            job.update(state=JOB_CANCELLED, stage='cancelled', error=_cancelled_message(job),
+                       error_details=job.cancelled_details(), finished_at=time.time())
+            print(f"[JOBS] Job {job.id} ({job.kind}) cancelled before it started")
+        return True
+
+    def abandoned_jobs(self, grace):
+        """Unfinished jobs whose client stopped sending heartbeats more than grace seconds ago."""
+        now = time.time()
+        with self._lock:
+            return [job for job in self._jobs.values() if job.heartbeat_lapsed(grace, now)]
+
+    def list_jobs(self):
+        with self._lock:
+            return list(self._jobs.values())
+
+    def _prune_locked(self):
+        cutoff = time.time() - self.retention_seconds
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job.is_finished and (job.finished_at or 0) < cutoff
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def _run(self, job, func, args, kwargs):
+        if job.is_finished:
+            if job.admission is not None:
+                job.admission.release()
+            return
+        job.update(state=JOB_RUNNING, stage=job.stage if job.stage == 'resuming' else 'starting',
+                   started_at=job.started_at or time.time())
+        _job_context.job = job
+        try:
+            with deadline_scope(deadline=job.deadline or Deadline(resolve_deadline_budget(job.mode))):
+                # The admission slot is already held (see _enqueue)
+                check_deadline("waiting for a job worker")
+                job.check_cancelled()
+                result = func(*args, **kwargs)
+            if job.cancel_requested and isinstance(result, dict) and result.get("success") is False:
+                job.update(state=JOB_CANCELLED, stage='cancelled', error=_cancelled_message(job),
+                           error_details=job.cancelled_details())
+            elif isinstance(result, dict) and result.get("success") is False:
+                job.update(
+                    state=JOB_FAILED,
+                    stage='failed',
+                    result=result,
+                    error=result.get("error") or "Job failed",
+                    error_details=result.get("error_details"),
+                )
+            else:
+                job.update(state=JOB_COMPLETED, stage='done', result=result, progress=1.0)
+        except Exception as e:
+            if job.cancel_requested:
+                # Whatever the prompt ended with (interrupted, cancelled wait), the user stopped it
+                job.update(state=JOB_CANCELLED, stage='cancelled', error=_cancelled_message(job),
+                           error_details=job.cancelled_details())
+            else:
+                traceback.print_exc()
+                details = e.to_dict() if hasattr(e, "to_dict") else None
+                job.update(state=JOB_FAILED, stage='failed', error=str(e), error_details=details)
+        finally:
+            _job_context.job = None
+            if job.admission is not None:
+                job.admission.release()
+            job.update(finished_at=time.time())
+            print(f"[JOBS] Job {job.id} ({job.kind}) finished: {job.state}")
+
+
+def _cancelled_message(job):
+    return f"Job cancelled ({job.cancel_reason})" if job.cancel_reason else "Job cancelled"
+
+
+job_manager = JobManager()
+
+# kind -> {"run": callable, "resume": callable(job)} used to recover jobs after a restart
+_job_kinds = {}
+
+
+def register_job_kind(kind, run, resume=None):
+    """Declare how a job kind is re-run and how it reattaches to its ComfyUI prompt.
+
+    Args:
+        kind: Job kind passed to submit_job
+        run: Function re-run with the stored args/kwargs when the job never got a prompt_id
+        resume: Function called with the Job when it already has a prompt_id; it
+            must wait for that prompt and return the same result as run
+    """
+    _job_kinds[kind] = {"run": run, "resume": resume}
+
+
+def init_jobs(resume=True):
+    """Enable the job store and, optionally, resume unfinished jobs."""
+    job_manager.enable_store()
+    if resume:
+        count = job_manager.recover()
+        if count:
+            print(f"[JOBS] Resumed {count} unfinished job(s)")
+
+
+def submit_job(kind, func, *args, **kwargs):
+    """Queue a job on the shared manager."""
+    return job_manager.submit(kind, func, *args, **kwargs)
+
+
+def get_job(job_or_prompt_id):
+    """Find a job by job id or ComfyUI prompt_id."""
+    return job_manager.find(job_or_prompt_id)
+
+
+def request_job_cancel(job, reason=None):
+    """Flag a job as cancelled on the shared manager (see JobManager.request_cancel)."""
+    return job_manager.request_cancel(job, reason=reason)
+
+
+def get_current_job():
+    """Job being executed by the current worker thread, or None for synchronous requests."""
+    return getattr(_job_context, 'job', None)
+
+
+def update_current_job(**fields):
+    """Report stage/progress/prompt_id for the current job; no-op outside a job."""
+    job = get_current_job()
+    if job is not None:
+        job.update(**fields)
+
+
+def wants_async(data, args=None):
+    """Whether a submit request asked for the asynchronous job API."""
+    value = (data or {}).get('async')
+    if value is None and args is not None:
+        value = args.get('async')
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes', 'on')
+    return bool(value)
+
+
+def wants_heartbeat(data, args=None):
+    """Whether an async submit asked to be cancelled when its heartbeats stop."""
+    if JOB_HEARTBEAT_GRACE <= 0:
+        return False
+    value = (data or {}).get('heartbeat')
+    if value is None and args is not None:
+        value = args.get('heartbeat')
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes', 'on')
+    return bool(value)
+
+
+def job_accepted_payload(job):
+    """Body returned by submit endpoints when a job was queued."""
+    payload = {
+        "success": True,
+        "job_id": job.id,
+        "state": job.state,
+        "status_url": f"/api/status/{job.id}",
+    }
+    if job.heartbeat_at is not None:
+        payload.update(
+            heartbeat_url="/api/jobs/heartbeat",
+            heartbeat_interval=JOB_HEARTBEAT_INTERVAL,
+            heartbeat_grace=JOB_HEARTBEAT_GRACE,
+        )
+    return payload
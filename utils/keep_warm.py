@@ -0,0 +1,368 @@
+"""
+Keep-warm controller for serverless backends
+Modal-hosted ComfyUI backends scale to zero when idle, so the first prompt
+after a quiet period pays a container cold start plus model loading. For each
+serverless backend the controller decides from observed traffic whether it
+should stay warm: for a while after its last prompt, during configured local
+hours, and in hours of the week that usually see prompts. While it should,
+within a daily ceiling of kept-warm hours, its WebSocket stays open and a
+cheap /system_stats request is sent shortly before the container's scale-down
+window ends whenever the socket is down. While it should not, its socket is
+closed (the next prompt reopens it) and the pool's background polls leave it
+alone, so it can scale down. Requests and sockets that reach a backend idle
+for longer than its window are counted as cold starts, and so are the user
+prompts that had to wait for one
+"""
+import time
+import threading
+from datetime import date
+from urllib.parse import urlparse
+from config import (
+    COMFY_KEEP_WARM,
+    COMFY_KEEP_WARM_SCALEDOWN,
+    COMFY_KEEP_WARM_RECENT_MINUTES,
+    COMFY_KEEP_WARM_HOURS,
+    COMFY_KEEP_WARM_LEARNED_DAYS,
+    COMFY_KEEP_WARM_MAX_HOURS,
+    COMFY_HTTP_CONNECT_TIMEOUT,
+)
+from utils.comfy_config import get_comfy_urls
+from utils.comfy_http import comfy_get, set_response_observer
+from utils.comfy_ws import get_ws_listener, suspend_ws_listener, set_socket_observer
+from utils.job_store import load_duration_samples
+
+MODES = ('generate', 'edit', 'video')
+
+# Days of traffic history kept per hour of the week
+_HISTORY_DAYS = 28
+# A warm-up request may have to wait for a whole container start
+_PING_READ_TIMEOUT = 180.0
+
+
+def parse_hours(spec):
+    """Local hours (0-23) of a '9-18' / '8-12,14-19' spec; the end hour is excluded and ranges may wrap midnight ('22-6')."""
+    hours = set()
+    for part in (spec or '').split(','):
+        part = part.strip()
+        if not part:
+            continue
+        try:
+            start, _, end = part.partition('-')
+            start = int(start)
+            end = int(end) if end else start + 1
+        except ValueError:
+            print(f"[WARM] Ignoring invalid hour range '{part}'")
+            continue
+        if not 0 <= start <= 23 or not 0 <= end <= 24:
+            print(f"[WARM] Ignoring invalid hour range '{part}'")
+            continue
+        if start == end:
+            # '9-9' would otherwise wrap all the way round to every hour of the day
+            print(f"[WARM] Ignoring empty hour range '{part}'")
+            continue
+        hour = start
+        while True:
+            hours.add(hour)
+            hour = (hour + 1) % 24
+            if hour == end % 24:
+                break
+    return hours
+
+
+def is_serverless(url, backends=COMFY_KEEP_WARM):
+    """Whether a backend URL is one the controller manages."""
+    if backends == 'all':
+        return True
+    if backends == 'modal':
+        return (urlparse(url).hostname or '').endswith('.modal.run')
+    return False
+
+
+def _hour_of_week(timestamp):
+    local = time.localtime(timestamp)
+    return local.tm_wday * 24 + local.tm_hour
+
+
+class BackendWarmth:
+    """Traffic, contacts and cold starts of one serverless backend."""
+
+    def __init__(self, url):
+        self.url = url
+        self.last_prompt = None
+        self.last_contact = None
+        self.last_tick = None
+        self.socket_open = False
+        self.pending_cold = False
+        # hour of the week -> ordinals of the days that saw a prompt in that hour
+        self.traffic = {}
+        self.prompts = 0
+        self.cold_prompts = 0
+        self.cold_starts = 0
+        self.cold_start_seconds = 0.0
+        self.pings = 0
+        self.ping_failures = 0
+        self.warm_day = None
+        self.warm_seconds_today = 0.0
+        self.ceiling_reached = False
+        self.last_reason = None
+
+    def note_traffic(self, timestamp):
+        day = date.fromtimestamp(timestamp).toordinal()
+        days = self.traffic.setdefault(_hour_of_week(timestamp), set())
+        days.add(day)
+        for stale in [d for d in days if d < day - _HISTORY_DAYS]:
+            days.discard(stale)
+
+    def contact_at(self, now):
+        """Last time the container was known to be up (now while its socket is open)."""
+        return now if self.socket_open else self.last_contact
+
+    def to_dict(self, now):
+        contact = self.contact_at(now)
+        return {
+            "warm_reason": self.last_reason,
+            "socket_open": self.socket_open,
+            "last_prompt": self.last_prompt,
+            "last_contact": contact,
+            "idle_seconds": round(now - contact, 1) if contact else None,
+            "prompts": self.prompts,
+            "cold_prompts": self.cold_prompts,
+            "cold_prompt_rate": round(self.cold_prompts / self.prompts, 3) if self.prompts else None,
+            "cold_starts": self.cold_starts,
+            "avg_cold_start_seconds": round(self.cold_start_seconds / self.cold_starts, 2) if self.cold_starts else None,
+            "pings": self.pings,
+            "ping_failures": self.ping_failures,
+            "warm_hours_today": round(self.warm_seconds_today / 3600, 2),
+            "ceiling_reached": self.ceiling_reached,
+        }
+
+
+class KeepWarmController:
+    """Background thread keeping serverless backends warm while traffic is expected."""
+
+    def __init__(self, backends=COMFY_KEEP_WARM, scaledown=COMFY_KEEP_WARM_SCALEDOWN,
+                 recent_minutes=COMFY_KEEP_WARM_RECENT_MINUTES, hours=COMFY_KEEP_WARM_HOURS,
+                 learned_days=COMFY_KEEP_WARM_LEARNED_DAYS, max_hours=COMFY_KEEP_WARM_MAX_HOURS):
+        self.backends = backends if backends in ('modal', 'all') else 'off'
+        self.scaledown = max(30.0, scaledown)
+        self.recent_seconds = recent_minutes * 60
+        self.hours = parse_hours(hours)
+        self.learned_days = learned_days
+        self.max_hours = max_hours
+        # Check often enough to ping well inside the scale-down window
+        self.interval = max(10.0, min(60.0, self.scaledown / 5))
+        self._states = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def enabled(self):
+        return self.backends != 'off'
+
+    def manages(self, url):
+        return self.enabled and bool(url) and is_serverless(url, self.backends)
+
+    def _state(self, url):
+        url = url.rstrip('/')
+        with self._lock:
+            state = self._states.get(url)
+            if state is None:
+                state = self._states[url] = BackendWarmth(url)
+            return state
+
+    def load_history(self):
+        """Seed the hour-of-week traffic of each backend from the recorded generations."""
+        count = 0
+        for record in load_duration_samples():
+            url = record.get('backend_url')
+            if url and self.manages(url):
+                self._state(url).note_traffic(record['recorded_at'])
+                count += 1
+        return count
+
+    def observe(self, url, elapsed):
+        """Response hook of utils.comfy_http: every request keeps the container alive."""
+        if not self.manages(url):
+            return
+        state = self._state(url)
+        now = time.time()
+        with self._lock:
+            self._contact_locked(state, now, elapsed)
+
+    def observe_socket(self, url, is_open, elapsed=0.0):
+        """Socket hook of utils.comfy_ws: an open socket keeps the container alive until it closes."""
+        if not self.manages(url):
+            return
+        state = self._state(url)
+        now = time.time()
+        with self._lock:
+            if is_open:
+                self._contact_locked(state, now, elapsed)
+            else:
+                state.last_contact = now
+            state.socket_open = is_open
+
+    def _contact_locked(self, state, now, elapsed):
+        contact = state.contact_at(now - elapsed)
+        if contact is not None and now - elapsed - contact > self.scaledown:
+            # The container had scaled down: this request or connection paid its start
+            state.cold_starts += 1
+            state.cold_start_seconds += elapsed
+            state.pending_cold = True
+        state.last_contact = now
+
+    def note_prompt(self, url):
+        """A user prompt was queued on a backend."""
+        if not self.manages(url):
+            return
+        state = self._state(url)
+        now = time.time()
+        with self._lock:
+            state.prompts += 1
+            if state.pending_cold:
+                state.cold_prompts += 1
+                state.pending_cold = False
+            state.last_prompt = now
+            state.note_traffic(now)
+
+    def warm_reason(self, url, now=None):
+        """Why a backend should be warm right now ('recent', 'hours' or 'learned'), or None."""
+        now = now or time.time()
+        state = self._state(url)
+        if state.last_prompt is not None and now - state.last_prompt <= self.recent_seconds:
+            return 'recent'
+        if time.localtime(now).tm_hour in self.hours:
+            return 'hours'
+        if self.learned_days > 0 and len(state.traffic.get(_hour_of_week(now), ())) >= self.learned_days:
+            return 'learned'
+        return None
+
+    def should_contact(self, url):
+        """Whether background polls may reach a backend (False lets an idle serverless one scale down)."""
+        if not self.manages(url):
+            return True
+        return self.warm_reason(url) is not None and not self._state(url).ceiling_reached
+
+    def _charge_locked(self, state, now):
+        """Add the time since the previous tick to today's kept-warm hours; False once the ceiling is reached."""
+        today = date.fromtimestamp(now).toordinal()
+        if state.warm_day != today:
+            state.warm_day = today
+            state.warm_seconds_today = 0.0
+            state.ceiling_reached = False
+        added = min(now - state.last_tick, 2 * self.interval) if state.last_tick else self.interval
+        if self.max_hours > 0 and state.warm_seconds_today + added > self.max_hours * 3600:
+            if not state.ceiling_reached:
+                print(f"[WARM] {state.url} reached its ceiling of {self.max_hours:g} kept-warm hours for today")
+            state.ceiling_reached = True
+            return False
+        state.warm_seconds_today += added
+        return True
+
+    def tick(self, now=None):
+        """Keep the socket of every managed backend that should be warm open, and close the others."""
+        now = now or time.time()
+        urls = {url.rstrip('/') for mode in MODES for url in get_comfy_urls(mode) if url and self.manages(url)}
+        for url in sorted(urls):
+            state = self._state(url)
+            reason = self.warm_reason(url, now)
+            state.last_reason = reason
+            with self._lock:
+                keep = reason is not None and self._charge_locked(state, now)
+                state.last_tick = now if keep else None
+            if not keep:
+                # A socket left open would keep the container from ever scaling down
+                if suspend_ws_listener(url):
+                    print(f"[WARM] Closed the socket of {url} so it can scale down")
+                continue
+            get_ws_listener(base_url=url)
+            with self._lock:
+                contact = state.contact_at(now)
+                due = contact is None or now - contact >= self.scaledown - 2 * self.interval
+            if due:
+                self.ping(state, reason)
+
+    def ping(self, state, reason=None):
+        """Send the cheap warm-up request to one backend and reopen its socket."""
+        get_ws_listener(base_url=state.url)
+        try:
+            response = comfy_get("/system_stats", base_url=state.url,
+                                 timeout=(COMFY_HTTP_CONNECT_TIMEOUT, _PING_READ_TIMEOUT))
+            response.raise_for_status()
+        except Exception as e:
+            with self._lock:
+                state.ping_failures += 1
+            print(f"[WARM] Keep-warm request to {state.url} failed: {e}")
+            return False
+        with self._lock:
+            state.pings += 1
+            # The ping, not a user, paid any cold start it found
+            state.pending_cold = False
+        if reason:
+            print(f"[WARM] Kept {state.url} warm ({reason})")
+        return True
+
+    def to_dict(self):
+        now = time.time()
+        with self._lock:
+            states = list(self._states.values())
+        return {
+            "enabled": self.enabled,
+            "backends": self.backends,
+            "scaledown_window": self.scaledown,
+            "recent_minutes": self.recent_seconds / 60,
+            "hours": sorted(self.hours),
+            "learned_days": self.learned_days,
+            "max_hours_per_day": self.max_hours,
+            "status": {state.url: state.to_dict(now) for state in states},
+        }
+
+    def start(self):
+        """Start the background keep-warm thread."""
+        with self._lock:
+            if not self.enabled or (self._thread and self._thread.is_alive()):
+                return
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name='comfy-keep-warm', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.tick()
+            except Exception as e:
+                print(f"[WARM] Keep-warm error: {e}")
+
+
+keep_warm = KeepWarmController()
+set_response_observer(keep_warm.observe)
+set_socket_observer(keep_warm.observe_socket)
+
+
+def note_backend_prompt(base_url):
+    """Count a user prompt queued on a backend (traffic pattern and cold-start rate)."""
+    keep_warm.note_prompt(base_url)
+
+
+def backend_contact_allowed(base_url):
+    """Whether background polls may reach a backend (see KeepWarmController.should_contact)."""
+    return keep_warm.should_contact(base_url)
+
+
+def start_keep_warm():
+    """Learn traffic from the recorded generations and start the controller (no-op when COMFY_KEEP_WARM is off)."""
+    if not keep_warm.enabled:
+        return
+    count = keep_warm.load_history()
+    if count:
+        print(f"[WARM] Learned traffic from {count} recorded generation(s)")
+    keep_warm.start()
+
+
+def get_keep_warm_status():
+    """Settings, traffic, pings, kept-warm hours and cold starts of every serverless backend."""
+    return keep_warm.to_dict()
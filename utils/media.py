@@ -6,10 +6,11 @@ import os
 import uuid
 import base64
 import mimetypes
-import requests
 from werkzeug.utils import secure_filename
 from config import OUTPUT_DIR
-from utils.comfy_config import get_comfy_url, build_comfy_headers
+from utils.comfy_http import comfy_get, comfy_post
+from utils.jobs import update_current_job
+from utils.deadlines import check_deadline, DeadlineExceeded
 
 def resolve_local_media_path(relative_path):
     """Resolver la ruta absoluta de un archivo guardado en el directorio local de salida."""
@@ -29,9 +30,12 @@ def resolve_local_media_path(relative_path):
         raise ValueError("Local filename resolves outside of output directory")
     return candidate_path
 
-def upload_image_to_comfy(filename, subfolder='', image_type='output', mode='generate'):
-    """Descargar una imagen desde ComfyUI y subirla al directorio de inputs"""
-    comfy_url = get_comfy_url(mode)
+def upload_image_to_comfy(filename, subfolder='', image_type='output', mode='generate', source_url=None):
+    """Download an image from ComfyUI and upload it to the inputs directory
+
+    source_url is the backend holding the image when it is not the current
+    backend of the mode (pools with several backends).
+    """
     params = {
         'filename': filename,
         'type': image_type or 'output'
@@ -39,11 +43,7 @@ def upload_image_to_comfy(filename, subfolder='', image_type='output', mode='gen
     if subfolder:
         params['subfolder'] = subfolder
 
-    response = requests.get(
-        f"{comfy_url}/view",
-        params=params,
-        headers=build_comfy_headers()
-    )
+    response = comfy_get("/view", mode=mode, base_url=source_url, params=params)
     if response.status_code != 200:
         raise ValueError(f"Unable to retrieve source image: HTTP {response.status_code}")
 
@@ -51,11 +51,11 @@ def upload_image_to_comfy(filename, subfolder='', image_type='output', mode='gen
     extension = os.path.splitext(filename)[1] or '.png'
     upload_name = f"video_source_{uuid.uuid4().hex}{extension}"
 
-    upload_response = requests.post(
-        f"{comfy_url}/upload/image",
+    upload_response = comfy_post(
+        "/upload/image",
+        mode=mode,
         data={'type': 'input', 'overwrite': 'true'},
-        files={'image': (upload_name, response.content, content_type)},
-        headers=build_comfy_headers()
+        files={'image': (upload_name, response.content, content_type)}
     )
 
     if upload_response.status_code != 200:
@@ -63,8 +63,9 @@ def upload_image_to_comfy(filename, subfolder='', image_type='output', mode='gen
 
     return upload_name
 
-def upload_image_bytes_to_comfy(content_bytes, filename='upload.png', mime_type='image/png', image_type='input', mode='generate'):
-    """Subir bytes de imagen directamente a ComfyUI"""
+def upload_image_bytes_to_comfy(content_bytes, filename='upload.png', mime_type='image/png', image_type='input', mode='generate',
+                                base_url=None):
+    """Upload image bytes straight to ComfyUI (to the backend of the mode or to base_url)"""
     if not content_bytes:
         raise ValueError("Empty image content provided")
 
@@ -77,12 +78,12 @@ def upload_image_bytes_to_comfy(content_bytes, filename='upload.png', mime_type=
 
     upload_name = f"user_upload_{uuid.uuid4().hex}{extension}"
     
-    comfy_url = get_comfy_url(mode)
-    upload_response = requests.post(
-        f"{comfy_url}/upload/image",
+    upload_response = comfy_post(
+        "/upload/image",
+        mode=mode,
+        base_url=base_url,
         data={'type': image_type, 'overwrite': 'true'},
-        files={'image': (upload_name, content_bytes, mime_type or 'image/png')},
-        headers=build_comfy_headers()
+        files={'image': (upload_name, content_bytes, mime_type or 'image/png')}
     )
 
     if upload_response.status_code != 200:
@@ -136,13 +137,12 @@ def persist_media_locally(media_items, prompt_id, media_category="images", mode=
     if not media_items:
         return []
 
+    update_current_job(stage='saving')
     saved_items = []
     output_root = os.path.abspath(OUTPUT_DIR)
     media_subdir = "videos" if media_category == "videos" else "images"
     target_dir = os.path.join(output_root, media_subdir)
     os.makedirs(target_dir, exist_ok=True)
-    
-    comfy_url = get_comfy_url(mode)
 
     for index, item in enumerate(media_items, start=1):
         if isinstance(item, dict):
@@ -162,12 +162,7 @@ def persist_media_locally(media_items, prompt_id, media_category="images", mode=
         if format_hint:
             params["format"] = format_hint
 
-        response = requests.get(
-            f"{comfy_url}/view",
-            params=params,
-            headers=build_comfy_headers(),
-            stream=True
-        )
+        response = comfy_get("/view", mode=mode, params=params, stream=True)
         if response.status_code != 200:
             response.close()
             raise ValueError(
@@ -193,8 +188,17 @@ def persist_media_locally(media_items, prompt_id, media_category="images", mode=
         try:
             with open(local_path, "wb") as output_file:
                 for chunk in response.iter_content(chunk_size=8192):
+                    # The read timeout is per chunk: the deadline bounds the whole download
+                    check_deadline(f"downloading {remote_filename}")
                     if chunk:
                         output_file.write(chunk)
+        except DeadlineExceeded:
+            # No dejar archivos a medio descargar
+            try:
+                os.remove(local_path)
+            except OSError:
+                pass
+            raise
         finally:
             response.close()
 
@@ -0,0 +1,126 @@
+"""
+Content-addressed result cache
+Maps a canonical hash of a fully patched workflow to the local media records
+persisted for it, so a deterministic resubmission (same prompt, model,
+resolution, steps and explicit seed) skips the GPU job
+"""
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from config import DATA_DIR, RESULT_CACHE_ENABLED, RESULT_CACHE_MAX_ENTRIES, RESULT_CACHE_MAX_AGE_SECONDS
+from utils.media import resolve_local_media_path
+
+RESULT_CACHE_DB_PATH = os.path.join(DATA_DIR, 'result_cache.db')
+
+_init_lock = threading.Lock()
+_initialized = False
+
+
+def get_result_cache_connection():
+    """Create a connection to the result cache database."""
+    conn = sqlite3.connect(RESULT_CACHE_DB_PATH, timeout=10)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def init_result_cache():
+    """Create the cache table (WAL mode); safe to call more than once."""
+    global _initialized
+    with _init_lock:
+        if _initialized:
+            return
+        conn = get_result_cache_connection()
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS result_cache (
+                    cache_key TEXT PRIMARY KEY,
+                    mode TEXT NOT NULL,
+                    prompt_id TEXT,
+                    media TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_used_at REAL NOT NULL,
+                    hits INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_result_cache_last_used ON result_cache(last_used_at)')
+            conn.commit()
+            _initialized = True
+        finally:
+            conn.close()
+
+
+def workflow_cache_key(workflow, mode='generate'):
+    """Canonical hash of a patched workflow (key order and whitespace independent)."""
+    canonical = json.dumps(workflow, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(f"{mode}\n{canonical}".encode('utf-8')).hexdigest()
+
+
+def _media_available(media):
+    for item in media:
+        try:
+            path = resolve_local_media_path(item.get("local_path") or item.get("filename", ""))
+        except ValueError:
+            return False
+        if not os.path.exists(path):
+            return False
+    return bool(media)
+
+
+def get_cached_result(cache_key):
+    """Return {"prompt_id", "media"} for a fresh entry whose files still exist, else None."""
+    if not RESULT_CACHE_ENABLED:
+        return None
+    init_result_cache()
+    conn = get_result_cache_connection()
+    try:
+        row = conn.execute('SELECT * FROM result_cache WHERE cache_key = ?', (cache_key,)).fetchone()
+        if row is None:
+            return None
+        media = json.loads(row['media'])
+        expired = time.time() - row['created_at'] > RESULT_CACHE_MAX_AGE_SECONDS
+        if expired or not _media_available(media):
+            conn.execute('DELETE FROM result_cache WHERE cache_key = ?', (cache_key,))
+            conn.commit()
+            return None
+        conn.execute(
+            'UPDATE result_cache SET last_used_at = ?, hits = hits + 1 WHERE cache_key = ?',
+            (time.time(), cache_key)
+        )
+        conn.commit()
+        return {"prompt_id": row['prompt_id'], "media": media}
+    except (sqlite3.Error, ValueError) as e:
+        print(f"[CACHE] Error reading result cache: {e}")
+        return None
+    finally:
+        conn.close()
+
+
+def store_cached_result(cache_key, mode, prompt_id, media):
+    """Remember the persisted media of a workflow and evict old or excess entries."""
+    if not RESULT_CACHE_ENABLED or not media:
+        return
+    init_result_cache()
+    now = time.time()
+    conn = get_result_cache_connection()
+    try:
+        conn.execute(
+            'INSERT OR REPLACE INTO result_cache (cache_key, mode, prompt_id, media, created_at, last_used_at, hits) '
+            'VALUES (?, ?, ?, ?, ?, ?, 0)',
+            (cache_key, mode, prompt_id, json.dumps(media), now, now)
+        )
+        # Age-based eviction, then keep only the most recently used entries
+        conn.execute('DELETE FROM result_cache WHERE created_at < ?', (now - RESULT_CACHE_MAX_AGE_SECONDS,))
+        conn.execute(
+            'DELETE FROM result_cache WHERE cache_key NOT IN '
+            '(SELECT cache_key FROM result_cache ORDER BY last_used_at DESC LIMIT ?)',
+            (RESULT_CACHE_MAX_ENTRIES,)
+        )
+        conn.commit()
+    except sqlite3.Error as e:
+        print(f"[CACHE] Error writing result cache: {e}")
+    finally:
+        conn.close()
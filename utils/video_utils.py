@@ -7,18 +7,27 @@ import uuid
 import subprocess
 import cv2
 from config import OUTPUT_IMAGES_DIR, OUTPUT_VIDEOS_DIR, OUTPUT_DIR
+from utils.deadlines import get_current_deadline, check_deadline, deadline_error
 
 def run_subprocess(command, error_message):
-    """Ejecutar un comando del sistema y reportar errores con salida detallada."""
+    """Run a system command and report errors with its detailed output.
+
+    Inside a request with a deadline, the command is stopped when time runs out.
+    """
+    check_deadline(f"running {command[0]}")
+    deadline = get_current_deadline()
     try:
         result = subprocess.run(
             command,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
             check=False,
+            timeout=deadline.remaining() if deadline is not None else None,
         )
     except FileNotFoundError as exc:
         raise RuntimeError(f"{error_message}: command not found ({command[0]})") from exc
+    except subprocess.TimeoutExpired as exc:
+        raise deadline_error(f"running {command[0]}") from exc
 
     if result.returncode != 0:
         stdout_text = result.stdout.decode("utf-8", errors="ignore")
@@ -0,0 +1,258 @@
+"""
+Model pre-warming
+The first prompt a freshly started ComfyUI runs pays for loading its
+checkpoints, text encoders and VAE, which for the video workflows takes longer
+than the generation itself. When the app starts, when the pool sees a
+backend restart (its /system_stats changed) and when its circuit closes again,
+every registered workflow that backend can serve is run once in a minimal
+variant (smallest latent, one step, one frame, output discarded; see
+WorkflowTemplate.warmup_variant), so the models are in memory before a user
+needs them. Warm-ups go through the backend's scheduler as batch prompts and
+stop as soon as the backend has anything else queued, so they never delay a
+user. Workflows that load the same models are warmed once per backend, and
+how long each warm-up took is kept for GET /api/warmup
+"""
+import json
+import time
+import queue
+import struct
+import zlib
+import threading
+from config import COMFY_WARMUP, COMFY_WARMUP_TIMEOUT, COMFY_WARMUP_COOLDOWN
+from utils.comfy import cancel_prompt
+from utils.comfy_config import get_comfy_urls
+from utils.comfy_health import set_recovery_observer
+from utils.comfy_http import comfy_get, comfy_post
+from utils.comfy_pool import set_restart_observer
+from utils.comfy_scheduler import acquire_dispatch_slot, dispatch_scope, PRIORITY_BATCH
+from utils.comfy_schema import backend_supports
+from utils.comfy_ws import get_comfy_client_id, get_ws_listener
+from utils.keep_warm import backend_contact_allowed
+from utils.media import upload_image_bytes_to_comfy
+from utils.workflow import workflow_registry, get_workflow_template
+
+MODES = ('generate', 'edit', 'video')
+
+# Seconds a backend's socket gets to connect before its warm-up is given up
+_CONNECT_WAIT = 15.0
+
+
+def _backend_busy(url):
+    """Whether a backend has prompts running or pending (a warm-up would only delay them)."""
+    response = comfy_get("/queue", base_url=url, timeout=5)
+    response.raise_for_status()
+    queue = response.json()
+    return bool(queue.get("queue_running") or queue.get("queue_pending"))
+
+
+def _blank_png(size=64):
+    """Gray PNG of size x size pixels for the LoadImage nodes of the warm-up prompts."""
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+    row = b'\x00' + b'\x80\x80\x80' * size
+    return b''.join((
+        b'\x89PNG\r\n\x1a\n',
+        chunk(b'IHDR', struct.pack('>IIBBBBB', size, size, 8, 2, 0, 0, 0)),
+        chunk(b'IDAT', zlib.compress(row * size)),
+        chunk(b'IEND', b''),
+    ))
+
+
+class ModelWarmer:
+    """Background thread running the warm-up prompts of each backend, one backend at a time."""
+
+    def __init__(self, enabled=COMFY_WARMUP, timeout=COMFY_WARMUP_TIMEOUT, cooldown=COMFY_WARMUP_COOLDOWN):
+        self.enabled = enabled
+        self.timeout = max(1.0, timeout)
+        self.cooldown = max(0.0, cooldown)
+        self._queue = queue.Queue()
+        self._pending = set()
+        self._last_warmed = {}
+        # backend_url -> summary of its last warm-up
+        self._backends = {}
+        # backend_url -> workflow -> result of its last warm-up prompt
+        self._results = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def request(self, url, reason):
+        """Queue a warm-up of a backend; False when disabled, already queued or warmed recently."""
+        if not self.enabled or not url:
+            return False
+        url = url.rstrip('/')
+        with self._lock:
+            if url in self._pending:
+                return False
+            last = self._last_warmed.get(url)
+            if last is not None and time.time() - last < self.cooldown:
+                return False
+            self._pending.add(url)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='comfy-warmup', daemon=True)
+                self._thread.start()
+        self._queue.put((url, reason))
+        return True
+
+    def _run(self):
+        while True:
+            url, reason = self._queue.get()
+            try:
+                self.warm_backend(url, reason)
+            except Exception as e:
+                print(f"[WARMUP] Warm-up of {url} failed: {e}")
+            finally:
+                with self._lock:
+                    self._pending.discard(url)
+
+    def templates_for(self, url):
+        """(mode, template) pairs to warm on a backend: one per distinct model set it can run."""
+        selected, seen = [], set()
+        for mode in MODES:
+            if url not in {candidate.rstrip('/') for candidate in get_comfy_urls(mode) if candidate}:
+                continue
+            for name in workflow_registry.names(mode):
+                try:
+                    template = get_workflow_template(name)
+                except Exception as e:
+                    print(f"[WARMUP] Skipping workflow '{name}': {e}")
+                    continue
+                key = template.models or (name,)
+                if key in seen:
+                    continue
+                if backend_supports(template.workflow, url) is False:
+                    self._store(url, name, {"status": "unsupported", "models": list(template.models)})
+                    continue
+                seen.add(key)
+                selected.append((mode, template))
+        return selected
+
+    def warm_backend(self, url, reason):
+        """Run the warm-up prompt of every distinct model set on one backend."""
+        if not backend_contact_allowed(url):
+            # An idle serverless backend is not woken up just to load its models
+            print(f"[WARMUP] Skipping idle serverless backend {url}")
+            return
+        templates = self.templates_for(url)
+        if not templates:
+            return
+        listener = get_ws_listener(templates[0][0], base_url=url)
+        if not listener.connected.wait(_CONNECT_WAIT):
+            # Its next restart or recovery queues another warm-up
+            print(f"[WARMUP] {url} is not reachable, warm-up skipped")
+            return
+        if _backend_busy(url):
+            # A backend already running prompts is loading the models users need
+            print(f"[WARMUP] {url} is busy, warm-up skipped")
+            return
+        started = time.time()
+        with self._lock:
+            self._last_warmed[url] = started
+            self._backends[url] = {"reason": reason, "started_at": started, "finished_at": None,
+                                   "seconds": None, "status": "running"}
+        print(f"[WARMUP] Warming {len(templates)} workflow(s) on {url} ({reason})")
+        image, failures, busy = None, 0, False
+        for mode, template in templates:
+            try:
+                if template.roles["load_image"] and image is None:
+                    image = upload_image_bytes_to_comfy(_blank_png(), 'warmup.png', mode=mode, base_url=url)
+                result = self.warm_template(url, mode, template, image)
+            except Exception as e:
+                result = {"status": "error", "error": str(e)}
+            result["models"] = list(template.models)
+            self._store(url, template.name, result)
+            if result["status"] == "busy":
+                print(f"[WARMUP] {url} got other prompts, warm-up stopped")
+                busy = True
+                break
+            if result["status"] != "success":
+                failures += 1
+                print(f"[WARMUP] '{template.name}' on {url}: {result['status']} {result.get('error') or ''}".rstrip())
+            else:
+                print(f"[WARMUP] '{template.name}' warmed on {url} in {result['seconds']:.1f}s")
+        elapsed = time.time() - started
+        with self._lock:
+            self._backends[url].update({
+                "finished_at": time.time(),
+                "seconds": round(elapsed, 2),
+                "status": "busy" if busy else "success" if not failures else "partial" if failures < len(templates) else "error",
+            })
+        print(f"[WARMUP] {url} warmed in {elapsed:.1f}s ({failures} failure(s))")
+
+    def warm_template(self, url, mode, template, image=None):
+        """Queue the warm-up variant of one workflow and wait for it; returns its result.
+
+        The prompt takes a batch slot in the backend's window like any other
+        prompt, and is not sent at all ('busy') when the backend has other
+        prompts by the time it gets one.
+        """
+        workflow = template.warmup_variant(image)
+        listener = get_ws_listener(mode, base_url=url)
+        data = f'{{"prompt": {workflow.to_json()}, "client_id": {json.dumps(get_comfy_client_id())}}}'.encode('utf-8')
+        with dispatch_scope(None, PRIORITY_BATCH):
+            dispatch = acquire_dispatch_slot(url)
+        try:
+            if _backend_busy(url):
+                return {"status": "busy"}
+            started = time.time()
+            response = comfy_post("/prompt", base_url=url, data=data, headers={"Content-Type": "application/json"})
+            if response.status_code != 200:
+                return {"status": "rejected", "error": f"HTTP {response.status_code} - {response.text[:200]}"}
+            prompt_id = response.json().get("prompt_id")
+            waiter = listener.register(prompt_id)
+            try:
+                done = waiter.wait(self.timeout)
+            finally:
+                listener.release(prompt_id)
+            finished = time.time()
+            if not done:
+                # A warm-up must not keep the backend busy once users need it
+                cancel_prompt(prompt_id, mode, base_url=url)
+                return {"status": "timeout", "seconds": round(finished - started, 2)}
+        finally:
+            dispatch.release()
+        return {
+            "status": waiter.status,
+            "error": (waiter.error or {}).get("exception_message"),
+            "seconds": round(finished - started, 2),
+            "execution_seconds": round(finished - waiter.started_at, 2) if waiter.started_at else None,
+            "finished_at": finished,
+        }
+
+    def _store(self, url, workflow_name, result):
+        with self._lock:
+            self._results.setdefault(url, {})[workflow_name] = result
+
+    def to_dict(self):
+        with self._lock:
+            backends = {
+                url: {**summary, "workflows": dict(self._results.get(url, {}))}
+                for url, summary in self._backends.items()
+            }
+            for url, results in self._results.items():
+                backends.setdefault(url, {"status": None, "workflows": dict(results)})
+            pending = sorted(self._pending)
+        return {
+            "enabled": self.enabled,
+            "timeout": self.timeout,
+            "cooldown": self.cooldown,
+            "pending": pending,
+            "backends": backends,
+        }
+
+
+model_warmer = ModelWarmer()
+set_restart_observer(lambda url: model_warmer.request(url, 'restarted'))
+set_recovery_observer(lambda url: model_warmer.request(url, 'recovered'))
+
+
+def start_warmup():
+    """Queue the warm-up of every configured backend (no-op when COMFY_WARMUP is off)."""
+    if not model_warmer.enabled:
+        return
+    for url in {url.rstrip('/') for mode in MODES for url in get_comfy_urls(mode) if url}:
+        model_warmer.request(url, 'startup')
+
+
+def get_warmup_status():
+    """Last warm-up of every backend and how long each workflow took to warm."""
+    return model_warmer.to_dict()
@@ -3,8 +3,11 @@ Workflow utilities for loading and processing ComfyUI workflows
 """
 import os
 import json
-import sys
-from config import WORKFLOW_PATH, VIDEO_WORKFLOW_PATH, EDIT_WORKFLOW_PATH
+import threading
+from config import (
+    WORKFLOW_PATH, VIDEO_WORKFLOW_PATH, VIDEO_NO_SOUND_WORKFLOW_PATH, VIDEO_NSFW_WORKFLOW_PATH,
+    EDIT_WORKFLOW_PATH,
+)
 
 def load_workflow(workflow_path, default_relative=None):
     """Cargar workflow desde archivo JSON"""
@@ -65,63 +68,441 @@ def find_video_output_nodes(workflow):
         print(f"[WARN] No video output nodes found, using fallback node 110")
         return ["110"]  # Fallback al nodo por defecto
 
-# Cargar workflows base
-try:
-    BASE_WORKFLOW = load_workflow(WORKFLOW_PATH, 'workflows/text-to-image/text-to-image-lumina.json')
-except Exception as e:
-    print(f"Error fatal: No se pudo cargar el workflow de Lumina: {e}")
-    print("Asegúrate de que el archivo workflows/text-to-image/text-to-image-lumina.json existe")
-    sys.exit(1)
-
-# Cargar workflow de Chroma
-CHROMA_WORKFLOW = None
-try:
-    CHROMA_WORKFLOW = load_workflow('workflows/text-to-image/text-to-image-chroma.json', 'workflows/text-to-image/text-to-image-chroma.json')
-except Exception as e:
-    print(f"Warning: No se pudo cargar el workflow de Chroma: {e}")
-    print("El workflow de Chroma no estará disponible")
-
-# Cargar workflow de Qwen
-QWEN_WORKFLOW = None
-try:
-    QWEN_WORKFLOW = load_workflow('workflows/text-to-image/text-to-image-qwen-edit.json', 'workflows/text-to-image/text-to-image-qwen-edit.json')
-except Exception as e:
-    print(f"Warning: No se pudo cargar el workflow de Qwen: {e}")
-    print("El modelo Qwen no estará disponible")
-
-def get_workflow_by_model(model='lumina'):
-    """Obtener el workflow según el modelo seleccionado
-    
+# Inputs of the loader nodes that load large weights (checkpoint, UNET, text encoder)
+MODEL_LOADER_INPUTS = ('ckpt_name', 'unet_name', 'clip_name', 'clip_name1', 'clip_name2', 'clip_name3')
+
+def get_workflow_models(workflow):
+    """Heavy models a workflow loads, as a sorted tuple.
+
+    Two workflows with the same tuple run on a backend without reloading
+    checkpoints between them.
+    """
+    models = set()
+    for node_data in (workflow or {}).values():
+        if not isinstance(node_data, dict):
+            continue
+        inputs = node_data.get("inputs") or {}
+        for key in MODEL_LOADER_INPUTS:
+            value = inputs.get(key)
+            if isinstance(value, str) and value:
+                models.add(value)
+    return tuple(sorted(models))
+
+# Class types that fill each role inside a workflow
+PROMPT_NODE_CLASSES = ("CLIPTextEncode", "TextEncodeQwenImageEditPlus")
+LATENT_NODE_CLASSES = ("EmptyLatentImage", "EmptySD3LatentImage")
+SAMPLER_NODE_CLASSES = ("KSampler", "KSamplerAdvanced", "SamplerCustomAdvanced")
+LOAD_IMAGE_NODE_CLASSES = ("LoadImage", "LoadImageMask")
+VIDEO_OUTPUT_NODE_CLASSES = ("VHS_VideoCombine", "SaveVideo", "CreateVideo", "VideoCombine")
+# Smallest values used by the warm-up variant (WorkflowTemplate.warmup_variant)
+WARMUP_INPUTS = {"width": 64, "height": 64, "steps": 1, "length": 1, "batch_size": 1, "megapixels": 0.01}
+
+# Known nodes of each text-to-image model (fallback when detection finds none)
+KNOWN_GENERATE_NODES = {
+    "lumina": {"positive": ["6", "15"], "negative": ["7", "16"], "latent": ["13", "5"], "scheduler": ["3", "10", "11"], "noise": []},
+    "chroma": {"positive": ["748"], "negative": ["749"], "latent": ["737"], "scheduler": ["734"], "noise": ["718"]},
+    "qwen": {"positive": ["10"], "negative": ["7"], "latent": ["5"], "scheduler": ["3"], "noise": []},
+}
+DEFAULT_KNOWN_NODES = {"positive": ["6"], "negative": ["7"], "latent": ["13"], "scheduler": ["3"], "noise": []}
+
+def get_prompt_text(inputs):
+    """Text of a prompt node, from its 'text' or 'prompt' input."""
+    if not isinstance(inputs, dict):
+        return ""
+    return inputs.get("text") or inputs.get("prompt") or ""
+
+def _prompt_input_key(inputs):
+    """Input that receives the prompt text ('text' or 'prompt')."""
+    if "text" in inputs:
+        return "text"
+    if "prompt" in inputs:
+        return "prompt"
+    return "text"
+
+
+class WorkflowTemplate:
+    """Base workflow precompiled with its node-role index and patch plan.
+
+    Nodes (prompts, latent, sampler, scheduler, noise, LoadImage and outputs)
+    are detected once when the workflow loads; each request only writes its
+    values into the already resolved inputs. A missing required role raises
+    ValueError while compiling, that is, at startup.
+    """
+
+    def __init__(self, name, workflow, known_nodes=None, required_roles=()):
+        self.name = name
+        self.workflow = workflow
+        self.models = get_workflow_models(workflow)
+        self.roles = self._index_roles(known_nodes or {})
+        self.plan = self._build_plan()
+        self._node_json = None
+        self.base_texts = {
+            role: next(
+                (text for text in (get_prompt_text(self._inputs(node_id)) for node_id in self.roles[role]) if text),
+                ""
+            )
+            for role in ("positive", "negative")
+        }
+
+        missing = [role for role in required_roles if not self.roles.get(role) and not self.plan.get(role)]
+        if missing:
+            raise ValueError(f"Workflow '{name}': no nodes detected for roles {missing}")
+        summary = ", ".join(f"{role}={nodes}" for role, nodes in self.roles.items() if nodes)
+        print(f"[WORKFLOW] Template '{name}' compiled: {summary}")
+
+    def _inputs(self, node_id):
+        node = self.workflow.get(node_id)
+        if isinstance(node, dict) and isinstance(node.get("inputs"), dict):
+            return node["inputs"]
+        return None
+
+    def _index_roles(self, known_nodes):
+        roles = {role: [] for role in (
+            "positive", "negative", "latent", "sampler", "scheduler", "noise", "load_image", "outputs",
+            "video_outputs",
+        )}
+        known_positive = known_nodes.get("positive", [])
+        known_negative = known_nodes.get("negative", [])
+
+        for node_id, node_data in self.workflow.items():
+            if not isinstance(node_data, dict):
+                continue
+            class_type = node_data.get("class_type", "")
+            inputs = node_data.get("inputs", {})
+            meta = node_data.get("_meta", {})
+            title = meta.get("title", "").lower() if meta else ""
+
+            # Prompts by class_type and title (or sample text)
+            if class_type in PROMPT_NODE_CLASSES:
+                text = get_prompt_text(inputs).lower()
+                if "positive" in text or "positive" in title or node_id in known_positive:
+                    roles["positive"].append(node_id)
+                elif "negative" in text or "negative" in title or node_id in known_negative:
+                    roles["negative"].append(node_id)
+
+            if class_type in LATENT_NODE_CLASSES:
+                roles["latent"].append(node_id)
+            if class_type in SAMPLER_NODE_CLASSES:
+                roles["sampler"].append(node_id)
+            if class_type == "BasicScheduler" or (class_type == "KSampler" and "steps" in inputs):
+                roles["scheduler"].append(node_id)
+            if class_type == "RandomNoise" or "noise_seed" in inputs:
+                roles["noise"].append(node_id)
+            if class_type in LOAD_IMAGE_NODE_CLASSES:
+                roles["load_image"].append(node_id)
+            if class_type == "SaveImage":
+                roles["outputs"].append(node_id)
+            if class_type in VIDEO_OUTPUT_NODE_CLASSES:
+                roles["video_outputs"].append(node_id)
+
+        # Fall back to the known nodes when none was detected
+        for role in ("positive", "negative", "latent", "scheduler", "noise"):
+            if not roles[role]:
+                roles[role] = [node_id for node_id in known_nodes.get(role, []) if node_id in self.workflow]
+        return roles
+
+    def _build_plan(self):
+        """Resolve once which (node, input) pairs receive each request value."""
+        plan = {"positive": [], "negative": [], "width": [], "height": [], "steps": [], "seed": [], "image": []}
+        for role in ("positive", "negative"):
+            for node_id in self.roles[role]:
+                inputs = self._inputs(node_id)
+                if inputs is not None:
+                    plan[role].append((node_id, _prompt_input_key(inputs)))
+        for node_id in self.roles["latent"]:
+            if self._inputs(node_id) is not None:
+                plan["width"].append((node_id, "width"))
+                plan["height"].append((node_id, "height"))
+        for node_id in self.roles["scheduler"]:
+            inputs = self._inputs(node_id)
+            if inputs is not None and "steps" in inputs:
+                plan["steps"].append((node_id, "steps"))
+        for node_id in dict.fromkeys(self.roles["sampler"] + self.roles["noise"]):
+            inputs = self._inputs(node_id) or {}
+            for key in ("noise_seed", "seed"):
+                if key in inputs:
+                    plan["seed"].append((node_id, key))
+        # Only the first LoadImage receives the uploaded image
+        for node_id in self.roles["load_image"][:1]:
+            if self._inputs(node_id) is not None:
+                plan["image"].append((node_id, "image"))
+        return {field: tuple(targets) for field, targets in plan.items()}
+
+    @property
+    def output_nodes(self):
+        """SaveImage nodes of the workflow (with the historical fallback to node 19)."""
+        return list(self.roles["outputs"]) or ["19"]
+
+    @property
+    def video_output_nodes(self):
+        """Video output nodes (with the historical fallback to node 110)."""
+        return list(self.roles["video_outputs"]) or ["110"]
+
+    @property
+    def node_json(self):
+        """JSON of each template node, encoded only once."""
+        if self._node_json is None:
+            self._node_json = {node_id: json.dumps(node) for node_id, node in self.workflow.items()}
+        return self._node_json
+
+    def base_text(self, role):
+        """Original text of the first non-empty node of a role ('positive' or 'negative')."""
+        return self.base_texts.get(role, "")
+
+    def instantiate(self, **values):
+        """Create an instance of the workflow and apply the plan values (None leaves an input unchanged)."""
+        workflow = WorkflowInstance(self)
+        for field, value in values.items():
+            if value is None:
+                continue
+            for node_id, input_key in self.plan.get(field, ()):
+                workflow.set_input(node_id, input_key, value)
+        return workflow
+
+    def warmup_variant(self, image=None):
+        """Minimal variant of the workflow, only meant to load its models on the backend.
+
+        It uses the smallest resolution, steps, frames and batch the nodes
+        accept, and discards the output: SaveImage becomes PreviewImage and
+        video combiners do not save the file. KSamplerAdvanced nodes keep their
+        steps because they split the range between several models (e.g. Wan
+        high/low noise), and with fewer steps one of them might never load.
+        image is the name of an already uploaded image for the LoadImage nodes.
+        """
+        workflow = self.instantiate(seed=0)
+        for node_id, node_data in self.workflow.items():
+            inputs = self._inputs(node_id)
+            if inputs is None:
+                continue
+            class_type = node_data.get("class_type", "")
+            if class_type == "SaveImage":
+                node = workflow.node(node_id)
+                node["class_type"] = "PreviewImage"
+                node["inputs"] = {"images": inputs.get("images")}
+                continue
+            if class_type in LOAD_IMAGE_NODE_CLASSES and image:
+                workflow.set_input(node_id, "image", image)
+            for key, value in WARMUP_INPUTS.items():
+                current = inputs.get(key)
+                # Literal values only: a list is a link to another node
+                if isinstance(current, (int, float)) and not isinstance(current, bool) and current > value:
+                    if key == "steps" and "start_at_step" in inputs:
+                        continue
+                    workflow.set_input(node_id, key, value)
+            if inputs.get("save_output") is True:
+                workflow.set_input(node_id, "save_output", False)
+            if "filename_prefix" in inputs:
+                workflow.set_input(node_id, "filename_prefix", "warmup")
+        return workflow
+
+
+class WorkflowInstance(dict):
+    """Workflow of one request that shares the nodes of its template.
+
+    It is a node_id -> node dict in which every unpatched node is the very
+    object held by the template, so nodes read from it must be treated as
+    read-only: mutating one in place would change the template and every
+    later request. Writes go through set_input/node, which copy just that node
+    first. to_json reuses the already encoded JSON of the shared nodes, so the
+    /prompt body is built without copying or re-serializing the whole workflow.
+    """
+
+    __slots__ = ('template', '_patched')
+
+    def __init__(self, template):
+        super().__init__(template.workflow)
+        self.template = template
+        self._patched = set()
+
+    def node(self, node_id):
+        """Own copy of a node (copied from the template the first time), safe to modify."""
+        if node_id not in self._patched:
+            base = dict.__getitem__(self, node_id)
+            node = dict(base)
+            node["inputs"] = dict(base.get("inputs") or {})
+            dict.__setitem__(self, node_id, node)
+            self._patched.add(node_id)
+        return dict.__getitem__(self, node_id)
+
+    def set_input(self, node_id, input_key, value):
+        """Set one input of a node without touching the template."""
+        self.node(node_id)["inputs"][input_key] = value
+
+    def to_json(self):
+        """Serialize the workflow like json.dumps would, reusing the encoded shared nodes."""
+        shared = self.template.workflow
+        node_json = self.template.node_json
+        parts = []
+        for node_id, node in self.items():
+            if node_id not in self._patched and shared.get(node_id) is node:
+                encoded = node_json[node_id]
+            else:
+                encoded = json.dumps(node)
+            parts.append(f"{json.dumps(node_id)}: {encoded}")
+        return "{" + ", ".join(parts) + "}"
+
+
+# Roles each kind of workflow needs to be patchable
+GENERATE_REQUIRED_ROLES = ("positive", "width", "seed")
+EDIT_REQUIRED_ROLES = ("positive", "image", "seed")
+
+def compile_generate_template(model, workflow):
+    """Compile a text-to-image workflow with the known nodes of its model."""
+    known_nodes = KNOWN_GENERATE_NODES.get(model, DEFAULT_KNOWN_NODES)
+    return WorkflowTemplate(model, workflow, known_nodes, required_roles=GENERATE_REQUIRED_ROLES)
+
+def compile_edit_template(workflow, name='edit'):
+    """Compile an edit workflow; without a 'positive' title the TextEncodeQwenImageEditPlus nodes are used."""
+    known_nodes = {
+        "positive": [
+            node_id for node_id, node_data in workflow.items()
+            if isinstance(node_data, dict) and node_data.get("class_type") == "TextEncodeQwenImageEditPlus"
+        ]
+    }
+    return WorkflowTemplate(name, workflow, known_nodes, required_roles=EDIT_REQUIRED_ROLES)
+
+class WorkflowRegistry:
+    """Workflow registry with lazy loading, caching and hot reload.
+
+    Each registered workflow (or any path under workflows/) is loaded and
+    compiled the first time it is requested and kept in memory. Every access
+    compares the file's mtime and reloads it when it changed, so a tuned
+    workflow is used without a restart. If a reload fails the previous version
+    stays in use.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self._names = {}
+        self._modes = {}
+        self._entries = {}
+        self._lock = threading.RLock()
+
+    def register(self, name, path, compiler=None, default_relative=None, mode=None):
+        """Map a logical name to a file, the function that compiles it and its mode."""
+        with self._lock:
+            self._names[name] = (path, default_relative, compiler)
+            self._modes[name] = mode
+
+    def names(self, mode=None):
+        """Registered names, optionally only those of one mode."""
+        with self._lock:
+            return [name for name in self._names if mode is None or self._modes.get(name) == mode]
+
+    def mode_of(self, name):
+        return self._modes.get(name)
+
+    def _resolve(self, name):
+        """Absolute path and compiler of a registered name or of a path under workflows/."""
+        with self._lock:
+            registered = self._names.get(name)
+        if registered:
+            path, default_relative, compiler = registered
+        else:
+            path, default_relative, compiler = name, None, None
+        project_dir = os.path.dirname(self.root)
+        candidates = [path, os.path.join(project_dir, path), os.path.join(self.root, path)]
+        if default_relative:
+            candidates.append(os.path.join(project_dir, default_relative))
+        for candidate in candidates:
+            if os.path.isfile(candidate):
+                return os.path.abspath(candidate), compiler
+        raise FileNotFoundError(f"Workflow not found in any of the paths: {candidates}")
+
+    def get(self, name):
+        """Compiled template of a workflow (reloaded when its file changed).
+
+        Raises:
+            FileNotFoundError: If the file does not exist
+            ValueError: If the JSON is invalid or required roles are missing
+        """
+        path, compiler = self._resolve(name)
+        mtime = os.path.getmtime(path)
+        key = (name, path)
+        entry = self._entries.get(key)
+        if entry and entry[0] == mtime:
+            return entry[1]
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] == mtime:
+                return entry[1]
+            try:
+                workflow = load_workflow(path)
+                template = (compiler or WorkflowTemplate)(name, workflow)
+            except Exception as e:
+                if entry:
+                    print(f"[WORKFLOW] Could not reload '{name}', keeping the previous version: {e}")
+                    # Do not retry until the file changes again
+                    self._entries[key] = (mtime, entry[1])
+                    return entry[1]
+                raise
+            if entry:
+                print(f"[WORKFLOW] '{name}' reloaded after it changed on disk")
+            self._entries[key] = (mtime, template)
+            return template
+
+    def check(self):
+        """Compile every registered workflow; returns {name: error}."""
+        errors = {}
+        for name in self.names():
+            try:
+                self.get(name)
+            except Exception as e:
+                errors[name] = str(e)
+                print(f"[WORKFLOW] Error in workflow '{name}': {e}")
+        return errors
+
+
+WORKFLOWS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'workflows')
+
+workflow_registry = WorkflowRegistry(WORKFLOWS_DIR)
+workflow_registry.register(
+    'lumina', WORKFLOW_PATH, lambda name, workflow: compile_generate_template('lumina', workflow),
+    'workflows/text-to-image/text-to-image-lumina.json', mode='generate'
+)
+workflow_registry.register(
+    'chroma', 'workflows/text-to-image/text-to-image-chroma.json',
+    lambda name, workflow: compile_generate_template('chroma', workflow), mode='generate'
+)
+workflow_registry.register(
+    'qwen', 'workflows/text-to-image/text-to-image-qwen-edit.json',
+    lambda name, workflow: compile_generate_template('qwen', workflow), mode='generate'
+)
+workflow_registry.register(
+    'edit', EDIT_WORKFLOW_PATH, lambda name, workflow: compile_edit_template(workflow, name),
+    'workflows/edit-image/edit-image-qwen-2509-aio.json', mode='edit'
+)
+workflow_registry.register('video', VIDEO_WORKFLOW_PATH, default_relative='workflows/image-to-video/video_wan2_2_14B_i2v_remix_sound.json', mode='video')
+workflow_registry.register('video_no_sound', VIDEO_NO_SOUND_WORKFLOW_PATH, default_relative='workflows/image-to-video/video_wan2_2_14B_i2v_remix.json', mode='video')
+workflow_registry.register('video_nsfw', VIDEO_NSFW_WORKFLOW_PATH, default_relative='workflows/image-to-video/video_wan2_2_14B_i2v_remix_sound_nsfw.json', mode='video')
+
+
+def get_workflow_template(name):
+    """Compiled template of a registered workflow (or of a path under workflows/)."""
+    return workflow_registry.get(name)
+
+def get_template_by_model(model='lumina'):
+    """Compiled template of the selected text-to-image model.
+
     Args:
-        model: Modelo a usar ('lumina', 'chroma' o 'qwen')
-    
+        model: Model to use ('lumina', 'chroma' or 'qwen')
+
     Returns:
-        Workflow JSON correspondiente al modelo
+        WorkflowTemplate of the model; Lumina when the model is not available
     """
     model_lower = model.lower() if model else 'lumina'
-    if model_lower == 'chroma':
-        if CHROMA_WORKFLOW is None:
-            print(f"Warning: Chroma workflow no disponible, usando Lumina por defecto")
-            return BASE_WORKFLOW
-        return CHROMA_WORKFLOW
-    if model_lower == 'qwen':
-        if QWEN_WORKFLOW is None:
-            print("Warning: Qwen workflow no disponible, usando Lumina por defecto")
-            return BASE_WORKFLOW
-        return QWEN_WORKFLOW
-    else:
-        return BASE_WORKFLOW
-
-try:
-    EDIT_WORKFLOW = load_workflow(EDIT_WORKFLOW_PATH, 'workflows/edit-image/edit-image-qwen-2509-aio.json')
-except Exception as e:
-    print(f"Error fatal: No se pudo cargar el workflow de edición: {e}")
-    print("Asegúrate de que el archivo workflows/edit-image/edit-image-qwen-2509.json existe")
-    sys.exit(1)
-
-try:
-    VIDEO_WORKFLOW = load_workflow(VIDEO_WORKFLOW_PATH, 'workflows/image-to-video/video_wan2_2_14B_i2v_remix.json')
-except Exception as e:
-    print(f"Warning: No se pudo cargar el workflow de video: {e}")
-    VIDEO_WORKFLOW = None
+    if model_lower in ('chroma', 'qwen'):
+        try:
+            return workflow_registry.get(model_lower)
+        except Exception as e:
+            print(f"Warning: {model_lower} workflow not available, falling back to Lumina: {e}")
+    return workflow_registry.get('lumina')
 
+def check_workflows():
+    """Check at startup that every registered workflow loads and compiles."""
+    print(f"[WORKFLOW] Checking {len(workflow_registry.names())} registered workflow(s)")
+    errors = workflow_registry.check()
+    if errors:
+        print(f"[WORKFLOW] {len(errors)} workflow(s) with errors: {', '.join(errors)}")
+    return errors